@@ -0,0 +1,4 @@
+"""Performance benchmarks of the MEDS-Tab stages on synthetic MEDS data.
+
+See ``benchmarks/README.md`` for how to run the pytest-benchmark and asv suites.
+"""
@@ -0,0 +1,64 @@
+"""asv suite tracking the wall time, CPU time and peak memory of each stage across scales and commits.
+
+The stages run in their own processes (see `benchmarks.harness`), so their measurements are recorded through
+asv ``track_`` benchmarks of one pipeline run per scale. The scales are set by the comma-separated
+``MEDS_TAB_BENCHMARK_SCALES`` environment variable; further stage configuration overrides are set by the
+space-separated ``MEDS_TAB_BENCHMARK_OVERRIDES``.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# asv imports this suite from the repository rather than as part of the installed package
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from benchmarks.harness import PIPELINE, run_pipeline  # noqa: E402
+from benchmarks.synthetic import SCALES, write_synthetic_dataset  # noqa: E402
+
+BENCHMARK_SCALES = os.environ.get("MEDS_TAB_BENCHMARK_SCALES", "tiny,small").split(",")
+BENCHMARK_OVERRIDES = os.environ.get("MEDS_TAB_BENCHMARK_OVERRIDES", "").split()
+
+
+class Pipeline:
+    """The measurements of each stage of the pipeline, per scale."""
+
+    params = [list(SCALES), PIPELINE]
+    param_names = ["scale", "stage"]
+    timeout = 4 * 3600
+
+    def setup_cache(self) -> dict[str, dict[str, dict]]:
+        results = {}
+        root = Path(tempfile.mkdtemp())
+        try:
+            for scale in BENCHMARK_SCALES:
+                dirs = write_synthetic_dataset(root / scale / "dataset", **SCALES[scale])
+                results[scale] = run_pipeline(
+                    dirs["input_dir"],
+                    dirs["input_label_dir"],
+                    root / scale / "output",
+                    extra_overrides=BENCHMARK_OVERRIDES,
+                )
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        return results
+
+    def setup(self, results, scale, stage):
+        if scale not in results:
+            raise NotImplementedError(f"Scale {scale} is not in MEDS_TAB_BENCHMARK_SCALES")
+
+    def track_wall_time(self, results, scale, stage):
+        return results[scale][stage]["wall_time_s"]
+
+    track_wall_time.unit = "seconds"
+
+    def track_cpu_time(self, results, scale, stage):
+        return results[scale][stage]["cpu_time_s"]
+
+    track_cpu_time.unit = "seconds"
+
+    def track_peak_rss(self, results, scale, stage):
+        return results[scale][stage]["peak_rss_mb"]
+
+    track_peak_rss.unit = "MB"
@@ -0,0 +1,132 @@
+"""Runs the MEDS-Tab stages on a dataset in separate processes, measuring their time and peak memory.
+
+Every stage runs in its own process, as it does from the command line, so its peak resident set size can be
+read from the resource usage of the process when it exits. Run as a module, this loads the task-specific
+data of all splits through `TabularDataset`, the way models load it for training.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import time
+from importlib.resources import files
+from pathlib import Path
+
+from hydra import compose, initialize_config_dir
+
+from MEDS_tabular_automl.tabular_dataset import TabularDataset
+
+TASK_NAME = "benchmark_task"
+PIPELINE = ["describe_codes", "tabularize_static", "tabularize_time_series", "cache_task", "load_dataset"]
+STAGE_MODULES = {
+    "describe_codes": "MEDS_tabular_automl.scripts.describe_codes",
+    "tabularize_static": "MEDS_tabular_automl.scripts.tabularize_static",
+    "tabularize_time_series": "MEDS_tabular_automl.scripts.tabularize_time_series",
+    "cache_task": "MEDS_tabular_automl.scripts.cache_task",
+    "load_dataset": "benchmarks.harness",
+}
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def get_stage_overrides(stage: str, input_dir: Path, input_label_dir: Path, output_dir: Path) -> list[str]:
+    """Returns the configuration overrides of a benchmarked stage.
+
+    Outputs are always recomputed, so repeated runs measure the same work.
+
+    Examples:
+        >>> get_stage_overrides("cache_task", Path("data"), Path("labels"), Path("out"))[-2:]
+        ['task_name=benchmark_task', 'input_label_dir=labels']
+        >>> get_stage_overrides("load_dataset", Path("data"), Path("labels"), Path("out"))[-1]
+        'cache_dir=out/.benchmark_dataset_cache'
+        >>> get_stage_overrides("foo", Path("data"), Path("labels"), Path("out"))
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown stage foo; expected one of describe_codes, tabularize_static, ...
+    """
+    if stage not in STAGE_MODULES:
+        raise ValueError(f"Unknown stage {stage}; expected one of {', '.join(PIPELINE)}")
+    overrides = [f"input_dir={input_dir}", f"output_dir={output_dir}", "do_overwrite=True"]
+    if stage == "cache_task":
+        overrides += [f"task_name={TASK_NAME}", f"input_label_dir={input_label_dir}"]
+    elif stage == "load_dataset":
+        # The dataset state is cached across loads, so each load starts from an empty cache
+        overrides += [
+            f"task_name={TASK_NAME}",
+            f"output_model_dir={output_dir / '.benchmark_models'}",
+            f"cache_dir={output_dir / '.benchmark_dataset_cache'}",
+        ]
+    return overrides
+
+
+def run_stage(
+    stage: str, input_dir: Path, input_label_dir: Path, output_dir: Path, extra_overrides: list[str] = ()
+) -> dict:
+    """Runs a stage in a separate process and returns its measurements.
+
+    Args:
+        stage: The stage, one of `PIPELINE`.
+        input_dir: The MEDS data directory.
+        input_label_dir: The directory of the task labels.
+        output_dir: The output directory of the pipeline.
+        extra_overrides: Further configuration overrides, e.g., ``tabularization.window_sizes=[1d,full]``.
+
+    Returns:
+        The stage with its wall time and CPU time in seconds and its peak resident set size in MB.
+
+    Raises:
+        RuntimeError: If the stage fails; its log is kept in ``{output_dir}/.benchmark_logs``.
+    """
+    input_dir, input_label_dir, output_dir = Path(input_dir), Path(input_label_dir), Path(output_dir)
+    overrides = get_stage_overrides(stage, input_dir, input_label_dir, output_dir) + list(extra_overrides)
+    if stage == "load_dataset":
+        shutil.rmtree(output_dir / ".benchmark_dataset_cache", ignore_errors=True)
+
+    log_fp = output_dir / ".benchmark_logs" / f"{stage}.log"
+    log_fp.parent.mkdir(parents=True, exist_ok=True)
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(REPO_ROOT), os.environ.get("PYTHONPATH", "")])}
+    start = time.perf_counter()
+    with log_fp.open("w") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, "-m", STAGE_MODULES[stage], *overrides],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.returncode}; see {log_fp}")
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {
+        "stage": stage,
+        "wall_time_s": wall_time,
+        "cpu_time_s": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": peak_rss_bytes / 2**20,
+    }
+
+
+def run_pipeline(
+    input_dir: Path, input_label_dir: Path, output_dir: Path, stages: list[str] = PIPELINE, **kwargs
+) -> dict[str, dict]:
+    """Runs the stages in order with `run_stage` and returns their measurements, keyed by stage."""
+    return {stage: run_stage(stage, input_dir, input_label_dir, output_dir, **kwargs) for stage in stages}
+
+
+def load_dataset(overrides: list[str]):
+    """Loads the task-specific data of every split through `TabularDataset`, as models do for training.
+
+    Args:
+        overrides: The overrides of the ``launch_model`` configuration.
+    """
+    config_dir = files("MEDS_tabular_automl").joinpath("configs")
+    with initialize_config_dir(version_base=None, config_dir=str(config_dir)):
+        cfg = compose(config_name="launch_model", overrides=overrides)
+    for split in ["train", "tuning", "held_out"]:
+        TabularDataset(cfg.model_launcher, split).get_data()
+
+
+if __name__ == "__main__":
+    load_dataset(sys.argv[1:])
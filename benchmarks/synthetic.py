@@ -0,0 +1,227 @@
+"""Generates synthetic MEDS datasets and task labels of configurable size for benchmarking."""
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+# Benchmark scales, from quick smoke runs to shards resembling a real EHR extract.
+SCALES = {
+    "tiny": {"n_subjects": 40, "events_per_subject": 50, "n_codes": 30},
+    "small": {"n_subjects": 400, "events_per_subject": 200, "n_codes": 300},
+    "medium": {"n_subjects": 4_000, "events_per_subject": 500, "n_codes": 2_000},
+    "large": {"n_subjects": 20_000, "events_per_subject": 1_000, "n_codes": 10_000},
+}
+
+SPLIT_FRACTIONS = {"train": 0.8, "tuning": 0.1, "held_out": 0.1}
+START_TIME = np.datetime64(datetime(2000, 1, 1), "us")
+MEAN_GAP_HOURS = 12.0
+EVENTS_PER_TIME = 4.0
+
+
+def generate_meds_shard(
+    subject_ids: np.ndarray,
+    events_per_subject: int,
+    n_codes: int,
+    value_density: float,
+    n_static_codes: int,
+    rng: np.random.Generator,
+) -> pl.DataFrame:
+    """Generates the MEDS data of a shard of subjects.
+
+    Each subject has a categorical static code (e.g., an eye color) and a numeric static code (a height),
+    followed by a Poisson distributed number of timestamped events. Events are grouped into measurement times
+    of about ``EVENTS_PER_TIME`` events, whose gaps are exponentially distributed. Codes follow a Zipf-like
+    distribution, so a few codes are frequent and most are rare, and a random ``value_density`` fraction of
+    them carries numeric values.
+
+    Args:
+        subject_ids: The ids of the subjects of the shard.
+        events_per_subject: The mean number of timestamped events per subject.
+        n_codes: The number of distinct timestamped codes.
+        value_density: The fraction of timestamped codes with numeric values.
+        n_static_codes: The number of distinct categorical static codes.
+        rng: The random number generator.
+
+    Returns:
+        The MEDS data, with columns subject_id, time, code and numeric_value, sorted by subject and time with
+        the static events first.
+
+    Examples:
+        >>> df = generate_meds_shard(np.array([1, 2]), 10, 5, 0.5, 2, np.random.default_rng(0))
+        >>> df.columns, df.schema["time"], df.schema["numeric_value"]
+        (['subject_id', 'time', 'code', 'numeric_value'], Datetime(time_unit='us', time_zone=None), Float32)
+        >>> static = df.filter(pl.col("time").is_null())
+        >>> static.group_by("subject_id").len().sort("subject_id")["len"].to_list()
+        [2, 2]
+        >>> df.equals(df.sort("subject_id", "time", nulls_last=False, maintain_order=True))
+        True
+    """
+    n_subjects = len(subject_ids)
+    code_probs = 1.0 / np.arange(1, n_codes + 1) ** 1.1
+    code_probs /= code_probs.sum()
+    is_numeric_code = rng.random(n_codes) < value_density
+    code_means = rng.normal(100.0, 20.0, n_codes)
+
+    n_events = np.maximum(rng.poisson(events_per_subject, n_subjects), 1)
+    event_subjects = np.repeat(subject_ids, n_events)
+    subject_starts = np.repeat(np.cumsum(n_events) - n_events, n_events)
+
+    # An event starts a new measurement time with probability 1 / EVENTS_PER_TIME
+    new_time = rng.random(len(event_subjects)) < 1.0 / EVENTS_PER_TIME
+    gaps_us = np.where(new_time, rng.exponential(MEAN_GAP_HOURS * 3600e6, len(event_subjects)), 0.0)
+    offsets_us = np.cumsum(gaps_us)
+    offsets_us -= offsets_us[subject_starts]
+    start_offsets_us = rng.uniform(0, 20 * 365 * 24 * 3600e6, n_subjects)
+    offsets_us += np.repeat(start_offsets_us, n_events)
+
+    codes = rng.choice(n_codes, size=len(event_subjects), p=code_probs)
+    values = np.where(is_numeric_code[codes], rng.normal(code_means[codes], 10.0), np.nan)
+    events = pl.DataFrame(
+        {
+            "subject_id": event_subjects.astype(np.int64),
+            "time": START_TIME + offsets_us.astype("timedelta64[us]"),
+            "code": pl.Series([f"CODE//{code}" for code in range(n_codes)]).gather(codes),
+            "numeric_value": pl.Series(values, dtype=pl.Float32, nan_to_null=True),
+        }
+    )
+
+    static_codes = pl.Series([f"STATIC//{code}" for code in range(n_static_codes)])
+    static_events = pl.concat(
+        [
+            pl.DataFrame(
+                {
+                    "subject_id": subject_ids.astype(np.int64),
+                    "code": static_codes.gather(rng.integers(0, n_static_codes, n_subjects)),
+                    "numeric_value": pl.Series([None] * n_subjects, dtype=pl.Float32),
+                }
+            ),
+            pl.DataFrame(
+                {
+                    "subject_id": subject_ids.astype(np.int64),
+                    "code": ["HEIGHT"] * n_subjects,
+                    "numeric_value": pl.Series(rng.normal(170.0, 10.0, n_subjects), dtype=pl.Float32),
+                }
+            ),
+        ]
+    ).with_columns(pl.lit(None, dtype=pl.Datetime("us")).alias("time"))
+
+    return (
+        pl.concat([static_events.select(events.columns), events])
+        .sort("subject_id", "time", nulls_last=False, maintain_order=True)
+        .select("subject_id", "time", "code", "numeric_value")
+    )
+
+
+def generate_labels(
+    meds_df: pl.DataFrame, rng: np.random.Generator, max_per_subject: int = 2
+) -> pl.DataFrame:
+    """Samples task labels at up to ``max_per_subject`` event times of each subject.
+
+    Args:
+        meds_df: The MEDS data of the subjects.
+        rng: The random number generator.
+        max_per_subject: The maximum number of prediction times per subject.
+
+    Returns:
+        The labels, with columns subject_id, prediction_time and boolean_value.
+
+    Examples:
+        >>> rng = np.random.default_rng(0)
+        >>> meds_df = generate_meds_shard(np.array([1, 2, 3]), 10, 5, 0.5, 2, rng)
+        >>> labels = generate_labels(meds_df, rng)
+        >>> labels.columns
+        ['subject_id', 'prediction_time', 'boolean_value']
+        >>> labels.group_by("subject_id").len()["len"].max() <= 2
+        True
+    """
+    times = meds_df.filter(pl.col("time").is_not_null()).select("subject_id", "time").unique()
+    times = times.with_columns(pl.Series("_rank", rng.random(len(times))))
+    labels = (
+        times.sort("_rank")
+        .group_by("subject_id", maintain_order=True)
+        .head(max_per_subject)
+        .sort("subject_id", "time")
+    )
+    return labels.select(
+        "subject_id",
+        pl.col("time").alias("prediction_time"),
+        pl.Series("boolean_value", rng.random(len(labels)) < 0.5),
+    )
+
+
+def write_synthetic_dataset(
+    output_dir: Path | str,
+    n_subjects: int,
+    events_per_subject: int,
+    n_codes: int,
+    value_density: float = 0.3,
+    n_static_codes: int = 5,
+    subjects_per_shard: int = 1_000,
+    seed: int = 0,
+) -> dict[str, Path]:
+    """Writes a synthetic MEDS dataset, sharded by split, and labels for a task on it.
+
+    The subjects are split 80/10/10 into the train, tuning and held_out splits, each in shards of at most
+    ``subjects_per_shard`` subjects, written to ``{output_dir}/data/{split}/{shard}.parquet``. The labels
+    are written to ``{output_dir}/labels/0.parquet``.
+
+    Args:
+        output_dir: The directory to write the dataset to.
+        n_subjects: The number of subjects; at least 10 so each split has subjects.
+        events_per_subject: The mean number of timestamped events per subject.
+        n_codes: The number of distinct timestamped codes.
+        value_density: The fraction of timestamped codes with numeric values.
+        n_static_codes: The number of distinct categorical static codes.
+        subjects_per_shard: The maximum number of subjects per shard.
+        seed: The random seed.
+
+    Returns:
+        The data and label directories, keyed by "input_dir" and "input_label_dir".
+
+    Raises:
+        ValueError: If there are fewer than 10 subjects.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     dirs = write_synthetic_dataset(d, **SCALES["tiny"], subjects_per_shard=16)
+        ...     sorted(str(fp.relative_to(dirs["input_dir"])) for fp in dirs["input_dir"].rglob("*.parquet"))
+        ...     pl.read_parquet(dirs["input_label_dir"] / "0.parquet")["subject_id"].n_unique()
+        ['held_out/0.parquet', 'train/0.parquet', 'train/1.parquet', 'tuning/0.parquet']
+        40
+        >>> write_synthetic_dataset("unused", n_subjects=5, events_per_subject=1, n_codes=1)
+        Traceback (most recent call last):
+            ...
+        ValueError: At least 10 subjects are needed for the train, tuning and held_out splits; got 5.
+    """
+    if n_subjects < 10:
+        raise ValueError(
+            f"At least 10 subjects are needed for the train, tuning and held_out splits; got {n_subjects}."
+        )
+    output_dir = Path(output_dir)
+    data_dir, label_dir = output_dir / "data", output_dir / "labels"
+    rng = np.random.default_rng(seed)
+
+    subject_ids = rng.permutation(np.arange(1, n_subjects + 1) * 7 + 1_000)
+    split_ends = (np.cumsum(list(SPLIT_FRACTIONS.values())) * n_subjects).round().astype(int)
+    split_starts = np.concatenate([[0], split_ends[:-1]])
+    shards, labels = {}, []
+    for split, start, end in zip(SPLIT_FRACTIONS, split_starts, split_ends):
+        split_ids = np.sort(subject_ids[start:end])
+        for shard, shard_start in enumerate(range(0, len(split_ids), subjects_per_shard)):
+            shard_ids = split_ids[shard_start : shard_start + subjects_per_shard]
+            shard_df = generate_meds_shard(
+                shard_ids, events_per_subject, n_codes, value_density, n_static_codes, rng
+            )
+            shard_fp = data_dir / split / f"{shard}.parquet"
+            shard_fp.parent.mkdir(parents=True, exist_ok=True)
+            shard_df.write_parquet(shard_fp)
+            shards[f"{split}/{shard}"] = shard_ids.tolist()
+            labels.append(generate_labels(shard_df, rng))
+
+    (data_dir / ".shards.json").write_text(json.dumps(shards))
+    label_dir.mkdir(parents=True, exist_ok=True)
+    pl.concat(labels).write_parquet(label_dir / "0.parquet")
+    return {"input_dir": data_dir, "input_label_dir": label_dir}
@@ -0,0 +1,54 @@
+"""pytest-benchmark suite timing each stage of the pipeline on synthetic data of several scales.
+
+Each stage runs once per round in its own process (see `harness.run_stage`); its CPU time and peak resident
+set size are stored in the ``extra_info`` of the benchmark, so they are saved and compared along with the
+wall times, e.g.::
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:20%
+
+The scales (see `synthetic.SCALES`) are set by the comma-separated ``MEDS_TAB_BENCHMARK_SCALES`` environment
+variable, the number of rounds by ``MEDS_TAB_BENCHMARK_ROUNDS``, and further stage configuration overrides by
+the space-separated ``MEDS_TAB_BENCHMARK_OVERRIDES``.
+"""
+import os
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from .harness import PIPELINE, run_stage  # noqa: E402
+from .synthetic import SCALES, write_synthetic_dataset  # noqa: E402
+
+BENCHMARK_SCALES = os.environ.get("MEDS_TAB_BENCHMARK_SCALES", "tiny").split(",")
+BENCHMARK_ROUNDS = int(os.environ.get("MEDS_TAB_BENCHMARK_ROUNDS", "1"))
+BENCHMARK_OVERRIDES = os.environ.get("MEDS_TAB_BENCHMARK_OVERRIDES", "").split()
+
+
+@pytest.fixture(scope="module", params=BENCHMARK_SCALES)
+def pipeline_dirs(request, tmp_path_factory) -> dict:
+    """The synthetic dataset of a scale and the output directory its stages run in, in pipeline order."""
+    root = tmp_path_factory.mktemp(request.param)
+    dirs = write_synthetic_dataset(root / "dataset", **SCALES[request.param])
+    return {**dirs, "output_dir": root / "output", "scale": request.param}
+
+
+@pytest.mark.parametrize("stage", PIPELINE)
+def test_stage(benchmark, pipeline_dirs, stage):
+    benchmark.group = f"{pipeline_dirs['scale']}"
+    benchmark.extra_info["scale"] = pipeline_dirs["scale"]
+    benchmark.extra_info.update(SCALES[pipeline_dirs["scale"]])
+
+    def run():
+        result = run_stage(
+            stage,
+            pipeline_dirs["input_dir"],
+            pipeline_dirs["input_label_dir"],
+            pipeline_dirs["output_dir"],
+            BENCHMARK_OVERRIDES,
+        )
+        # The peak of the slowest round is kept
+        for key in ["cpu_time_s", "peak_rss_mb"]:
+            benchmark.extra_info[key] = max(benchmark.extra_info.get(key, 0), result[key])
+
+    benchmark.pedantic(run, rounds=BENCHMARK_ROUNDS, iterations=1)
@@ -2,6 +2,8 @@ from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import TypeVar
 
+import numpy as np
+import scipy.sparse as sp
 from mixins import TimeableMixin
 from omegaconf import DictConfig
 
@@ -23,10 +25,24 @@ class BaseModel(ABC, TimeableMixin):
     def evaluate(self) -> float:
         pass
 
+    @abstractmethod
+    def evaluate_metrics(self, split: str = "tuning") -> dict[str, float]:
+        pass
+
     @abstractmethod
     def save_model(self, output_fp: Path):
         pass
 
+    @abstractmethod
+    def load_model(self, input_fp: Path):
+        """Restores a model written by `save_model`, replacing the model of this launcher."""
+        pass
+
+    @abstractmethod
+    def predict(self, X: sp.csc_matrix) -> np.ndarray:
+        """Returns the predicted probability of the positive class for each row of `X`."""
+        pass
+
     @classmethod
     def initialize(cls: T, **kwargs) -> T:
         return cls(DictConfig(kwargs, flags={"allow_objects": True}))
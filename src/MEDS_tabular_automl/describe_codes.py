@@ -1,9 +1,8 @@
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 
-from MEDS_tabular_automl.utils import get_feature_names
-
 
 def convert_to_df(freq_dict: dict[str, int]) -> pl.DataFrame:
     """Converts a dictionary of code frequencies to a Polars DataFrame.
@@ -70,12 +69,14 @@ def compute_feature_frequencies(shard_df: pl.LazyFrame) -> pl.DataFrame:
     aggregations by computing frequency counts for certain attributes and organizing the results into specific
     categories based on the dataset's features.
 
+    All four frequencies (static presence, static values, time-series codes and time-series values) are
+    computed with conditional sums in a single group_by over the shard.
+
     Args:
         shard_df: A DataFrame containing the data to be analyzed and split (e.g., 'train', 'test').
 
     Returns:
-        A tuple containing a list of feature columns and a dictionary of code properties identified
-        during the evaluation.
+        A DataFrame with the "code" of each feature (e.g., "A/static/present") and its "count".
 
     Examples:
         >>> from datetime import datetime
@@ -100,34 +101,204 @@ def compute_feature_frequencies(shard_df: pl.LazyFrame) -> pl.DataFrame:
         ...     }
         ... )
     """
-    static_df = shard_df.filter(
-        pl.col("subject_id").is_not_null() & pl.col("code").is_not_null() & pl.col("time").is_null()
+    is_static = pl.col("time").is_null()
+    has_value = pl.col("numeric_value").is_not_null()
+
+    return (
+        shard_df.filter(pl.col("subject_id").is_not_null() & pl.col("code").is_not_null())
+        .group_by(pl.col("code").alias("base_code"))
+        .agg(
+            is_static.sum().alias("static/present"),
+            (is_static & has_value).sum().alias("static/first"),
+            (~is_static).sum().alias("code"),
+            (~is_static & has_value).sum().alias("value"),
+        )
+        .unpivot(index="base_code", variable_name="aggregation", value_name="count")
+        .filter(pl.col("count") > 0)
+        .select(
+            pl.concat_str("base_code", "aggregation", separator="/").alias("code"),
+            pl.col("count").cast(pl.Int64),
+        )
+        .collect()
     )
-    static_code_freqs_df = static_df.group_by("code").agg(pl.count("code").alias("count")).collect()
-    static_code_freqs = {
-        row["code"] + "/static/present": row["count"] for row in static_code_freqs_df.iter_rows(named=True)
-    }
-
-    static_value_df = static_df.filter(pl.col("numeric_value").is_not_null())
-    static_value_freqs_df = (
-        static_value_df.group_by("code").agg(pl.count("numeric_value").alias("count")).collect()
+
+
+def sum_feature_frequencies(freq_df: pl.LazyFrame) -> pl.DataFrame:
+    """Sums the per-shard feature frequencies of a lazy scan over all shard frequency files.
+
+    Args:
+        freq_df: A LazyFrame with columns "code" and "count", typically a single scan over all shards' outputs
+            of `compute_feature_frequencies`.
+
+    Returns:
+        A DataFrame with the total "count" of each "code", sorted by code.
+
+    Examples:
+        >>> shard_1 = pl.DataFrame({"code": ["A/code", "B/value"], "count": [1, 2]})
+        >>> shard_2 = pl.DataFrame({"code": ["B/value", "C/code"], "count": [3, 4]})
+        >>> sum_feature_frequencies(pl.concat([shard_1, shard_2]).lazy())
+        shape: (3, 2)
+        ┌─────────┬───────┐
+        │ code    ┆ count │
+        │ ---     ┆ ---   │
+        │ str     ┆ i64   │
+        ╞═════════╪═══════╡
+        │ A/code  ┆ 1     │
+        │ B/value ┆ 5     │
+        │ C/code  ┆ 4     │
+        └─────────┴───────┘
+    """
+    return freq_df.group_by("code").agg(pl.col("count").sum()).sort("code").collect()
+
+
+def compute_code_stats(shard_df: pl.LazyFrame, n_quantiles: int = 21) -> pl.DataFrame:
+    """Computes mergeable per-code statistics of a shard in a single pass.
+
+    The statistics are computed per code (without aggregation suffix) over all events of the code, static or
+    not, and can be combined across shards with `merge_code_stats`. Numeric value moments are stored as the
+    mean and the sum of squared deviations from it (``m2``) so that they can be merged without loss of
+    precision, and the value distribution is summarized by ``n_quantiles`` evenly spaced order statistics.
+
+    Args:
+        shard_df: A MEDS shard.
+        n_quantiles: The number of evenly spaced quantiles (including the min and max) kept per code.
+
+    Returns:
+        A DataFrame with one row per code and the columns "code", "n_occurrences", "n_subjects", "n_values",
+        "mean", "m2", "min", "max", "quantiles" and "shard_n_subjects" (the number of subjects in the shard).
+        The shard itself is identified when merging by a "shard" column, e.g. the file path of the output.
+
+    Examples:
+        >>> data = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2, 3],
+        ...     "code": ["A", "A", "B", "A", "B", "B"],
+        ...     "numeric_value": [1.0, 3.0, None, 2.0, None, None],
+        ... }).lazy()
+        >>> compute_code_stats(data, n_quantiles=3).drop("quantiles")
+        shape: (2, 9)
+        ┌──────┬───────────────┬────────────┬──────────┬───┬──────┬──────┬──────┬──────────────────┐
+        │ code ┆ n_occurrences ┆ n_subjects ┆ n_values ┆ … ┆ m2   ┆ min  ┆ max  ┆ shard_n_subjects │
+        │ ---  ┆ ---           ┆ ---        ┆ ---      ┆   ┆ ---  ┆ ---  ┆ ---  ┆ ---              │
+        │ str  ┆ u32           ┆ u32        ┆ u32      ┆   ┆ f64  ┆ f64  ┆ f64  ┆ u32              │
+        ╞══════╪═══════════════╪════════════╪══════════╪═══╪══════╪══════╪══════╪══════════════════╡
+        │ A    ┆ 3             ┆ 2          ┆ 3        ┆ … ┆ 2.0  ┆ 1.0  ┆ 3.0  ┆ 3                │
+        │ B    ┆ 3             ┆ 3          ┆ 0        ┆ … ┆ null ┆ null ┆ null ┆ 3                │
+        └──────┴───────────────┴────────────┴──────────┴───┴──────┴──────┴──────┴──────────────────┘
+        >>> compute_code_stats(data, n_quantiles=3)["quantiles"].to_list()
+        [[1.0, 2.0, 3.0], None]
+    """
+    if n_quantiles < 2:
+        raise ValueError(f"n_quantiles must be at least 2, got {n_quantiles}")
+
+    value = pl.col("numeric_value").cast(pl.Float64)
+    n_values = value.count()
+    quantiles = pl.concat_list([value.quantile(q, "nearest") for q in np.linspace(0, 1, n_quantiles)])
+
+    return (
+        shard_df.filter(pl.col("subject_id").is_not_null() & pl.col("code").is_not_null())
+        .with_columns(pl.col("subject_id").n_unique().alias("shard_n_subjects"))
+        .group_by("code")
+        .agg(
+            pl.len().alias("n_occurrences"),
+            pl.col("subject_id").n_unique().alias("n_subjects"),
+            n_values.alias("n_values"),
+            value.mean().alias("mean"),
+            (value.var(ddof=0) * n_values).alias("m2"),
+            value.min().alias("min"),
+            value.max().alias("max"),
+            quantiles.alias("quantiles"),
+            pl.col("shard_n_subjects").first(),
+        )
+        .with_columns(pl.when(pl.col("n_values") > 0).then("quantiles").alias("quantiles"))
+        .sort("code")
+        .collect()
     )
-    static_value_freqs = {
-        row["code"] + "/static/first": row["count"] for row in static_value_freqs_df.iter_rows(named=True)
-    }
 
-    ts_df = shard_df.filter(
-        pl.col("subject_id").is_not_null() & pl.col("code").is_not_null() & pl.col("time").is_not_null()
+
+def merge_code_stats(stats_df: pl.LazyFrame, n_quantiles: int = 21) -> pl.DataFrame:
+    """Merges per-shard code statistics computed by `compute_code_stats` into dataset-level statistics.
+
+    Means and variances are combined exactly with the parallel algorithm of Chan et al. Quantiles are
+    approximated by treating each shard's quantiles as equally weighted samples of its values and taking the
+    weighted quantiles of their union. Subjects are assumed not to be shared across shards.
+
+    Args:
+        stats_df: The concatenated per-shard statistics, typically a single scan over all shard outputs, with
+            an additional "shard" column identifying the shard of each row.
+        n_quantiles: The number of evenly spaced quantiles (including the min and max) kept per code.
+
+    Returns:
+        A DataFrame with one row per code and the columns "code", "n_occurrences", "n_subjects",
+        "subject_prevalence", "n_values", "mean", "var", "min", "max" and "quantiles".
+
+    Examples:
+        >>> shard_1 = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2], "code": ["A", "A", "B"], "numeric_value": [1.0, 3.0, None],
+        ... }).lazy()
+        >>> shard_2 = pl.DataFrame({
+        ...     "subject_id": [3, 3, 4], "code": ["A", "A", "A"], "numeric_value": [5.0, 7.0, 9.0],
+        ... }).lazy()
+        >>> stats = pl.concat([
+        ...     compute_code_stats(shard_1, 3).with_columns(shard=pl.lit("1")),
+        ...     compute_code_stats(shard_2, 3).with_columns(shard=pl.lit("2")),
+        ... ])
+        >>> merge_code_stats(stats.lazy(), 3)
+        shape: (2, 10)
+        ┌──────┬───────────────┬────────────┬───────────────────┬───┬──────┬──────┬──────┬─────────────────┐
+        │ code ┆ n_occurrences ┆ n_subjects ┆ subject_prevalenc ┆ … ┆ var  ┆ min  ┆ max  ┆ quantiles       │
+        │ ---  ┆ ---           ┆ ---        ┆ e                 ┆   ┆ ---  ┆ ---  ┆ ---  ┆ ---             │
+        │ str  ┆ i64           ┆ i64        ┆ ---               ┆   ┆ f64  ┆ f64  ┆ f64  ┆ list[f64]       │
+        │      ┆               ┆            ┆ f64               ┆   ┆      ┆      ┆      ┆                 │
+        ╞══════╪═══════════════╪════════════╪═══════════════════╪═══╪══════╪══════╪══════╪═════════════════╡
+        │ A    ┆ 5             ┆ 3          ┆ 0.75              ┆ … ┆ 8.0  ┆ 1.0  ┆ 9.0  ┆ [1.0, 5.0, 9.0] │
+        │ B    ┆ 1             ┆ 1          ┆ 0.25              ┆ … ┆ null ┆ null ┆ null ┆ null            │
+        └──────┴───────────────┴────────────┴───────────────────┴───┴──────┴──────┴──────┴─────────────────┘
+    """
+    stats_df = stats_df.with_columns(
+        pl.col("n_occurrences", "n_subjects", "n_values", "shard_n_subjects").cast(pl.Int64)
+    )
+    shard_n_subjects = stats_df.group_by("shard").agg(pl.col("shard_n_subjects").first())
+    n_subjects_total = shard_n_subjects.select(pl.sum("shard_n_subjects")).collect().item()
+
+    n_values = pl.col("n_values").sum()
+    mean = (pl.col("n_values") * pl.col("mean").fill_null(0)).sum() / n_values
+    m2 = (pl.col("m2").fill_null(0) + pl.col("n_values") * (pl.col("mean").fill_null(0) - mean) ** 2).sum()
+    moments = stats_df.group_by("code").agg(
+        pl.col("n_occurrences").sum(),
+        pl.col("n_subjects").sum(),
+        (pl.col("n_subjects").sum() / n_subjects_total).alias("subject_prevalence"),
+        n_values.alias("n_values"),
+        pl.when(n_values > 0).then(mean).alias("mean"),
+        pl.when(n_values > 0).then(m2 / n_values).alias("var"),
+        pl.col("min").min(),
+        pl.col("max").max(),
     )
-    code_freqs_df = ts_df.group_by("code").agg(pl.count("code").alias("count")).collect()
-    code_freqs = {row["code"] + "/code": row["count"] for row in code_freqs_df.iter_rows(named=True)}
 
-    value_df = ts_df.filter(pl.col("numeric_value").is_not_null())
-    value_freqs_df = value_df.group_by("code").agg(pl.count("numeric_value").alias("count")).collect()
-    value_freqs = {row["code"] + "/value": row["count"] for row in value_freqs_df.iter_rows(named=True)}
+    # Every shard quantile stands for an equal share of the shard's values. Each point is placed at its
+    # weighted rank, normalized so that with a single shard the points sit exactly at the target quantiles.
+    weight = pl.col("weight").sort_by("point")
+    rank = (weight.cum_sum() - weight / 2 - weight.first() / 2) / (
+        weight.sum() - weight.first() / 2 - weight.last() / 2
+    )
+    targets = pl.lit(pl.Series(np.linspace(0, 1, n_quantiles) - 1e-9))
+    quantiles = (
+        stats_df.filter(pl.col("n_values") > 0)
+        .select(
+            "code",
+            pl.col("quantiles").alias("point"),
+            (pl.col("n_values") / pl.col("quantiles").list.len()).alias("weight"),
+        )
+        .explode("point")
+        .group_by("code")
+        .agg(
+            pl.col("point")
+            .sort()
+            .gather(rank.fill_nan(0).search_sorted(targets).clip(upper_bound=pl.len() - 1))
+            .alias("quantiles")
+        )
+    )
 
-    combined_freqs = {**static_code_freqs, **static_value_freqs, **code_freqs, **value_freqs}
-    return convert_to_df(combined_freqs)
+    return moments.join(quantiles, on="code", how="left").sort("code").collect()
 
 
 def get_feature_columns(fp: Path) -> list[str]:
@@ -206,13 +377,84 @@ def clear_code_aggregation_suffix(code: str) -> str:
         raise ValueError(f"Code {code} does not have a recognized aggregation suffix!")
 
 
-def filter_parquet(fp: Path, allowed_codes: list[str]) -> pl.LazyFrame:
+class CodeFilter:
+    """The allowed codes of a tabularization, split by aggregation once so they can be applied to many shards.
+
+    `filter_parquet` and `filter_meds_df` accept an instance in place of the list of allowed codes, so scripts
+    filtering every shard of a cohort with the same codes parse the code list once per run rather than once
+    per shard.
+
+    Args:
+        allowed_codes: The allowed codes with their aggregation suffixes, i.e.,
+            ``cfg.tabularization._resolved_codes``.
+
+    Raises:
+        ValueError: If an allowed code does not have a recognized aggregation suffix.
+
+    Examples:
+        >>> code_filter = CodeFilter(["A/code", "A/value", "B/static/present", "C/static/first"])
+        >>> code_filter.code_codes, code_filter.value_codes
+        (['A'], ['A'])
+        >>> code_filter.static_present_codes, code_filter.static_first_codes
+        (['B'], ['C'])
+        >>> code_filter.codes
+        ['A', 'B', 'C']
+        >>> CodeFilter(["A"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Code A does not have a recognized aggregation suffix!
+    """
+
+    def __init__(self, allowed_codes: list[str]):
+        self.code_codes = []
+        self.value_codes = []
+        self.static_present_codes = []
+        self.static_first_codes = []
+        codes_by_suffix = {
+            "/code": self.code_codes,
+            "/value": self.value_codes,
+            "/static/present": self.static_present_codes,
+            "/static/first": self.static_first_codes,
+        }
+        for allowed_code in allowed_codes:
+            code = clear_code_aggregation_suffix(allowed_code)
+            codes_by_suffix[allowed_code[len(code) :]].append(code)
+        self.codes = sorted(
+            set(self.code_codes)
+            | set(self.value_codes)
+            | set(self.static_present_codes)
+            | set(self.static_first_codes)
+        )
+
+    def __call__(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        """Filters MEDS data to the allowed codes and values; see `filter_meds_df`."""
+        is_static_code = pl.col("time").is_null()
+        is_allowed_code = (
+            pl.when(is_static_code)
+            .then(pl.col("code").is_in(self.static_present_codes))
+            .otherwise(pl.col("code").is_in(self.code_codes))
+        )
+        is_allowed_value = (
+            pl.when(is_static_code)
+            .then(pl.col("code").is_in(self.static_first_codes))
+            .otherwise(pl.col("code").is_in(self.value_codes))
+        )
+        # The row filter comes first so it is pushed into the Parquet scan of `filter_parquet`
+        return df.filter(is_allowed_code).with_columns(
+            pl.when(is_allowed_value).then(pl.col("numeric_value")).alias("numeric_value")
+        )
+
+
+def filter_parquet(fp: Path, allowed_codes: list[str] | CodeFilter) -> pl.LazyFrame:
     """Loads and filters a Parquet file with Polars to include only specified codes and removes rare
     codes/values.
 
+    The filters are applied while the file is scanned, so the events of excluded codes are never
+    materialized in full.
+
     Args:
         fp: Path to the Parquet file of a Meds cohort shard.
-        allowed_codes: List of codes to filter by.
+        allowed_codes: List of codes to filter by, or a `CodeFilter` of them.
 
     Returns:
         pl.LazyFrame: A filtered LazyFrame containing only the allowed and not rare codes/values.
@@ -239,38 +481,37 @@ def filter_parquet(fp: Path, allowed_codes: list[str]) -> pl.LazyFrame:
         │ E    ┆ 2021-01-03 ┆ null          │
         │ E    ┆ 2021-01-04 ┆ 3             │
         └──────┴────────────┴───────────────┘
+        >>> code_filter = CodeFilter(["A/code", "D/static/present", "E/code", "E/value"])
+        >>> filter_parquet(fp.name, code_filter).collect().equals(
+        ...     filter_parquet(fp.name, ["A/code", "D/static/present", "E/code", "E/value"]).collect()
+        ... )
+        True
         >>> fp.close()
     """
-    df = pl.scan_parquet(fp)
-    # Drop values that are rare
-    # Drop Rare Static Codes
-    static_present_feature_columns = [
-        clear_code_aggregation_suffix(each) for each in get_feature_names("static/present", allowed_codes)
-    ]
-    static_first_feature_columns = [
-        clear_code_aggregation_suffix(each) for each in get_feature_names("static/first", allowed_codes)
-    ]
-    code_feature_columns = [
-        clear_code_aggregation_suffix(each) for each in get_feature_names("code/count", allowed_codes)
-    ]
-    value_feature_columns = [
-        clear_code_aggregation_suffix(each) for each in get_feature_names("value/sum", allowed_codes)
-    ]
-
-    is_static_code = pl.col("time").is_null()
-    is_numeric_code = pl.col("numeric_value").is_not_null()
-    rare_static_code = is_static_code & ~pl.col("code").is_in(static_present_feature_columns)
-    rare_ts_code = ~is_static_code & ~pl.col("code").is_in(code_feature_columns)
-    rare_ts_value = ~is_static_code & ~pl.col("code").is_in(value_feature_columns) & is_numeric_code
-    rare_static_value = is_static_code & ~pl.col("code").is_in(static_first_feature_columns) & is_numeric_code
-
-    # Remove rare numeric values by converting them to null
-    df = df.with_columns(
-        pl.when(rare_static_value | rare_ts_value)
-        .then(None)
-        .otherwise(pl.col("numeric_value"))
-        .alias("numeric_value")
-    )
-    # Drop rows with rare codes
-    df = df.filter(~(rare_static_code | rare_ts_code))
-    return df
+    return filter_meds_df(pl.scan_parquet(fp), allowed_codes)
+
+
+def filter_meds_df(df: pl.LazyFrame, allowed_codes: list[str] | CodeFilter) -> pl.LazyFrame:
+    """Filters MEDS data to include only specified codes and removes rare codes/values.
+
+    This is the filtering of `filter_parquet`, for data that is already loaded, e.g., the history of a single
+    subject at inference time.
+
+    Args:
+        df: The MEDS data, with columns code, time and numeric_value.
+        allowed_codes: List of codes to filter by, or a `CodeFilter` of them.
+
+    Returns:
+        pl.LazyFrame: A filtered LazyFrame containing only the allowed and not rare codes/values.
+
+    Examples:
+        >>> df = pl.LazyFrame({"code": ["A", "B", "C"], "time": ["2021-01-01", None, None]})
+        >>> df = df.with_columns(numeric_value=pl.lit(1.0))
+        >>> filter_meds_df(df, ["A/code", "B/static/present"]).collect()["numeric_value"].to_list()
+        [None, None]
+        >>> filter_meds_df(df, CodeFilter(["A/code", "A/value"])).collect()["numeric_value"].to_list()
+        [1.0]
+    """
+    if not isinstance(allowed_codes, CodeFilter):
+        allowed_codes = CodeFilter(allowed_codes)
+    return allowed_codes(df)
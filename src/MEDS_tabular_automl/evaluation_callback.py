@@ -47,6 +47,13 @@ class EvaluationCallback(Callback):
             f"Tuning AUC: {tuning_auc}",
             f"Test AUC: {test_auc}",
         ]
+        if "tuning_auprc" in best_model_performance.columns:
+            log_performance_message.extend(
+                [
+                    f"Tuning AUPRC: {best_model_performance['tuning_auprc'][0]}",
+                    f"Test AUPRC: {best_model_performance['test_auprc'][0]}",
+                ]
+            )
         logger.info("\n".join(log_performance_message))
 
     def delete_below_top_k_models(self, performance, k, sweep_results_dir):
@@ -0,0 +1,340 @@
+"""Tabularizes the history of a few subjects in memory, e.g., to score patients at request time.
+
+The batch pipeline tabularizes whole shards and stores one matrix per window size and aggregation on disk;
+`FeatureBuilder` computes the same feature rows for a handful of prediction times directly from an in-memory
+MEDS frame, so that deployed models can score subjects without a batch run.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+import polars as pl
+from scipy.sparse import csr_array
+
+from .describe_codes import CodeFilter, filter_meds_df, get_feature_columns
+from .generate_static_features import summarize_static_measurements
+from .generate_summarized_reps import aggregate_groups, get_event_window_indices
+from .generate_ts_features import get_long_code_df, get_long_value_df
+from .utils import (
+    CODE_AGGREGATIONS,
+    STATIC_CODE_AGGREGATION,
+    STATIC_VALUE_AGGREGATION,
+    VALUE_AGGREGATIONS,
+    get_events_df,
+    get_feature_names,
+    get_resolved_code_set,
+)
+
+
+def match_prediction_events(
+    group_df: pl.DataFrame, subject_ids: np.ndarray, prediction_times: np.ndarray
+) -> np.ndarray:
+    """Matches each prediction time to the last event of the subject at or before it.
+
+    This is the matching of `get_label_events_df`, for the unique events of a few subjects.
+
+    Args:
+        group_df: The unique events, with columns 'subject_id' and 'time', sorted by subject and time.
+        subject_ids: The subject of each prediction.
+        prediction_times: The time of each prediction.
+
+    Returns:
+        The row in ``group_df`` of the matched event of each prediction, or -1 if the subject has no event at
+        or before the prediction time.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> group_df = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "time": [datetime(2020, 1, 1), datetime(2020, 1, 5), datetime(2020, 1, 3)],
+        ... })
+        >>> match_prediction_events(
+        ...     group_df,
+        ...     np.array([2, 1, 1, 3]),
+        ...     np.array(["2020-01-04", "2020-01-04", "2019-12-31", "2020-01-04"], dtype="datetime64[us]"),
+        ... )
+        array([ 2,  0, -1, -1])
+    """
+    subjects = group_df["subject_id"].to_numpy()
+    times = group_df["time"].to_numpy()
+    event_ids = np.full(len(subject_ids), -1, dtype=np.int64)
+    starts = np.searchsorted(subjects, subject_ids, side="left")
+    ends = np.searchsorted(subjects, subject_ids, side="right")
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if start < end:
+            event_ids[i] = start + np.searchsorted(times[start:end], prediction_times[i], side="right") - 1
+            if event_ids[i] < start:
+                event_ids[i] = -1
+    return event_ids
+
+
+def expand_rows(matrix: csr_array, rows: np.ndarray, num_rows: int) -> csr_array:
+    """Places the rows of a matrix at the given rows of a larger, otherwise empty matrix.
+
+    Examples:
+        >>> expand_rows(csr_array(np.array([[1, 0], [0, 2]])), np.array([2, 0]), 3).toarray()
+        array([[0, 2],
+               [0, 0],
+               [1, 0]])
+    """
+    coo = matrix.tocoo()
+    return csr_array((coo.data, (rows[coo.row], coo.col)), shape=(num_rows, matrix.shape[1]))
+
+
+class FeatureBuilder:
+    """Builds the feature rows of a `TabularDataset` for prediction times of in-memory MEDS data.
+
+    Rows are built exactly like the task-specific cache of the batch pipeline: the data is filtered to the
+    allowed codes like `filter_parquet`, each prediction time is matched to the last event at or before it
+    like `get_label_events_df`, the time-series features are aggregated over the windows ending at that
+    event like `generate_summary_at_events`, and the static features are summarized per subject with
+    `summarize_static_measurements`. The blocks of each window size and aggregation are concatenated in the
+    order of `get_model_files`, filtered by the code masks and imputed and scaled like
+    `TabularDataset.get_data`.
+
+    Only the windows ending at the requested events are aggregated and the rows of events sharing a time are
+    merged in a single vectorized pass, so the cost scales with the history of the requested subjects; for
+    a single subject this takes milliseconds.
+
+    Args:
+        feature_columns: All feature columns, as returned by `get_feature_columns` for the code metadata the
+            model was trained with.
+        window_sizes: The window sizes of the time-series aggregations.
+        aggs: The aggregations.
+        allowed_codes: The codes the data is filtered to, i.e., ``cfg.tabularization._resolved_codes``.
+            Defaults to all feature columns.
+        code_masks: The mask of the included features of each aggregation, i.e., `TabularDataset.code_masks`.
+            Defaults to including all features.
+        imputer: The fitted imputer applied to the feature rows, if any.
+        scaler: The fitted normalizer applied to the feature rows, if any.
+
+    Raises:
+        ValueError: If an aggregation is not supported or a code mask does not match its features.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> meds_df = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 1, 1, 2],
+        ...     "time": [None, datetime(2020, 1, 1), datetime(2020, 1, 1), datetime(2020, 1, 3),
+        ...              datetime(2020, 1, 9), datetime(2020, 1, 2)],
+        ...     "code": ["S", "A", "B", "A", "B", "A"],
+        ...     "numeric_value": [None, None, 1.0, None, 2.0, None],
+        ... })
+        >>> builder = FeatureBuilder(
+        ...     ["A/code", "B/code", "B/value", "S/static/present"],
+        ...     window_sizes=["7d", "full"],
+        ...     aggs=["code/count", "static/present"],
+        ... )
+        >>> builder.get_column_names() # doctest: +NORMALIZE_WHITESPACE
+        ['A/code/count/7d', 'B/code/count/7d', 'A/code/count/full', 'B/code/count/full',
+         'S/static/present/present/none']
+        >>> prediction_times = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2, 2],
+        ...     "prediction_time": [datetime(2020, 1, 9), datetime(2020, 1, 4), datetime(2020, 1, 5),
+        ...                         datetime(2020, 1, 1)],
+        ... })
+        >>> builder.transform(meds_df, prediction_times).toarray()
+        array([[1, 1, 2, 2, 1],
+               [2, 1, 2, 1, 1],
+               [1, 0, 1, 0, 0],
+               [0, 0, 0, 0, 0]])
+        >>> builder = FeatureBuilder(
+        ...     ["A/code", "B/code", "B/value", "S/static/present"],
+        ...     window_sizes=["7d", "full"],
+        ...     aggs=["code/count", "static/present"],
+        ...     code_masks={"code/count": [False, True], "static/present": [True]},
+        ... )
+        >>> builder.get_column_names()
+        ['B/code/count/7d', 'B/code/count/full', 'S/static/present/present/none']
+        >>> builder.transform(meds_df, prediction_times[:1]).toarray()
+        array([[1, 2, 1]])
+        >>> FeatureBuilder(["A/code"], ["7d"], ["code/count"], code_masks={"code/count": []})
+        Traceback (most recent call last):
+            ...
+        ValueError: The code mask of code/count has 0 entries but there are 1 features.
+        >>> FeatureBuilder(["A/code"], window_sizes=["7d"], aggs=["code/mean"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown aggregation type code/mean
+    """
+
+    def __init__(
+        self,
+        feature_columns: list[str],
+        window_sizes: list[str],
+        aggs: list[str],
+        allowed_codes: list[str] | None = None,
+        code_masks: Mapping[str, list[bool]] | None = None,
+        imputer=None,
+        scaler=None,
+    ):
+        self.feature_columns = list(feature_columns)
+        self.allowed_codes = list(feature_columns if allowed_codes is None else allowed_codes)
+        self.code_filter = CodeFilter(self.allowed_codes)
+        self.imputer = imputer
+        self.scaler = scaler
+
+        aggs = list(dict.fromkeys(aggs))
+        self.feature_names = {agg: get_feature_names(agg, self.feature_columns) for agg in aggs}
+        self.code_masks = {}
+        for agg in aggs:
+            mask = np.ones(len(self.feature_names[agg]), dtype=bool)
+            if code_masks is not None:
+                mask = np.asarray(code_masks[agg], dtype=bool)
+                if len(mask) != len(self.feature_names[agg]):
+                    raise ValueError(
+                        f"The code mask of {agg} has {len(mask)} entries but there are "
+                        f"{len(self.feature_names[agg])} features."
+                    )
+            self.code_masks[agg] = mask
+
+        # The (window size, aggregation) blocks, in the order of the files returned by `get_model_files`
+        self.static_aggs = [agg for agg in aggs if agg in [STATIC_CODE_AGGREGATION, STATIC_VALUE_AGGREGATION]]
+        self.ts_aggs = [agg for agg in aggs if agg not in self.static_aggs]
+        self.window_sizes = list(dict.fromkeys(window_sizes))
+        blocks = [(window_size, agg) for window_size in self.window_sizes for agg in self.ts_aggs]
+        blocks += [("none", agg) for agg in self.static_aggs]
+        self.blocks = sorted(blocks, key=lambda block: (block[0], *block[1].split("/")))
+
+        # The output column of each feature of each block, or -1 if the feature is excluded by the code masks
+        self.block_offsets = {}
+        num_columns = 0
+        for block in self.blocks:
+            self.block_offsets[block] = num_columns
+            num_columns += int(self.code_masks[block[1]].sum())
+        self.num_columns = num_columns
+        self.column_index = {
+            agg: np.where(mask, np.cumsum(mask) - 1, -1) for agg, mask in self.code_masks.items()
+        }
+
+    @classmethod
+    def from_dataset(cls, dataset) -> "FeatureBuilder":
+        """Creates a builder for the features of a `TabularDataset`, with its code masks and preprocessing.
+
+        Args:
+            dataset: The dataset the model was trained on.
+
+        Returns:
+            A builder of the feature rows of the dataset.
+        """
+        tabularization = dataset.cfg.tabularization
+        return cls(
+            get_feature_columns(tabularization.filtered_code_metadata_fp),
+            list(tabularization.window_sizes),
+            list(tabularization.aggs),
+            allowed_codes=sorted(get_resolved_code_set(tabularization)),
+            code_masks=dataset.code_masks,
+            imputer=dataset.imputer,
+            scaler=dataset.scaler,
+        )
+
+    def get_column_names(self) -> list[str]:
+        """Returns the names of the columns of the feature rows.
+
+        These are the columns of `TabularDataset.get_column_names`, restricted to the included features.
+        """
+        return [
+            f"{name}/{agg.split('/')[-1]}/{window_size}"
+            for window_size, agg in self.blocks
+            for name, included in zip(self.feature_names[agg], self.code_masks[agg])
+            if included
+        ]
+
+    def transform(self, meds_df: pl.DataFrame, prediction_times: pl.DataFrame) -> csr_array:
+        """Builds the feature rows of the given prediction times.
+
+        Args:
+            meds_df: The MEDS data of the subjects, with columns subject_id, time, code and numeric_value. It
+                must hold the complete history of each subject, but need not be sorted.
+            prediction_times: The prediction times, with columns subject_id and prediction_time.
+
+        Returns:
+            The feature rows, one per prediction time, in the order of `get_column_names`. Prediction times
+            before the first event of their subject only have static features.
+        """
+        df = (
+            filter_meds_df(meds_df.lazy(), self.code_filter)
+            .sort("subject_id", "time", maintain_order=True)
+            .collect()
+        )
+        num_rows = len(prediction_times)
+        data, rows, cols = [], [], []
+
+        def add_entries(matrix: csr_array, agg: str, row_ids: np.ndarray, row_offsets: np.ndarray):
+            """Adds the included features of each row of a matrix to output row ``row_ids`` of the features,
+            starting at column ``row_offsets``."""
+            coo = matrix.tocoo()
+            block_cols = self.column_index[agg][coo.col]
+            included = block_cols >= 0
+            data.append(coo.data[included])
+            rows.append(row_ids[coo.row[included]])
+            cols.append(row_offsets[coo.row[included]] + block_cols[included])
+
+        for agg in self.static_aggs:
+            static_df = summarize_static_measurements(agg, self.feature_names[agg], df.lazy())
+            static_rows = (
+                prediction_times.select("subject_id")
+                .join(static_df, on="subject_id", how="left", maintain_order="left")
+                .drop("subject_id")
+                .fill_null(False)
+            )
+            offsets = np.full(num_rows, self.block_offsets[("none", agg)])
+            add_entries(csr_array(static_rows.to_numpy().astype(bool)), agg, np.arange(num_rows), offsets)
+
+        events_df = get_events_df(df.lazy(), self.feature_columns).collect()
+        subjects = events_df["subject_id"].to_numpy()
+        times = events_df["time"].to_numpy()
+        is_new_group = np.r_[True, (subjects[1:] != subjects[:-1]) | (times[1:] != times[:-1])]
+        group_starts = np.flatnonzero(is_new_group)
+        group_sizes = np.diff(np.r_[group_starts, len(events_df)])
+        group_df = pl.DataFrame({"subject_id": subjects[group_starts], "time": times[group_starts]})
+
+        event_ids = match_prediction_events(
+            group_df,
+            prediction_times["subject_id"].to_numpy(),
+            prediction_times["prediction_time"].to_numpy(),
+        )
+        matched_rows = np.flatnonzero(event_ids >= 0)
+        if len(matched_rows) and self.ts_aggs:
+            # Aggregate the windows of all window sizes at once, from the rows of the events in each window
+            windows = pl.concat(
+                [
+                    get_event_window_indices(group_df, event_ids[matched_rows], window_size)
+                    for window_size in self.window_sizes
+                ]
+            )
+            window_starts = windows["min_index"].to_numpy().astype(np.int64)
+            window_sizes = windows["max_index"].to_numpy().astype(np.int64) - window_starts + 1
+            window_rows = np.repeat(window_starts - np.cumsum(window_sizes) + window_sizes, window_sizes)
+            window_rows += np.arange(window_sizes.sum())
+
+            event_matrices = {}
+            for agg in self.ts_aggs:
+                code_type = "code" if agg in CODE_AGGREGATIONS else "value"
+                if code_type not in event_matrices:
+                    # the event-level matrices of `summarize_dynamic_measurements`
+                    if agg in CODE_AGGREGATIONS:
+                        code_df = events_df.lazy().drop("subject_id", "time", "numeric_value")
+                        long_df = get_long_code_df(code_df, self.feature_names[agg])
+                    elif agg in VALUE_AGGREGATIONS:
+                        value_df = events_df.lazy().drop("subject_id", "time")
+                        long_df = get_long_value_df(value_df, self.feature_names[agg])
+                    shape = (len(events_df), len(self.feature_names[agg]))
+                    event_matrices[code_type] = csr_array(long_df, shape=shape)
+
+                # Merge the events sharing a time first, as `generate_summary_at_events` does
+                summary = aggregate_groups(group_sizes, event_matrices[code_type], agg)
+                summary = aggregate_groups(window_sizes, summary[window_rows], agg)
+                offsets = [self.block_offsets[(window_size, agg)] for window_size in self.window_sizes]
+                row_ids = np.tile(matched_rows, len(offsets))
+                add_entries(summary, agg, row_ids, np.repeat(offsets, len(matched_rows)))
+
+        if data:
+            data = np.concatenate(data)
+            rows, cols = np.concatenate(rows), np.concatenate(cols)
+        features = csr_array((data, (rows, cols)), shape=(num_rows, self.num_columns))
+        if self.imputer is not None:
+            features = self.imputer.transform(features)
+        if self.scaler is not None:
+            features = self.scaler.transform(features)
+        return features
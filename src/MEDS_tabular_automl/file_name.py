@@ -13,7 +13,8 @@ def list_subdir_files(root: Path | str, ext: str) -> list[Path]:
 
     Returns:
         An alphabetically sorted list of Path objects to files matching the extension in any level of
-        subdirectories of the given directory.
+        subdirectories of the given directory. Hidden files and directories, such as the cache directories
+        holding the in-progress outputs of `mapper.wrap`, are skipped.
 
     Examples:
         >>> import tempfile
@@ -32,6 +33,8 @@ def list_subdir_files(root: Path | str, ext: str) -> list[Path]:
         >>> (root / "subdir_2" / "4.csv").touch()
         >>> (root / "subdir_1" / "A" / "5.csv").touch()
         >>> (root / "subdir_1" / "A" / "15.csv.gz").touch()
+        >>> (root / "subdir_2" / ".6_cache").mkdir()
+        >>> (root / "subdir_2" / ".6_cache" / "tmp.6.csv").touch()
         >>> [fp.relative_to(root) for fp in list_subdir_files(root, "csv")] # doctest: +NORMALIZE_WHITESPACE
         [PosixPath('1.csv'),
          PosixPath('2.csv'),
@@ -49,7 +52,12 @@ def list_subdir_files(root: Path | str, ext: str) -> list[Path]:
         >>> tmpdir.cleanup()
     """
 
-    return sorted(list(Path(root).glob(f"**/*.{ext}")))
+    root = Path(root)
+    return sorted(
+        fp
+        for fp in root.glob(f"**/*.{ext}")
+        if not any(part.startswith(".") for part in fp.relative_to(root).parts)
+    )
 
 
 def get_model_files(cfg: DictConfig, split: str, shard: str) -> list[Path]:
@@ -77,6 +77,13 @@ def get_sparse_static_rep(
         raise ValueError("static_df has duplicate subject_id values.")
 
     meds_df = get_unique_time_events_df(get_events_df(meds_df, feature_columns))
+    # One row per subject with events, in order, even for subjects without any static measurements
+    static_df = (
+        meds_df.select("subject_id")
+        .unique()
+        .sort(by="subject_id")
+        .join(static_df, on="subject_id", how="left")
+    )
 
     # load static data as sparse matrix
     static_matrix = convert_to_matrix(
@@ -124,14 +131,14 @@ def summarize_static_measurements(
         static_value_pivot_df = first_code_subset.pivot(
             index=["subject_id"], columns=["code"], values=["numeric_value"], aggregate_function=None
         )
-        # rename code to feature name
-        remap_cols = {
-            input_name: output_name
-            for input_name, output_name in zip(static_first_codes, static_features)
-            if input_name in static_value_pivot_df.columns
-        }
+        # rename code to feature name; codes absent from the shard are kept as null columns so that the
+        # columns always align with the static features
         static_value_pivot_df = static_value_pivot_df.select(
-            *["subject_id"], *[pl.col(k).alias(v).cast(pl.Boolean) for k, v in remap_cols.items()]
+            *["subject_id"],
+            *[
+                (pl.col(k) if k in static_value_pivot_df.columns else pl.lit(None)).alias(v).cast(pl.Boolean)
+                for k, v in zip(static_first_codes, static_features)
+            ],
         ).sort(by="subject_id")
         # pivot can be faster: https://stackoverflow.com/questions/73522017/replacing-a-pivot-with-a-lazy-groupby-operation # noqa: E501
         # TODO: consider casting with .cast(pl.Float32))
@@ -153,14 +160,15 @@ def summarize_static_measurements(
             )
             .sort(by="subject_id")
         )
-        remap_cols = {
-            input_name: output_name
-            for input_name, output_name in zip(static_present_codes, static_features)
-            if input_name in static_present_pivot_df.columns
-        }
-        # rename columns to final feature names
+        # rename columns to final feature names, keeping codes absent from the shard as null columns
         static_present_pivot_df = static_present_pivot_df.select(
-            *["subject_id"], *[pl.col(k).alias(v).cast(pl.Boolean) for k, v in remap_cols.items()]
+            *["subject_id"],
+            *[
+                (pl.col(k) if k in static_present_pivot_df.columns else pl.lit(None))
+                .alias(v)
+                .cast(pl.Boolean)
+                for k, v in zip(static_present_codes, static_features)
+            ],
         )
         return static_present_pivot_df
     else:
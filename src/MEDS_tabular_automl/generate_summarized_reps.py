@@ -43,6 +43,20 @@ def sparse_aggregate(sparse_matrix: sparray, agg: str) -> np.ndarray | coo_array
     return merged_matrix
 
 
+def get_window_timedelta(window_size: str) -> pd.Timedelta:
+    """Returns the length of a rolling window, using 150 years for the "full" history.
+
+    Examples:
+        >>> get_window_timedelta("7d")
+        Timedelta('7 days 00:00:00')
+        >>> get_window_timedelta("full")
+        Timedelta('54600 days 00:00:00')
+    """
+    if window_size == "full":
+        return pd.Timedelta(150 * 52, unit="W")  # just use 150 years as time delta
+    return pd.Timedelta(window_size.replace("d", "D"))  # pandas deprecated the lowercase day unit
+
+
 def get_rolling_window_indicies(index_df: pl.LazyFrame, window_size: str) -> pl.LazyFrame:
     """Computes the start and end indices for rolling window operations on a LazyFrame.
 
@@ -53,19 +67,62 @@ def get_rolling_window_indicies(index_df: pl.LazyFrame, window_size: str) -> pl.
     Returns:
         A LazyFrame with columns 'min_index' and 'max_index' representing the range of each window.
     """
-    if window_size == "full":
-        timedelta = pd.Timedelta(150 * 52, unit="W")  # just use 150 years as time delta
-    else:
-        timedelta = pd.Timedelta(window_size)
     return (
         index_df.with_row_index("index")
-        .rolling(index_column="time", period=timedelta, group_by="subject_id")
+        .rolling(index_column="time", period=get_window_timedelta(window_size), group_by="subject_id")
         .agg([pl.col("index").min().alias("min_index"), pl.col("index").max().alias("max_index")])
         .select(pl.col("min_index", "max_index"))
         .collect()
     )
 
 
+def get_event_window_indices(event_df: pl.DataFrame, event_ids: np.ndarray, window_size: str) -> pl.DataFrame:
+    """Computes the rolling windows ending at a subset of events, e.g., the events matched to task labels.
+
+    Each window covers the events of the same subject within ``window_size`` before (and including) the
+    event, exactly like `get_rolling_window_indicies`, but the start of each window is found by a binary
+    search into the subject's event history, so the cost only scales with the number of requested events.
+
+    Args:
+        event_df: The unique events, with columns 'subject_id' and 'time', sorted by subject and time.
+        event_ids: The row indices in ``event_df`` of the events at which windows end.
+        window_size: The size of the window as a string denoting time, e.g., '7d' for 7 days.
+
+    Returns:
+        A DataFrame with columns 'min_index' and 'max_index', with one row per requested event.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> event_df = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2],
+        ...     "time": [datetime(2020, 1, d) for d in [1, 2, 5]] + [datetime(2020, 1, d) for d in [1, 3]],
+        ... })
+        >>> windows = get_rolling_window_indicies(event_df.lazy(), "2d")
+        >>> windows.to_dicts() == get_event_window_indices(event_df, np.arange(5), "2d").to_dicts()
+        True
+        >>> get_event_window_indices(event_df, np.array([4, 1]), "full").rows()
+        [(3, 4), (0, 1)]
+    """
+    subjects = event_df["subject_id"].to_numpy()
+    times = event_df["time"].to_numpy()
+    starts = np.r_[0, np.flatnonzero(subjects[1:] != subjects[:-1]) + 1]
+    ends = np.r_[starts[1:], len(subjects)]
+    event_ids = np.asarray(event_ids, dtype=np.int64)
+    if not len(event_ids):
+        return pl.DataFrame(schema={"min_index": pl.UInt32, "max_index": pl.UInt32})
+    event_subjects = np.searchsorted(starts, event_ids, side="right") - 1
+
+    window_starts = times[event_ids] - get_window_timedelta(window_size).to_timedelta64()
+    min_index = np.empty_like(event_ids)
+    order = np.argsort(event_subjects, kind="stable")
+    subject_bounds = np.r_[0, np.flatnonzero(np.diff(event_subjects[order])) + 1, len(order)]
+    for lo, hi in zip(subject_bounds[:-1], subject_bounds[1:]):
+        idxs = order[lo:hi]
+        start, end = starts[event_subjects[idxs[0]]], ends[event_subjects[idxs[0]]]
+        min_index[idxs] = start + np.searchsorted(times[start:end], window_starts[idxs], side="right")
+    return pl.DataFrame({"min_index": min_index, "max_index": event_ids}).cast(pl.UInt32)
+
+
 def aggregate_matrix(
     windows: pl.LazyFrame, matrix: sparray, agg: str, num_features: int, use_tqdm: bool = False
 ) -> csr_array:
@@ -83,6 +140,23 @@ def aggregate_matrix(
 
     Raises:
         TypeError: If the type of the aggregated matrix is not compatible for further operations.
+
+    Examples:
+        >>> matrix = csr_array(np.array([[1, 0], [3, 2], [0, 5]]))
+        >>> windows = pl.DataFrame({"min_index": [0, 0, 1], "max_index": [0, 1, 2]})
+        >>> aggregate_matrix(windows, matrix, "value/sum", 2).toarray()
+        array([[1, 0],
+               [4, 2],
+               [3, 7]])
+        >>> # The min and max of each window are written to the row of that window
+        >>> aggregate_matrix(windows, matrix, "value/max", 2).toarray()
+        array([[1, 0],
+               [3, 2],
+               [3, 5]])
+        >>> aggregate_matrix(windows, matrix, "value/min", 2).toarray()
+        array([[1, 0],
+               [1, 0],
+               [0, 2]])
     """
     tqdm = load_tqdm(use_tqdm)
     agg = agg.split("/")[-1]
@@ -105,7 +179,8 @@ def aggregate_matrix(
         elif isinstance(agg_matrix, coo_array):
             col.append(agg_matrix.col)
             data.append(agg_matrix.data)
-            row.append(agg_matrix.row)
+            # The aggregate of a window is a single row, which is row i of the output
+            row.append(np.repeat(np.array(i, dtype=np.int32), len(agg_matrix.col)))
         else:
             raise TypeError(f"Invalid matrix type {type(agg_matrix)}")
     row = np.concatenate(row)
@@ -122,6 +197,88 @@ def aggregate_matrix(
     return out_matrix
 
 
+def aggregate_groups(group_sizes: np.ndarray, matrix: sparray, agg: str) -> csr_array:
+    """Aggregates consecutive, non-overlapping groups of rows of a matrix in a single vectorized pass.
+
+    This yields the same matrix as `aggregate_matrix` with one window per group, including the semantics of
+    the sparse aggregations (``min`` and ``max`` include the implicit zeros of rows without a stored entry and
+    ``count`` counts the stored entries), but without slicing the matrix once per window. It is used to merge
+    the rows of events sharing the same time when only a few subjects are tabularized.
+
+    Args:
+        group_sizes: The number of consecutive rows of each group, summing to the number of matrix rows.
+        matrix: The matrix to aggregate.
+        agg: The aggregation method to apply.
+
+    Returns:
+        Aggregated sparse matrix, with one row per group.
+
+    Raises:
+        ValueError: If the aggregation method is not implemented or the group sizes do not match the matrix.
+
+    Examples:
+        >>> rng = np.random.default_rng(0)
+        >>> matrix = csr_array(rng.random((40, 5)).astype(np.float32) * (rng.random((40, 5)) < 0.4))
+        >>> group_sizes = rng.integers(1, 5, 20)
+        >>> group_sizes = group_sizes[np.cumsum(group_sizes) <= 40]
+        >>> group_sizes[-1] += 40 - group_sizes.sum()
+        >>> ends = np.cumsum(group_sizes) - 1
+        >>> windows = pl.DataFrame({"min_index": ends - group_sizes + 1, "max_index": ends})
+        >>> for agg in ["value/count", "value/sum", "value/sum_sqd", "value/min", "value/max"]:
+        ...     expected = aggregate_matrix(windows, matrix, agg, 5)
+        ...     assert (aggregate_groups(group_sizes, matrix, agg) != expected).nnz == 0, agg
+        >>> aggregate_groups(np.array([1, 2]), csr_array(np.array([[0, 1], [1, 0], [2, 3]])), "max").toarray()
+        array([[0, 1],
+               [2, 3]])
+        >>> aggregate_groups(np.array([1, 2]), csr_array(np.array([[0, 1], [1, 0], [2, 3]])), "min").toarray()
+        array([[0, 1],
+               [1, 0]])
+        >>> aggregate_groups(np.array([2]), csr_array(np.array([[0, 1], [1, 0], [2, 3]])), "min")
+        Traceback (most recent call last):
+            ...
+        ValueError: The groups cover 2 rows but the matrix has 3 rows.
+    """
+    agg = agg.split("/")[-1]
+    group_sizes = np.asarray(group_sizes, dtype=np.int64)
+    n_rows, num_features = matrix.shape
+    if group_sizes.sum() != n_rows:
+        raise ValueError(f"The groups cover {group_sizes.sum()} rows but the matrix has {n_rows} rows.")
+
+    # CSR entries (including explicit zeros) are ordered by row, so sums accumulate in row order
+    if not isinstance(matrix, csr_array):
+        matrix = csr_array(matrix)
+    if not matrix.nnz:
+        return csr_array((len(group_sizes), num_features), dtype=matrix.dtype)
+    groups = np.repeat(np.arange(len(group_sizes)), group_sizes)
+    entry_groups = np.repeat(groups, np.diff(matrix.indptr))
+    keys, inverse, counts = np.unique(
+        entry_groups.astype(np.int64) * num_features + matrix.indices, return_inverse=True, return_counts=True
+    )
+    if agg == "count":
+        values = counts
+    elif agg in ("sum", "sum_sqd"):
+        data = matrix.data**2 if agg == "sum_sqd" else matrix.data
+        values = np.zeros(len(keys), dtype=matrix.dtype)
+        np.add.at(values, inverse, data.astype(matrix.dtype, copy=False))
+    elif agg in ("min", "max"):
+        ufunc = np.minimum if agg == "min" else np.maximum
+        values = matrix.data[np.unique(inverse, return_index=True)[1]]
+        ufunc.at(values, inverse, matrix.data)
+        # Groups with rows without a stored entry also aggregate the implicit zeros of these rows
+        has_implicit_zeros = counts < group_sizes[keys // num_features]
+        values[has_implicit_zeros] = ufunc(values[has_implicit_zeros], 0)
+    else:
+        raise ValueError(f"Aggregation method '{agg}' not implemented.")
+
+    nonzero = values != 0
+    data, row, col = values[nonzero], keys[nonzero] // num_features, keys[nonzero] % num_features
+    if len(data):
+        row = row.astype(get_min_dtype(row), copy=False)
+        col = col.astype(get_min_dtype(col), copy=False)
+        data = data.astype(get_min_dtype(data), copy=False)
+    return csr_array((data, (row, col)), shape=(len(group_sizes), num_features))
+
+
 def compute_agg(
     index_df: pl.LazyFrame,
     matrix: sparray,
@@ -209,3 +366,74 @@ def generate_summary(
 
     out_matrix = compute_agg(index_df, matrix, window_size, agg, len(ts_columns), use_tqdm=use_tqdm)
     return out_matrix
+
+
+def generate_summary_at_events(
+    feature_columns: list[str],
+    index_df: pl.LazyFrame,
+    matrix: sparray,
+    window_size: str,
+    agg: str,
+    event_ids: np.ndarray,
+    use_tqdm: bool = False,
+) -> csr_array:
+    """Generates the summary of `generate_summary` only for the rows of the given unique events.
+
+    This yields the rows ``event_ids`` of the output of `generate_summary`, but only aggregates the windows
+    ending at these events (see `get_event_window_indices`), e.g., at the prediction times of a task.
+
+    Args:
+        feature_columns: A list of all feature columns that must exist in the final output.
+        index_df: The DataFrame with index and grouping information.
+        matrix: The sparse matrix containing the data to aggregate.
+        window_size: The size of the rolling window used for summary.
+        agg: The aggregation function to apply.
+        event_ids: The indices of the unique (subject_id, time) events whose rows are computed.
+        use_tqdm: The flag to enable or disable progress display.
+
+    Returns:
+        The summary of the requested events as a sparse matrix, with one row per event id.
+
+    Raises:
+        ValueError: If the aggregation type is not supported.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> index_df = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 1, 1, 2, 2],
+        ...     "time": [datetime(2020, 1, d) for d in [1, 1, 2, 5]] + [datetime(2020, 1, d) for d in [1, 3]],
+        ... })
+        >>> matrix = csr_array(np.array([[1, 0], [1, 1], [0, 1], [1, 0], [0, 1], [1, 1]]))
+        >>> feature_columns = ["A/code", "B/code"]
+        >>> summary = generate_summary(feature_columns, index_df, matrix, "2d", "code/count")
+        >>> summary.toarray()[[3, 1]]
+        array([[0, 1],
+               [1, 2]])
+        >>> generate_summary_at_events(
+        ...     feature_columns, index_df, matrix, "2d", "code/count", np.array([3, 1])
+        ... ).toarray()
+        array([[0, 1],
+               [1, 2]])
+    """
+    if agg not in CODE_AGGREGATIONS + VALUE_AGGREGATIONS:
+        raise ValueError(
+            f"Invalid aggregation: {agg}. Valid options are: {CODE_AGGREGATIONS + VALUE_AGGREGATIONS}"
+        )
+    ts_columns = get_feature_names(agg, feature_columns)
+    logger.info(
+        f"Generating aggregation {agg} for window_size {window_size} at {len(event_ids)} events, "
+        f"with {len(ts_columns)} columns."
+    )
+    group_df = (
+        index_df.with_row_index("index")
+        .group_by(["subject_id", "time"], maintain_order=True)
+        .agg([pl.col("index").min().alias("min_index"), pl.col("index").max().alias("max_index")])
+        .collect()
+    )
+    matrix = aggregate_matrix(
+        group_df.select("min_index", "max_index"), matrix, agg, len(ts_columns), use_tqdm
+    )
+    windows = get_event_window_indices(group_df.select("subject_id", "time"), event_ids, window_size)
+    if not len(windows):
+        return csr_array((0, len(ts_columns)), dtype=matrix.dtype)
+    return aggregate_matrix(windows, matrix, agg, len(ts_columns), use_tqdm)
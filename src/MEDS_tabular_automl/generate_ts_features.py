@@ -35,6 +35,43 @@ def feature_name_to_code(feature_name: str) -> str:
     return "/".join(feature_name.split("/")[:-1])
 
 
+def get_code_index_expr(ts_columns: list[str], strict: bool = True) -> pl.Expr:
+    """Returns an expression mapping the codes of events to the indices of their time-series columns.
+
+    The codes are cast to an enum of the codes of ``ts_columns``, so the mapping runs in polars' streaming
+    engine and only the integer indices, rather than the code strings, are materialized.
+
+    Args:
+        ts_columns: The time-series feature columns.
+        strict: Whether codes without a column raise an error. Otherwise, their index is null.
+
+    Examples:
+        >>> df = pl.LazyFrame({"code": ["B", "A", "C"]})
+        >>> code_index = get_code_index_expr(["A/code", "B/code"], strict=False)
+        >>> df.select(code_index).collect()["code_index"].to_list()
+        [1, 0, None]
+        >>> df.select(get_code_index_expr(["A/code", "B/code"])).collect()
+        Traceback (most recent call last):
+            ...
+        polars.exceptions.InvalidOperationError: conversion from `str` to `enum` failed in column 'code'...
+    """
+    codes = pl.Enum([feature_name_to_code(col) for col in ts_columns])
+    return pl.col("code").cast(pl.String).cast(codes, strict=strict).to_physical().alias("code_index")
+
+
+def collect_streaming(df: pl.LazyFrame) -> pl.DataFrame:
+    """Collects a LazyFrame with polars' streaming engine, which processes the scanned data in batches.
+
+    Filters and projections of a shard scan are then applied batch by batch, so peak memory is bounded by the
+    projected result rather than by the full shard.
+
+    Examples:
+        >>> collect_streaming(pl.LazyFrame({"a": [1, 2, 3]}).filter(pl.col("a") > 1))["a"].to_list()
+        [2, 3]
+    """
+    return df.collect(streaming=True)
+
+
 def get_long_code_df(
     df: pl.LazyFrame, ts_columns: list[str]
 ) -> tuple[np.ndarray, tuple[np.ndarray, np.ndarray]]:
@@ -47,19 +84,16 @@ def get_long_code_df(
     Returns:
         A tuple containing the data (1s for presence), and a tuple of row and column indices for
         the CSR sparse matrix.
+
+    Examples:
+        >>> df = pl.LazyFrame({"code": ["B", "A", "B"]})
+        >>> data, (rows, cols) = get_long_code_df(df, ["A/code", "B/code"])
+        >>> data.tolist(), rows.tolist(), cols.tolist()
+        ([True, True, True], [0, 1, 2], [1, 0, 1])
     """
-    column_to_int = {feature_name_to_code(col): i for i, col in enumerate(ts_columns)}
-    rows = range(df.select(pl.len()).collect().item())
-    cols = (
-        df.with_columns(pl.col("code").cast(str).replace(column_to_int).cast(int).alias("code_index"))
-        .select("code_index")
-        .collect()
-        .to_series()
-        .to_numpy()
-    )
-    if not np.issubdtype(cols.dtype, np.number):
-        raise ValueError("numeric_value must be a numerical type. Instead it has type: ", cols.dtype)
-    data = np.ones(df.select(pl.len()).collect().item(), dtype=np.bool_)
+    cols = collect_streaming(df.select(get_code_index_expr(ts_columns)))["code_index"].to_numpy()
+    rows = np.arange(len(cols))
+    data = np.ones(len(cols), dtype=np.bool_)
     return data, (rows, cols)
 
 
@@ -75,21 +109,24 @@ def get_long_value_df(
     Returns:
         A tuple containing the data (numerical values), and a tuple of row and column indices for
         the CSR sparse matrix.
+
+    Raises:
+        ValueError: If a selected value has no time-series column.
     """
-    column_to_int = {feature_name_to_code(col): i for i, col in enumerate(ts_columns)}
-    value_df = df.with_row_index("index").drop_nulls("numeric_value").filter(pl.col("code").is_in(ts_columns))
-    rows = value_df.select(pl.col("index")).collect().to_series().to_numpy()
-    cols = (
-        value_df.with_columns(pl.col("code").cast(str).replace(column_to_int).cast(int).alias("value_index"))
-        .select("value_index")
-        .collect()
-        .to_series()
-        .to_numpy()
+    is_value = pl.col("code").is_in(ts_columns) & pl.col("numeric_value").is_not_null()
+    value_df = collect_streaming(
+        df.select(
+            is_value.alias("is_value"),
+            pl.when(is_value).then(pl.col("numeric_value")),
+            pl.when(is_value).then(get_code_index_expr(ts_columns, strict=False)),
+        )
     )
-    if not np.issubdtype(cols.dtype, np.number):
-        raise ValueError("numeric_value must be a numerical type. Instead it has type: ", cols.dtype)
-
-    data = value_df.select(pl.col("numeric_value")).collect().to_series().to_numpy()
+    rows = np.flatnonzero(value_df["is_value"].to_numpy())
+    value_df = value_df.filter("is_value")
+    if value_df["code_index"].null_count():
+        raise ValueError("Some numeric values have codes that are not in the time-series columns.")
+    cols = value_df["code_index"].to_numpy()
+    data = value_df["numeric_value"].to_numpy()
     return data, (rows, cols)
 
 
@@ -112,24 +149,25 @@ def summarize_dynamic_measurements(
     logger.info("Generating Sparse matrix for Time Series Features")
     id_cols = ["subject_id", "time"]
 
+    # The index columns and the column indices of the codes are each collected in a streaming pass
+    index_df = collect_streaming(df.select(pl.col(id_cols)))
+
     # Confirm dataframe is sorted
-    check_df = df.select(pl.col(id_cols))
-    if not check_df.sort(by=id_cols).collect().equals(check_df.collect()):
+    prev_subject_id = pl.col("subject_id").shift()
+    is_ordered = (pl.col("subject_id") > prev_subject_id) | (
+        (pl.col("subject_id") == prev_subject_id) & (pl.col("time") >= pl.col("time").shift())
+    )
+    if not index_df.select(is_ordered.fill_null(True).all()).item():
         raise ValueError("data frame must be sorted by subject_id and time")
 
     # Generate sparse matrix
     if agg in CODE_AGGREGATIONS:
-        code_df = df.drop(*(id_cols + ["numeric_value"]))
-        data, (rows, cols) = get_long_code_df(code_df, ts_columns)
+        data, (rows, cols) = get_long_code_df(df.select("code"), ts_columns)
     elif agg in VALUE_AGGREGATIONS:
-        value_df = df.drop(*id_cols)
-        data, (rows, cols) = get_long_value_df(value_df, ts_columns)
+        data, (rows, cols) = get_long_value_df(df.select("code", "numeric_value"), ts_columns)
 
-    sp_matrix = csr_array(
-        (data, (rows, cols)),
-        shape=(df.select(pl.len()).collect().item(), len(ts_columns)),
-    )
-    return df.select(pl.col(id_cols)), sp_matrix
+    sp_matrix = csr_array((data, (rows, cols)), shape=(len(index_df), len(ts_columns)))
+    return index_df.lazy(), sp_matrix
 
 
 def get_flat_ts_rep(
@@ -0,0 +1,221 @@
+"""Shard manifests for incremental runs over MEDS datasets that are appended to over time.
+
+A manifest records, per input shard, a fingerprint of the shard file (its size and modification time, or a
+hash of its contents) and, for tabularization outputs, a hash of the code set they were computed with.
+Comparing the manifest of a previous run with the current state of the input directory identifies the shards
+that were added, changed or removed, so that only the outputs of those shards need to be recomputed.
+
+Whether an individual output is up to date is decided by `mapper.wrap` through its per-output manifests;
+these stage-level manifests report the changes and clean up the outputs of removed shards.
+"""
+
+import hashlib
+import json
+import os
+from collections.abc import Iterable
+from pathlib import Path
+
+from loguru import logger
+
+from .file_name import list_subdir_files
+from .utils import get_shard_prefix
+
+
+def get_file_fingerprint(fp: Path, use_content_hash: bool = False) -> dict[str, int | str]:
+    """Returns a fingerprint of a file that changes whenever the file is modified.
+
+    Args:
+        fp: The file to fingerprint.
+        use_content_hash: If True, the SHA-256 hash of the file contents is used, which is robust to files
+            being copied or touched without being changed but requires reading the whole file. Otherwise the
+            file size and modification time are used.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as f:
+        ...     _ = Path(f.name).write_text("foo")
+        ...     sorted(get_file_fingerprint(Path(f.name)))
+        ...     get_file_fingerprint(Path(f.name), use_content_hash=True)["sha256"][:8]
+        ['mtime_ns', 'size']
+        '2c26b46b'
+    """
+    if use_content_hash:
+        sha256 = hashlib.sha256()
+        with open(fp, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return {"sha256": sha256.hexdigest()}
+
+    stat = fp.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_shard_manifest(input_dir: Path | str, use_content_hash: bool = False) -> dict[str, dict]:
+    """Fingerprints all parquet shards of a MEDS dataset, keyed by shard prefix.
+
+    Args:
+        input_dir: The directory of the MEDS dataset.
+        use_content_hash: Whether to fingerprint shards by content hash; see `get_file_fingerprint`.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     (Path(d) / "train").mkdir()
+        ...     _ = (Path(d) / "train" / "0.parquet").write_text("foo")
+        ...     _ = (Path(d) / "held_out.parquet").write_text("foobar")
+        ...     {k: v["size"] for k, v in get_shard_manifest(d).items()}
+        {'held_out': 6, 'train/0': 3}
+    """
+    return {
+        get_shard_prefix(Path(input_dir), shard_fp): get_file_fingerprint(shard_fp, use_content_hash)
+        for shard_fp in list_subdir_files(input_dir, "parquet")
+    }
+
+
+def hash_codes(codes: Iterable[str]) -> str:
+    """Returns an order-independent hash of a set of codes.
+
+    Examples:
+        >>> hash_codes(["A", "B"]) == hash_codes(["B", "A"])
+        True
+        >>> hash_codes(["A", "B"]) == hash_codes(["A"])
+        False
+    """
+    return hashlib.sha256("\n".join(sorted(codes)).encode()).hexdigest()
+
+
+def load_manifest(fp: Path) -> dict:
+    """Loads a manifest, returning an empty manifest if it does not exist yet."""
+    fp = Path(fp)
+    if not fp.is_file():
+        return {"shards": {}}
+    return json.loads(fp.read_text())
+
+
+def write_manifest(manifest: dict, fp: Path):
+    """Writes a manifest atomically, so that concurrent workers never read a partially written file.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "manifest" / ".manifest.json"
+        ...     load_manifest(fp)
+        ...     write_manifest({"shards": {"train/0": {"size": 1}}}, fp)
+        ...     load_manifest(fp)
+        {'shards': {}}
+        {'shards': {'train/0': {'size': 1}}}
+    """
+    fp = Path(fp)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+    tmp_fp.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp_fp, fp)
+
+
+def diff_manifests(old_shards: dict[str, dict], new_shards: dict[str, dict]) -> dict[str, list[str]]:
+    """Compares the shard fingerprints of two manifests.
+
+    Args:
+        old_shards: The shard fingerprints of the previous run.
+        new_shards: The current shard fingerprints.
+
+    Returns:
+        A dictionary with the sorted shard prefixes that were "added", "changed" or "removed".
+
+    Examples:
+        >>> old = {"train/0": {"size": 1}, "train/1": {"size": 2}, "held_out/0": {"size": 3}}
+        >>> new = {"train/0": {"size": 1}, "train/1": {"size": 5}, "train/2": {"size": 4}}
+        >>> diff_manifests(old, new)
+        {'added': ['train/2'], 'changed': ['train/1'], 'removed': ['held_out/0']}
+    """
+    return {
+        "added": sorted(set(new_shards) - set(old_shards)),
+        "changed": sorted(k for k in set(new_shards) & set(old_shards) if new_shards[k] != old_shards[k]),
+        "removed": sorted(set(old_shards) - set(new_shards)),
+    }
+
+
+def log_shard_changes(changes: dict[str, list[str]], n_shards: int):
+    """Logs a summary of the shard changes detected by `diff_manifests`."""
+    n_unchanged = n_shards - len(changes["added"]) - len(changes["changed"])
+    logger.info(
+        f"Incremental run: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+        f"{len(changes['removed'])} removed and {n_unchanged} unchanged shards."
+    )
+    for kind, shards in changes.items():
+        if shards:
+            logger.info(f"{kind.capitalize()} shards: {', '.join(shards)}")
+
+
+def report_stale_outputs(manifest: dict, codes_hash: str, shards: Iterable[str]) -> list[str]:
+    """Reports the shards whose existing outputs were computed with a different code set.
+
+    Args:
+        manifest: The manifest of the previous run, whose "codes_hashes" record the `hash_codes` of the code
+            set the outputs of each shard were computed with.
+        codes_hash: The `hash_codes` of the current filtered code set.
+        shards: The shard prefixes whose previous outputs are being kept.
+
+    Returns:
+        The sorted shard prefixes with stale outputs.
+
+    Examples:
+        >>> manifest = {"shards": {}, "codes_hashes": {"train/0": hash_codes(["A"]), "train/1": "foo"}}
+        >>> report_stale_outputs(manifest, hash_codes(["A"]), ["train/0"])
+        []
+        >>> report_stale_outputs(manifest, hash_codes(["A"]), ["train/1", "train/0", "train/2"])
+        ['train/1']
+    """
+    old_codes_hashes = manifest.get("codes_hashes", {})
+    stale = sorted(shard for shard in shards if old_codes_hashes.get(shard, codes_hash) != codes_hash)
+    if stale:
+        logger.warning(
+            f"The filtered code set changed since the outputs of {len(stale)} shards were computed, so "
+            f"they are stale and will be recomputed: {', '.join(stale)}."
+        )
+    return stale
+
+
+def plan_incremental_run(
+    input_dir: Path | str, manifest_fp: Path, codes: Iterable[str], use_content_hash: bool = False
+) -> tuple[set[str], list[str], dict]:
+    """Determines which shards of an incremental tabularization run need to be (re)computed.
+
+    Args:
+        input_dir: The directory of the MEDS dataset.
+        manifest_fp: The manifest of the previous run of the stage.
+        codes: The current filtered code set.
+        use_content_hash: Whether to fingerprint shards by content hash; see `get_file_fingerprint`.
+
+    Returns:
+        The shard prefixes to recompute (added or changed), the shard prefixes that were removed, and the
+        manifest to write once the run completes.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     input_dir, manifest_fp = Path(d) / "data", Path(d) / ".manifest.json"
+        ...     input_dir.mkdir()
+        ...     _ = (input_dir / "0.parquet").write_text("foo")
+        ...     update, removed, manifest = plan_incremental_run(input_dir, manifest_fp, ["A"])
+        ...     print(update, removed)
+        ...     write_manifest(manifest, manifest_fp)
+        ...     _ = (input_dir / "1.parquet").write_text("bar")
+        ...     update, removed, manifest = plan_incremental_run(input_dir, manifest_fp, ["A", "B"])
+        ...     print(update, removed)
+        ...     manifest["codes_hashes"] == {"0": hash_codes(["A", "B"]), "1": hash_codes(["A", "B"])}
+        {'0'} []
+        {'1'} []
+        True
+    """
+    manifest = load_manifest(manifest_fp)
+    shards = get_shard_manifest(input_dir, use_content_hash)
+    changes = diff_manifests(manifest["shards"], shards)
+    log_shard_changes(changes, len(shards))
+
+    update_shards = set(changes["added"]) | set(changes["changed"])
+    codes_hash = hash_codes(codes)
+    report_stale_outputs(manifest, codes_hash, set(shards) - update_shards)
+
+    new_manifest = {**manifest, "shards": shards, "codes_hashes": {shard: codes_hash for shard in shards}}
+    return update_shards, changes["removed"], new_manifest
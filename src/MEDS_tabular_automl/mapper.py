@@ -1,7 +1,16 @@
 """Basic utilities for parallelizable map operations on sharded MEDS datasets with caching and locking."""
 
+import hashlib
 import json
+import os
 import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from collections.abc import Callable
 from datetime import datetime
 from pathlib import Path
@@ -9,79 +18,588 @@ from typing import TypeVar
 
 from loguru import logger
 
+from .profiling import get_output_counts, profile_task
+
 LOCK_TIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
+LOCK_HEARTBEAT_INTERVAL = 30.0
+LOCK_STALE_AFTER = 300.0
+# The process-wide in-memory step cache is disabled by default, as it only helps retries within a process but
+# keeps intermediate outputs alive in every worker; set MEDS_TAB_MEMORY_STEP_CACHE_MAX_BYTES to enable it.
+MEMORY_STEP_CACHE_MAX_BYTES = int(os.environ.get("MEDS_TAB_MEMORY_STEP_CACHE_MAX_BYTES", 0))
 DF_T = TypeVar("DF_T")
 
 
-def get_earliest_lock(cache_directory: Path) -> datetime | None:
-    """Returns the earliest start time of any lock file present in a cache directory, or None if none exist.
+def is_process_alive(pid: int) -> bool:
+    """Returns whether a process with the given id is running on this host.
+
+    Examples:
+        >>> is_process_alive(os.getpid())
+        True
+        >>> is_process_alive(-1)
+        False
+    """
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_lock(lock_fp: Path) -> dict | None:
+    """Reads the owner information of a lock file, or returns None if it does not exist (any more)."""
+    try:
+        return json.loads(lock_fp.read_text())
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        # The owner is still writing its information.
+        return {}
+
+
+def is_lock_stale(lock_fp: Path, lock_info: dict, stale_after: float) -> bool:
+    """Returns whether a lock was left behind by a worker that died.
+
+    A lock is stale if its owner is a process on this host that is no longer running, or if its heartbeat
+    (the modification time of the lock file) is older than ``stale_after`` seconds.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     lock_fp = Path(d) / "lock.json"
+        ...     lock_info = {"pid": os.getpid(), "host": socket.gethostname()}
+        ...     _ = lock_fp.write_text(json.dumps(lock_info))
+        ...     is_lock_stale(lock_fp, lock_info, stale_after=60)
+        ...     is_lock_stale(lock_fp, {**lock_info, "pid": -1}, stale_after=60)
+        ...     os.utime(lock_fp, (time.time() - 120, time.time() - 120))
+        ...     is_lock_stale(lock_fp, {"pid": 1, "host": "other-host"}, stale_after=60)
+        False
+        True
+        True
+    """
+    pid = lock_info.get("pid", None)
+    if lock_info.get("host", None) == socket.gethostname() and pid is not None and not is_process_alive(pid):
+        return True
+    try:
+        last_heartbeat = lock_fp.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - last_heartbeat > stale_after
+
+
+def break_stale_lock(lock_fp: Path, stale_lock_info: dict, stale_after: float = LOCK_STALE_AFTER) -> bool:
+    """Deletes a stale lock, unless another worker broke it (and possibly acquired the lock) in the meantime.
+
+    Checking that a lock is stale and deleting it are separate steps, so workers serialise breaking a lock
+    through a breaker file created with ``O_CREAT | O_EXCL`` and, while holding it, only delete the lock if it
+    is still the one they found to be stale. Otherwise, a worker that read the stale lock before another
+    worker broke it and acquired a fresh lock could delete the fresh lock.
 
     Args:
-        cache_directory: The cache directory to check for the presence of a lock file.
+        lock_fp: The lock file.
+        stale_lock_info: The owner information of the lock, as read when it was found to be stale.
+        stale_after: The number of seconds without a heartbeat after which a breaker file of a worker that
+            died while breaking the lock is deleted.
+
+    Returns:
+        Whether the stale lock was deleted.
 
     Examples:
         >>> import tempfile
-        >>> directory = tempfile.TemporaryDirectory()
-        >>> root = Path(directory.name)
-        >>> empty_directory = root / "cache_empty"
-        >>> empty_directory.mkdir(exist_ok=True, parents=True)
-        >>> cache_directory = root / "cache_with_locks"
-        >>> locks_directory = cache_directory / "locks"
-        >>> locks_directory.mkdir(exist_ok=True, parents=True)
-        >>> time_1 = datetime(2021, 1, 1)
-        >>> time_1_str = time_1.strftime(LOCK_TIME_FMT) # "2021-01-01T00:00:00.000000"
-        >>> lock_fp_1 = locks_directory / f"{time_1_str}.json"
-        >>> _ = lock_fp_1.write_text(json.dumps({"start": time_1_str}))
-        >>> time_2 = datetime(2021, 1, 2, 3, 4, 5)
-        >>> time_2_str = time_2.strftime(LOCK_TIME_FMT) # "2021-01-02T03:04:05.000000"
-        >>> lock_fp_2 = locks_directory / f"{time_2_str}.json"
-        >>> _ = lock_fp_2.write_text(json.dumps({"start": time_2_str}))
-        >>> get_earliest_lock(cache_directory)
-        datetime.datetime(2021, 1, 1, 0, 0)
-        >>> get_earliest_lock(empty_directory) is None
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     cache_directory = Path(d)
+        ...     lock_fp = cache_directory / "locks" / "lock.json"
+        ...     lock_fp.parent.mkdir()
+        ...     stale_lock_info = {"pid": -1, "host": socket.gethostname(), "token": "dead"}
+        ...     _ = lock_fp.write_text(json.dumps(stale_lock_info))
+        ...     # Two workers read the same stale lock, then the first one breaks it and acquires the lock
+        ...     lock_fp, token = acquire_lock(cache_directory)
+        ...     break_stale_lock(lock_fp, stale_lock_info)
+        ...     read_lock(lock_fp)["token"] == token
+        ...     acquire_lock(cache_directory) is None
+        ...     sorted(p.name for p in lock_fp.parent.iterdir())
+        False
         True
-        >>> lock_fp_1.unlink()
-        >>> get_earliest_lock(cache_directory)
-        datetime.datetime(2021, 1, 2, 3, 4, 5)
-        >>> directory.cleanup()
+        True
+        ['lock.json']
     """
-    locks_directory = cache_directory / "locks"
+    breaker_fp = lock_fp.with_name(f"{lock_fp.name}.breaker")
+    try:
+        fd = os.open(breaker_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        breaker_info = read_lock(breaker_fp)
+        if breaker_info is not None and is_lock_stale(breaker_fp, breaker_info, stale_after):
+            breaker_fp.unlink(missing_ok=True)
+        return False
 
-    lock_times = [
-        datetime.strptime(json.loads(lock_fp.read_text())["start"], LOCK_TIME_FMT)
-        for lock_fp in locks_directory.glob("*.json")
-    ]
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid()}, f)
+        if read_lock(lock_fp) != stale_lock_info:
+            return False
+        logger.warning(f"Breaking stale lock {lock_fp} held by {stale_lock_info}.")
+        lock_fp.unlink(missing_ok=True)
+        return True
+    finally:
+        breaker_fp.unlink(missing_ok=True)
 
-    return min(lock_times) if lock_times else None
 
+def acquire_lock(cache_directory: Path, stale_after: float = LOCK_STALE_AFTER) -> tuple[Path, str] | None:
+    """Atomically acquires the lock of a cache directory, breaking it first if its owner died.
 
-def register_lock(cache_directory: Path) -> tuple[datetime, Path]:
-    """Register a lock file in a cache directory.
+    The lock file is created with ``O_CREAT | O_EXCL``, so exactly one worker can hold it, and records the
+    owner's host, process id and a unique token. Stale locks (see `is_lock_stale`) are deleted with
+    `break_stale_lock`, which never deletes a lock that another worker acquired in the meantime, before the
+    lock is acquired again.
 
     Args:
-        cache_directory: The cache directory to register a lock file in.
+        cache_directory: The cache directory to lock.
+        stale_after: The number of seconds without a heartbeat after which a lock is considered stale.
+
+    Returns:
+        The lock file and this worker's token if the lock was acquired, otherwise None.
 
     Examples:
         >>> import tempfile
-        >>> directory = tempfile.TemporaryDirectory()
-        >>> root = Path(directory.name)
-        >>> cache_directory = root / "cache_with_locks"
-        >>> lock_time, lock_fp = register_lock(cache_directory)
-        >>> assert (datetime.now() - lock_time).total_seconds() < 1, "Lock time should be ~ now."
-        >>> lock_fp.is_file()
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     cache_directory = Path(d) / "cache"
+        ...     lock_fp, token = acquire_lock(cache_directory)
+        ...     lock_fp.relative_to(cache_directory)
+        ...     acquire_lock(cache_directory) is None
+        ...     release_lock(lock_fp, token)
+        ...     lock_fp.exists()
+        ...     # A lock left behind by a killed worker is broken automatically.
+        ...     _ = lock_fp.write_text(json.dumps({"pid": -1, "host": socket.gethostname(), "token": "dead"}))
+        ...     lock_fp, token = acquire_lock(cache_directory)
+        ...     read_lock(lock_fp)["token"] == token
+        ...     # Of several workers competing to break the same stale lock, only one acquires the lock.
+        ...     n_acquired = []
+        ...     with ThreadPoolExecutor(8) as pool:
+        ...         for _ in range(20):
+        ...             _ = lock_fp.write_text(json.dumps({"pid": -1, "host": socket.gethostname()}))
+        ...             locks = list(pool.map(lambda _: acquire_lock(cache_directory), range(8)))
+        ...             n_acquired.append(sum(lock is not None for lock in locks))
+        ...     set(n_acquired)
+        PosixPath('locks/lock.json')
         True
-        >>> lock_fp.read_text() == f'{{"start": "{lock_time.strftime(LOCK_TIME_FMT)}"}}'
+        False
         True
-        >>> directory.cleanup()
+        {1}
+    """
+    lock_fp = cache_directory / "locks" / "lock.json"
+    lock_fp.parent.mkdir(exist_ok=True, parents=True)
+    token = uuid.uuid4().hex
+    lock_info = {
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "token": token,
+        "start": datetime.now().strftime(LOCK_TIME_FMT),
+    }
+
+    for _ in range(2):
+        try:
+            fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            held_lock_info = read_lock(lock_fp)
+            if held_lock_info is None:
+                continue
+            if not is_lock_stale(lock_fp, held_lock_info, stale_after):
+                return None
+            if not break_stale_lock(lock_fp, held_lock_info, stale_after):
+                return None
+            continue
+        with os.fdopen(fd, "w") as f:
+            json.dump(lock_info, f)
+        return lock_fp, token
+    return None
+
+
+def release_lock(lock_fp: Path, token: str):
+    """Releases a lock if it is still held by the worker with the given token."""
+    lock_info = read_lock(lock_fp)
+    if lock_info is not None and lock_info.get("token", None) == token:
+        lock_fp.unlink(missing_ok=True)
+
+
+class LockHeartbeat:
+    """Context manager that periodically touches a lock file so other workers know its owner is alive.
+
+    Args:
+        lock_fp: The lock file.
+        interval: The number of seconds between heartbeats.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     lock_fp = Path(d) / "lock.json"
+        ...     lock_fp.touch()
+        ...     os.utime(lock_fp, (0, 0))
+        ...     with LockHeartbeat(lock_fp, interval=0.01):
+        ...         time.sleep(0.1)
+        ...     lock_fp.stat().st_mtime > 0
+        True
+    """
+
+    def __init__(self, lock_fp: Path, interval: float = LOCK_HEARTBEAT_INTERVAL):
+        self.lock_fp = lock_fp
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.lock_fp)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def get_input_signature(in_fp: Path) -> dict[str, list[int]]:
+    """Returns the sizes and modification times of an input file or of the files in an input directory.
+
+    Hidden files and directories (e.g., caches, locks and manifests) inside an input directory are ignored.
+
+    Args:
+        in_fp: The input file or directory.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     root = Path(d)
+        ...     _ = (root / "a.parquet").write_text("foo")
+        ...     (root / ".a_cache").mkdir()
+        ...     _ = (root / ".a_cache" / "step_0.output").write_text("bar")
+        ...     list(get_input_signature(root))
+        ...     [size for size, _ in get_input_signature(root / "a.parquet").values()]
+        ['a.parquet']
+        [3]
+    """
+    if in_fp.is_dir():
+        fps = sorted(
+            fp
+            for fp in in_fp.rglob("*")
+            if fp.is_file() and not any(part.startswith(".") for part in fp.relative_to(in_fp).parts)
+        )
+        rel_fps = [str(fp.relative_to(in_fp)) for fp in fps]
+    else:
+        fps = [in_fp]
+        rel_fps = [in_fp.name]
+
+    signature = {}
+    for rel_fp, fp in zip(rel_fps, fps):
+        stat = fp.stat()
+        signature[rel_fp] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def get_manifest_fp(out_fp: Path) -> Path:
+    """Returns the path of the hidden manifest file recording how an output file was computed.
+
+    Examples:
+        >>> get_manifest_fp(Path("/a/b/0.npz"))
+        PosixPath('/a/b/.0.npz.manifest.json')
+    """
+    return out_fp.parent / f".{out_fp.name}.manifest.json"
+
+
+def get_manifest_hash(in_fp: Path, manifest_key: str) -> str:
+    """Hashes the input signature of ``in_fp`` together with a key describing the computation.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as f:
+        ...     fp = Path(f.name)
+        ...     get_manifest_hash(fp, "foo") == get_manifest_hash(fp, "foo")
+        ...     get_manifest_hash(fp, "foo") == get_manifest_hash(fp, "bar")
+        True
+        False
+    """
+    payload = json.dumps({"inputs": get_input_signature(in_fp), "key": manifest_key}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_output_up_to_date(
+    in_fp: Path, out_fp: Path, manifest_key: str | None = None, manifest_hash: str | None = None
+) -> bool:
+    """Returns whether `wrap` would reuse the existing output ``out_fp`` rather than recompute it.
+
+    Args:
+        in_fp: The input file or directory of the output.
+        out_fp: The output file.
+        manifest_key: The manifest key passed to `wrap`, if any.
+        manifest_hash: The precomputed `get_manifest_hash` of the input and manifest key, if known.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     in_fp, out_fp = Path(d) / "in.csv", Path(d) / "out.csv"
+        ...     _ = in_fp.write_text("a")
+        ...     is_output_up_to_date(in_fp, out_fp)
+        ...     _ = out_fp.write_text("a")
+        ...     is_output_up_to_date(in_fp, out_fp), is_output_up_to_date(in_fp, out_fp, manifest_key="foo")
+        ...     _ = get_manifest_fp(out_fp).write_text(json.dumps({"hash": get_manifest_hash(in_fp, "foo")}))
+        ...     is_output_up_to_date(in_fp, out_fp, "foo"), is_output_up_to_date(in_fp, out_fp, "bar")
+        False
+        (True, False)
+        (True, False)
+    """
+    if not out_fp.is_file():
+        return False
+    if manifest_hash is None and manifest_key is not None:
+        manifest_hash = get_manifest_hash(in_fp, manifest_key)
+    if manifest_hash is None:
+        return True
+    try:
+        stored_hash = json.loads(get_manifest_fp(out_fp).read_text()).get("hash", None)
+    except (FileNotFoundError, json.JSONDecodeError):
+        stored_hash = None
+    return stored_hash == manifest_hash
+
+
+def get_object_size(obj) -> int:
+    """Estimates the number of bytes held in memory by a dataframe, array, sparse matrix or tuple thereof.
+
+    Lazy frames only hold a query plan and are counted as empty.
+
+    Examples:
+        >>> import numpy as np
+        >>> import polars as pl
+        >>> from scipy.sparse import csr_array
+        >>> get_object_size(np.zeros(10, dtype=np.float32))
+        40
+        >>> get_object_size(csr_array(np.eye(4, dtype=np.float32)))
+        52
+        >>> get_object_size((pl.DataFrame({"a": [1, 2]}), pl.LazyFrame({"a": [1, 2]})))
+        16
+    """
+    if isinstance(obj, tuple | list):
+        return sum(get_object_size(o) for o in obj)
+    if hasattr(obj, "estimated_size"):
+        return int(obj.estimated_size())
+    if hasattr(obj, "collect_schema"):
+        return 0
+    if hasattr(obj, "indptr"):
+        return int(obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes)
+    if hasattr(obj, "row") and hasattr(obj, "col"):
+        return int(obj.data.nbytes + obj.row.nbytes + obj.col.nbytes)
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    return sys.getsizeof(obj)
+
+
+class StepCache(ABC):
+    """Defines the interface of the backends in which `wrap` caches the outputs of intermediate steps.
+
+    Step outputs are keyed by the final output file path and the index of the step.
+
+    Examples:
+        >>> class IncompleteStepCache(StepCache):
+        ...     def has(self, out_fp, step):
+        ...         return False
+        >>> IncompleteStepCache()
+        Traceback (most recent call last):
+            ...
+        TypeError: Can't instantiate abstract class IncompleteStepCache...
+    """
+
+    @abstractmethod
+    def has(self, out_fp: Path, step: int) -> bool:
+        pass
+
+    @abstractmethod
+    def load(self, out_fp: Path, step: int, read_fn: Callable[[Path], DF_T]) -> DF_T:
+        pass
+
+    @abstractmethod
+    def store(self, out_fp: Path, step: int, df: DF_T, write_fn: Callable[[DF_T, Path], None]):
+        pass
+
+    @abstractmethod
+    def discard(self, out_fp: Path, step: int):
+        pass
+
+    @abstractmethod
+    def clear(self, out_fp: Path):
+        pass
+
+
+class DiskStepCache(StepCache):
+    """Caches step outputs as files written with the `write_fn` of `wrap`, so runs can resume after crashes.
+
+    Args:
+        root: The directory in which step outputs are stored, e.g., a local SSD. If None, they are stored in
+            the hidden cache directory `{out_fp.parent}/.{out_fp.stem}_cache` of each output.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     out_fp = Path(d) / "out" / "0.txt"
+        ...     for cache in (DiskStepCache(), DiskStepCache(Path(d) / "ssd")):
+        ...         cache.has(out_fp, 0)
+        ...         cache.store(out_fp, 0, "foo", lambda df, fp: fp.write_text(df))
+        ...         cache.has(out_fp, 0), cache.load(out_fp, 0, Path.read_text)
+        ...         cache.clear(out_fp)
+        ...         cache.has(out_fp, 0)
+        False
+        (True, 'foo')
+        False
+        False
+        (True, 'foo')
+        False
+    """
+
+    def __init__(self, root: Path | str | None = None):
+        self.root = None if root is None else Path(root)
+
+    def get_directory(self, out_fp: Path) -> Path:
+        if self.root is None:
+            return out_fp.parent / f".{out_fp.stem}_cache"
+        return self.root / hashlib.sha256(str(Path(out_fp).resolve()).encode()).hexdigest()[:16]
+
+    def get_step_fp(self, out_fp: Path, step: int) -> Path:
+        return self.get_directory(out_fp) / f"step_{step}.output"
+
+    def has(self, out_fp: Path, step: int) -> bool:
+        return self.get_step_fp(out_fp, step).is_file()
+
+    def load(self, out_fp: Path, step: int, read_fn: Callable[[Path], DF_T]) -> DF_T:
+        return read_fn(self.get_step_fp(out_fp, step))
+
+    def store(self, out_fp: Path, step: int, df: DF_T, write_fn: Callable[[DF_T, Path], None]):
+        step_fp = self.get_step_fp(out_fp, step)
+        step_fp.parent.mkdir(exist_ok=True, parents=True)
+        tmp_fp = step_fp.with_name(f"tmp.{uuid.uuid4().hex}.{step_fp.name}")
+        try:
+            write_fn(df, tmp_fp)
+            os.replace(tmp_fp, step_fp)
+        finally:
+            tmp_fp.unlink(missing_ok=True)
+
+    def discard(self, out_fp: Path, step: int):
+        self.get_step_fp(out_fp, step).unlink(missing_ok=True)
+
+    def clear(self, out_fp: Path):
+        for step_fp in self.get_directory(out_fp).glob("step_*.output"):
+            step_fp.unlink(missing_ok=True)
+        if self.root is not None:
+            shutil.rmtree(self.get_directory(out_fp), ignore_errors=True)
+
+
+class MemoryStepCache(StepCache):
+    """Keeps step outputs in memory, evicting the least recently used ones beyond a size limit.
+
+    Unlike `DiskStepCache`, this never serializes intermediate outputs, but cached steps are only reused by
+    later calls of `wrap` in the same process, e.g., when a failed output is retried. Cached outputs stay
+    alive until they are evicted, so they add up to ``max_bytes`` to the memory use of the process. The cache
+    may be shared by the threads of a stage.
+
+    Args:
+        max_bytes: The maximum total size of the cached outputs (see `get_object_size`). Outputs larger than
+            this are not cached. The process-wide `MEMORY_STEP_CACHE` is disabled (0 bytes) by default.
+
+    Examples:
+        >>> import numpy as np
+        >>> cache = MemoryStepCache(max_bytes=100)
+        >>> cache.store(Path("a"), 0, np.zeros(8), write_fn=None)
+        >>> cache.store(Path("b"), 0, np.zeros(8), write_fn=None)
+        >>> cache.has(Path("a"), 0), cache.has(Path("b"), 0), cache.n_bytes
+        (False, True, 64)
+        >>> cache.store(Path("b"), 1, np.zeros(16), write_fn=None)  # Too large to cache
+        >>> cache.load(Path("b"), 0, read_fn=None)
+        array([0., 0., 0., 0., 0., 0., 0., 0.])
+        >>> cache.clear(Path("b"))
+        >>> cache.n_bytes
+        0
     """
 
-    lock_directory = cache_directory / "locks"
-    lock_directory.mkdir(exist_ok=True, parents=True)
+    def __init__(self, max_bytes: int = MEMORY_STEP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries: OrderedDict[tuple[str, int], tuple[object, int]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def has(self, out_fp: Path, step: int) -> bool:
+        with self._lock:
+            return (str(out_fp), step) in self._entries
+
+    def load(self, out_fp: Path, step: int, read_fn: Callable[[Path], DF_T]) -> DF_T:
+        with self._lock:
+            self._entries.move_to_end((str(out_fp), step))
+            return self._entries[(str(out_fp), step)][0]
+
+    def store(self, out_fp: Path, step: int, df: DF_T, write_fn: Callable[[DF_T, Path], None]):
+        size = get_object_size(df)
+        with self._lock:
+            self.discard(out_fp, step)
+            if size > self.max_bytes:
+                logger.info(f"Not caching step {step} of {out_fp} in memory as it takes {size} bytes.")
+                return
+            while self.n_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+            self._entries[(str(out_fp), step)] = (df, size)
+            self.n_bytes += size
+
+    def discard(self, out_fp: Path, step: int):
+        with self._lock:
+            entry = self._entries.pop((str(out_fp), step), None)
+            if entry is not None:
+                self.n_bytes -= entry[1]
+
+    def clear(self, out_fp: Path):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == str(out_fp)]:
+                self.discard(Path(key[0]), key[1])
 
-    lock_time = datetime.now()
-    lock_fp = lock_directory / f"{lock_time.strftime(LOCK_TIME_FMT)}.json"
-    lock_fp.write_text(json.dumps({"start": lock_time.strftime(LOCK_TIME_FMT)}))
-    return lock_time, lock_fp
+
+MEMORY_STEP_CACHE = MemoryStepCache()
+
+
+def get_step_cache(cache_intermediate: bool | str | StepCache | None) -> StepCache | None:
+    """Resolves the `cache_intermediate` argument of `wrap` to a step cache backend.
+
+    Args:
+        cache_intermediate: A `StepCache`, "memory" for the process-wide `MEMORY_STEP_CACHE` (or no caching
+            if it is disabled), "disk" (or True) for a `DiskStepCache` next to each output, or None (or False)
+            to disable caching.
+
+    Examples:
+        >>> get_step_cache("memory") is None  # MEMORY_STEP_CACHE is disabled by default
+        True
+        >>> cache = MemoryStepCache(max_bytes=1024)
+        >>> get_step_cache(cache) is cache
+        True
+        >>> type(get_step_cache(True)).__name__, get_step_cache(False)
+        ('DiskStepCache', None)
+        >>> get_step_cache("ssd")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown intermediate cache 'ssd'; expected 'memory', 'disk', a bool or a StepCache.
+    """
+    if isinstance(cache_intermediate, StepCache):
+        return cache_intermediate
+    if cache_intermediate is None or cache_intermediate is False:
+        return None
+    if cache_intermediate is True or cache_intermediate == "disk":
+        return DiskStepCache()
+    if cache_intermediate == "memory":
+        return MEMORY_STEP_CACHE if MEMORY_STEP_CACHE.max_bytes > 0 else None
+    raise ValueError(
+        f"Unknown intermediate cache {cache_intermediate!r}; "
+        "expected 'memory', 'disk', a bool or a StepCache."
+    )
 
 
 def wrap(
@@ -90,20 +608,23 @@ def wrap(
     read_fn: Callable[[Path], DF_T],
     write_fn: Callable[[DF_T, Path], None],
     *transform_fns: Callable[[DF_T], DF_T],
-    cache_intermediate: bool = True,
+    cache_intermediate: bool | str | StepCache | None = "memory",
     clear_cache_on_completion: bool = True,
     do_overwrite: bool = False,
     do_return: bool = False,
+    manifest_key: str | None = None,
+    lock_heartbeat_interval: float = LOCK_HEARTBEAT_INTERVAL,
+    lock_stale_after: float = LOCK_STALE_AFTER,
 ) -> tuple[bool, DF_T | None]:
     """Wrap a series of file-in file-out map transformations on a dataframe with caching and locking.
 
     Args:
         in_fp: The file path of the input dataframe. Must exist and be readable via `read_fn`.
-        out_fp: Output file path. The parent directory will be created if it does not exist. If this file
-            already exists, it will be deleted before any computations are done if `do_overwrite=True`, which
-            can result in data loss if the transformation functions do not complete successfully on
-            intermediate steps. If `do_overwrite` is `False` and this file exists, the function will use the
-            `read_fn` to read the file and return the dataframe directly.
+        out_fp: Output file path. The parent directory will be created if it does not exist. The output is
+            written to a temporary file in the cache directory and atomically renamed to `out_fp`, so readers
+            never see a partially written file and an existing output is only replaced once its recomputation
+            (with `do_overwrite=True`) succeeds. If `do_overwrite` is `False` and this file exists, the
+            function will use the `read_fn` to read the file and return the dataframe directly.
         read_fn: Function that reads the dataframe from a file. This must take as input a Path object and
             return a dataframe of (generic) type DF_T. Ideally, this read function can make use of lazy
             loading to further accelerate unnecessary reads when resuming from intermediate cached steps.
@@ -112,25 +633,38 @@ def wrap(
         transform_fns: A series of functions that transform the dataframe. Each function must take as input
             a dataframe of (generic) type DF_T and return a dataframe of (generic) type DF_T. The functions
             will be applied in the passed order.
-        cache_intermediate: If True, intermediate outputs of the transformations will be cached in a hidden
-            directory in the same parent directory as `out_fp` of the form
-            `{out_fp.parent}/.{out_fp.stem}_cache`. This can be useful for debugging and resuming from
-            intermediate steps when nontrivial transformations are composed. Cached files will be named
-            `step_{i}.output` where `i` is the index of the transformation function in `transform_fns`. **Note
-            that if you change the order of the transformations, the cache will be no longer valid but the
-            system will _not_ automatically delete the cache!**. This is `True` by default.
-            If `do_overwrite=True`, any prior individual cache files that are detected during the run will be
-            deleted before their corresponding step is run. If `do_overwrite=False` and a cache file exists,
-            that step of the transformation will be skipped and the cache file will be read directly.
+        cache_intermediate: Where the outputs of intermediate transformation steps are cached, so that a
+            failed computation resumes from the last completed step (see `get_step_cache`). By default, they
+            are kept in the size-limited, process-wide `MEMORY_STEP_CACHE`, which avoids serializing them, if
+            it is enabled through the ``MEDS_TAB_MEMORY_STEP_CACHE_MAX_BYTES`` environment variable.
+            With "disk" (or True), they are written with `write_fn` to files `step_{i}.output` in the hidden
+            directory `{out_fp.parent}/.{out_fp.stem}_cache`, where `i` is the index of the transformation
+            function in `transform_fns`, so that they can also be reused by other processes; a
+            `DiskStepCache` with a `root` (e.g., on a local SSD) stores them elsewhere. None (or False)
+            disables caching. **Note that if you change the order of the transformations, the cache will be
+            no longer valid but the system will _not_ automatically delete the cache!**.
+            If `do_overwrite=True`, any prior individual cached steps that are detected during the run will be
+            deleted before their corresponding step is run. If `do_overwrite=False` and a cached step exists,
+            that step of the transformation will be skipped and the cached output will be used directly.
         clear_cache_on_completion: If True, the cache directory will be deleted after the final output is
             written. This is `True` by default.
         do_overwrite: If True, the output file will be overwritten if it already exists. This is `False` by
             default.
         do_return: If True, the final dataframe will be returned. This is `False` by default.
+        manifest_key: If set, a hidden manifest file (see `get_manifest_fp`) records a hash of the input
+            file signature(s) and this key, which should describe everything else the output depends on
+            (e.g., the resolved code list and relevant config). An existing output is then only reused if the
+            hash matches; otherwise it is recomputed. If `None`, an existing output is always reused unless
+            `do_overwrite=True`.
+        lock_heartbeat_interval: The number of seconds between heartbeats of the lock held while computing
+            the output. Only one worker computes an output at a time; others return immediately.
+        lock_stale_after: The number of seconds without a heartbeat after which another worker may break the
+            lock. Locks of killed workers on the same host are broken immediately. See `acquire_lock`.
 
     Returns:
-        The dataframe resulting from the transformations applied in sequence to the dataframe stored in
-        `in_fp`.
+        Whether the output exists after the call, i.e., False if another worker holds the lock, and, if
+        `do_return=True`, the dataframe resulting from the transformations applied in sequence to the
+        dataframe stored in `in_fp` (or None if the lock was held by another worker).
 
     Examples:
         >>> import polars as pl
@@ -165,7 +699,7 @@ def wrap(
         ... ]
         >>> import pytest
         >>> with pytest.raises(Exception):
-        ...     wrap(in_fp, out_fp, read_fn, write_fn, *transform_fns)
+        ...     wrap(in_fp, out_fp, read_fn, write_fn, *transform_fns, cache_intermediate="disk")
         >>> assert cache_directory.is_dir()
         >>> cache_fp = cache_directory / "step_0.output"
         >>> pl.read_csv(cache_fp)
@@ -180,6 +714,22 @@ def wrap(
         │ 3   ┆ 5   ┆ 12  │
         └─────┴─────┴─────┘
         >>> shutil.rmtree(cache_directory)
+        >>> # Intermediate steps cached in memory are reused when the output is retried in the same process
+        >>> memory_cache = MemoryStepCache(max_bytes=1024**2)
+        >>> with pytest.raises(Exception):
+        ...     wrap(in_fp, out_fp, read_fn, write_fn, *transform_fns, cache_intermediate=memory_cache)
+        >>> memory_cache.has(out_fp, 0), cache_fp.exists()
+        (True, False)
+        >>> def fail_fn(df):
+        ...     raise AssertionError("Step 0 should be read from the cache")
+        >>> wrap(
+        ...     in_fp, out_fp, read_fn, write_fn, fail_fn, lambda df: df, cache_intermediate=memory_cache,
+        ...     do_return=True,
+        ... )[1]["c"].to_list()
+        [6, -2, 12]
+        >>> memory_cache.has(out_fp, 0)
+        False
+        >>> out_fp.unlink()
         >>> lock_dir = cache_directory / "locks"
         >>> assert not lock_dir.exists()
         >>> def lock_dir_checker_fn(df: pl.DataFrame) -> pl.DataFrame:
@@ -201,77 +751,139 @@ def wrap(
         │ 3   ┆ 4   ┆ -1  │
         │ 3   ┆ 5   ┆ 6   │
         └─────┴─────┴─────┘
+        >>> out_fp.unlink()
+        >>> wrap(in_fp, out_fp, read_fn, write_fn, transform_fns[0], manifest_key="c * 2")
+        True
+        >>> pl.read_csv(out_fp)["c"].to_list()
+        [6, -2, 12]
+        >>> wrap(in_fp, out_fp, read_fn, write_fn, transform_fns[0], manifest_key="c * 2", do_return=True)[1]
+        shape: (3, 3)
+        ┌─────┬─────┬─────┐
+        │ a   ┆ b   ┆ c   │
+        │ --- ┆ --- ┆ --- │
+        │ i64 ┆ i64 ┆ i64 │
+        ╞═════╪═════╪═════╡
+        │ 1   ┆ 2   ┆ 6   │
+        │ 3   ┆ 4   ┆ -2  │
+        │ 3   ┆ 5   ┆ 12  │
+        └─────┴─────┴─────┘
+        >>> wrap(in_fp, out_fp, read_fn, write_fn, lambda df: df, manifest_key="identity")
+        True
+        >>> pl.read_csv(out_fp)["c"].to_list()
+        [3, -1, 6]
+        >>> out_fp.unlink()
+        >>> lock = acquire_lock(cache_directory)
+        >>> wrap(in_fp, out_fp, read_fn, write_fn, lambda df: df, do_return=True)
+        (False, None)
+        >>> release_lock(*lock)
+        >>> # The lock of a worker that was killed does not block later workers
+        >>> lock_fp, _ = acquire_lock(cache_directory)
+        >>> _ = lock_fp.write_text(json.dumps({"pid": -1, "host": socket.gethostname(), "token": "dead"}))
+        >>> wrap(in_fp, out_fp, read_fn, write_fn, lambda df: df)
+        True
+        >>> sorted(p.name for p in root.iterdir())
+        ['input.csv', 'output.csv']
         >>> directory.cleanup()
     """
 
-    if out_fp.is_file():
+    manifest_fp = get_manifest_fp(out_fp)
+    manifest_hash = get_manifest_hash(in_fp, manifest_key) if manifest_key is not None else None
+
+    def is_up_to_date() -> bool:
         if do_overwrite:
-            logger.info(f"Deleting existing {out_fp} as do_overwrite={do_overwrite}.")
-            out_fp.unlink()
-        else:
-            logger.info(f"{out_fp} exists; reading directly and returning.")
-            if do_return:
-                return True, read_fn(out_fp)
-            else:
-                return True
+            return False
+        if out_fp.is_file() and not is_output_up_to_date(in_fp, out_fp, manifest_hash=manifest_hash):
+            logger.info(f"{out_fp} is stale relative to its inputs or manifest key; recomputing.")
+            return False
+        return out_fp.is_file()
+
+    def skip() -> tuple[bool, DF_T] | bool:
+        logger.info(f"{out_fp} exists; reading directly and returning.")
+        return (True, read_fn(out_fp)) if do_return else True
+
+    if is_up_to_date():
+        return skip()
+    elif out_fp.is_file() and manifest_hash is not None:
+        # Stale outputs are recomputed, including any cached intermediate steps.
+        do_overwrite = True
 
+    step_cache = get_step_cache(cache_intermediate)
     cache_directory = out_fp.parent / f".{out_fp.stem}_cache"
     cache_directory.mkdir(exist_ok=True, parents=True)
 
-    earliest_lock_time = get_earliest_lock(cache_directory)
-    if earliest_lock_time is not None:
-        logger.info(f"{out_fp} is in progress as of {earliest_lock_time}. Returning.")
-        return False, None if do_return else False
+    lock = acquire_lock(cache_directory, lock_stale_after)
+    if lock is None:
+        logger.info(f"{out_fp} is in progress by another worker. Returning.")
+        return (False, None) if do_return else False
+    lock_fp, token = lock
+    st_time = datetime.now()
+    logger.info(f"Acquired lock {lock_fp} at {st_time}.")
 
-    st_time, lock_fp = register_lock(cache_directory)
+    # Another worker may have completed the output between the check above and acquiring the lock.
+    if is_up_to_date():
+        release_lock(lock_fp, token)
+        return skip()
 
-    logger.info(f"Registered lock at {st_time}. Double checking no earlier locks have been registered.")
-    earliest_lock_time = get_earliest_lock(cache_directory)
-    if earliest_lock_time < st_time:
-        logger.info(f"Earlier lock found at {earliest_lock_time}. Deleting current lock and returning.")
-        lock_fp.unlink()
-        return False, None if do_return else False
-
-    logger.info(f"Reading input dataframe from {in_fp}")
-    df = read_fn(in_fp)
-    logger.info("Read dataset")
+    def write_atomically(df: DF_T, fp: Path):
+        tmp_fp = cache_directory / f"tmp.{token}.{fp.name}"
+        write_fn(df, tmp_fp)
+        os.replace(tmp_fp, fp)
 
     try:
-        for i, transform_fn in enumerate(transform_fns):
-            cache_fp = cache_directory / f"step_{i}.output"
-
-            st_time_step = datetime.now()
-            if cache_fp.is_file():
-                if do_overwrite:
-                    logger.info(
-                        f"Deleting existing cached output for step {i} " f"as do_overwrite={do_overwrite}"
-                    )
-                    cache_fp.unlink()
+        # With profiling enabled, the computation is recorded as a task of the stage (see `profiling`)
+        with (
+            LockHeartbeat(lock_fp, lock_heartbeat_interval),
+            profile_task(str(out_fp), in_fp, out_fp) as record,
+        ):
+            logger.info(f"Reading input dataframe from {in_fp}")
+            df = read_fn(in_fp)
+            logger.info("Read dataset")
+
+            for i, transform_fn in enumerate(transform_fns):
+                st_time_step = datetime.now()
+                if step_cache is not None and step_cache.has(out_fp, i):
+                    if do_overwrite:
+                        logger.info(
+                            f"Deleting existing cached output for step {i} " f"as do_overwrite={do_overwrite}"
+                        )
+                        step_cache.discard(out_fp, i)
+                        df = transform_fn(df)
+                    else:
+                        logger.info(f"Reading cached output for step {i}")
+                        df = step_cache.load(out_fp, i, read_fn)
                 else:
-                    logger.info(f"Reading cached output for step {i}")
-                    df = read_fn(cache_fp)
-            else:
-                df = transform_fn(df)
-
-            if cache_intermediate and i < len(transform_fns) - 1:
-                logger.info(f"Writing intermediate output for step {i} to {cache_fp}")
-                write_fn(df, cache_fp)
-            logger.info(f"Completed step {i} in {datetime.now() - st_time_step}")
-
-        logger.info(f"Writing final output to {out_fp}")
-        write_fn(df, out_fp)
-        logger.info(f"Succeeded in {datetime.now() - st_time}")
-        if clear_cache_on_completion:
-            logger.info(f"Clearing cache directory {cache_directory}")
-            shutil.rmtree(cache_directory)
-        else:
-            logger.info(f"Leaving cache directory {cache_directory}, but clearing lock at {lock_fp}")
-            lock_fp.unlink()
-        if do_return:
-            return True, df
-        else:
-            return True
+                    df = transform_fn(df)
+
+                if step_cache is not None and i < len(transform_fns) - 1:
+                    logger.info(f"Caching intermediate output for step {i}")
+                    step_cache.store(out_fp, i, df, write_fn)
+                logger.info(f"Completed step {i} in {datetime.now() - st_time_step}")
+
+            record.update(get_output_counts(df))
+            logger.info(f"Writing final output to {out_fp}")
+            manifest_fp.unlink(missing_ok=True)
+            write_atomically(df, out_fp)
+            if manifest_hash is not None:
+                tmp_manifest_fp = cache_directory / f"tmp.{token}.{manifest_fp.name}"
+                tmp_manifest_fp.write_text(json.dumps({"hash": manifest_hash, "key": manifest_key}))
+                os.replace(tmp_manifest_fp, manifest_fp)
     except Exception as e:
         logger.warning(f"Clearing lock due to Exception {e} at {lock_fp} after {datetime.now() - st_time}")
-        lock_fp.unlink()
+        for tmp_fp in cache_directory.glob(f"tmp.{token}.*"):
+            tmp_fp.unlink(missing_ok=True)
+        release_lock(lock_fp, token)
         raise e
+
+    logger.info(f"Succeeded in {datetime.now() - st_time}")
+    if clear_cache_on_completion:
+        logger.info(f"Clearing cache directory {cache_directory}")
+        if step_cache is not None:
+            step_cache.clear(out_fp)
+        shutil.rmtree(cache_directory, ignore_errors=True)
+    else:
+        logger.info(f"Leaving cache directory {cache_directory}, but clearing lock at {lock_fp}")
+        release_lock(lock_fp, token)
+    if do_return:
+        return True, df
+    else:
+        return True
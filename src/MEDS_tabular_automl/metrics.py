@@ -0,0 +1,79 @@
+"""Vectorized evaluation metrics for binary classification models."""
+
+import numpy as np
+
+LOG_LOSS_EPS = 1e-15
+
+
+def binary_classification_metrics(y_true: np.ndarray, y_score: np.ndarray) -> dict[str, float]:
+    """Computes the ROC AUC, average precision (AUPRC) and log-loss of binary predictions in one pass.
+
+    The scores are sorted once and the ROC and precision-recall curves are both derived from the cumulative
+    true and false positive counts at each distinct score threshold, matching the values of
+    `sklearn.metrics.roc_auc_score`, `sklearn.metrics.average_precision_score` and `sklearn.metrics.log_loss`.
+
+    Args:
+        y_true: The binary labels.
+        y_score: The predicted probabilities of the positive class.
+
+    Returns:
+        A dictionary with the keys "auc", "auprc" and "logloss".
+
+    Raises:
+        ValueError: If the inputs are empty, have mismatched lengths, or only contain a single class.
+
+    Examples:
+        >>> from sklearn.metrics import average_precision_score, log_loss, roc_auc_score
+        >>> rng = np.random.default_rng(0)
+        >>> y_true = rng.integers(0, 2, 1000)
+        >>> y_score = np.round(np.clip(0.3 * y_true + rng.random(1000) * 0.7, 0, 1), 2)  # with ties
+        >>> metrics = binary_classification_metrics(y_true, y_score)
+        >>> bool(np.isclose(metrics["auc"], roc_auc_score(y_true, y_score)))
+        True
+        >>> bool(np.isclose(metrics["auprc"], average_precision_score(y_true, y_score)))
+        True
+        >>> bool(np.isclose(metrics["logloss"], log_loss(y_true, y_score)))
+        True
+        >>> metrics = binary_classification_metrics(np.array([0, 0, 1, 1]), np.array([0.1, 0.4, 0.35, 0.8]))
+        >>> {k: round(v, 4) for k, v in metrics.items()}
+        {'auc': 0.75, 'auprc': 0.8333, 'logloss': 0.4723}
+        >>> binary_classification_metrics(np.array([1, 1]), np.array([0.1, 0.4]))
+        Traceback (most recent call last):
+            ...
+        ValueError: Only one class present in y_true. ROC AUC score is not defined in that case.
+        >>> binary_classification_metrics(np.array([]), np.array([]))
+        Traceback (most recent call last):
+            ...
+        ValueError: Predictions or true labels are empty.
+    """
+    y_true = np.asarray(y_true).ravel().astype(np.float64)
+    y_score = np.asarray(y_score).ravel().astype(np.float64)
+    if len(y_true) == 0 or len(y_score) == 0:
+        raise ValueError("Predictions or true labels are empty.")
+    if len(y_true) != len(y_score):
+        raise ValueError(f"Got {len(y_true)} labels but {len(y_score)} predictions.")
+
+    order = np.argsort(-y_score, kind="mergesort")
+    sorted_score = y_score[order]
+    sorted_true = y_true[order]
+
+    # Curve points are taken at the last index of each run of tied scores.
+    threshold_idxs = np.r_[np.flatnonzero(np.diff(sorted_score)), len(sorted_true) - 1]
+    tps = np.cumsum(sorted_true)[threshold_idxs]
+    fps = threshold_idxs + 1 - tps
+    n_pos, n_neg = tps[-1], fps[-1]
+    if n_pos == 0 or n_neg == 0:
+        raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+
+    tpr = np.r_[0.0, tps / n_pos]
+    fpr = np.r_[0.0, fps / n_neg]
+    auc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+
+    precision = tps / (tps + fps)
+    recall = tps / n_pos
+    auprc = np.sum(np.diff(np.r_[0.0, recall]) * precision)
+
+    p = np.clip(y_score, LOG_LOSS_EPS, 1 - LOG_LOSS_EPS)
+    logloss = -np.mean(y_true * np.log(p) + (1 - y_true) * np.log1p(-p))
+
+    return {"auc": float(auc), "auprc": float(auprc), "logloss": float(logloss)}
@@ -0,0 +1,425 @@
+"""Per-task profiling of the pipeline stages, reported in the hydra output directory of each run.
+
+When ``profiling.enabled=True``, the `StageProfilerCallback` activates a `StageProfiler` for the duration of
+the hydra job. Every output computed through `mapper.wrap` is then recorded as a task with its wall time, CPU
+time, the peak resident set size of the process, the rows and nonzeros of the output and the bytes read and
+written; stages can record further tasks with `profile_task`. At the end of the job, the tasks and a summary
+of the stage are written to ``{job_name}_profile.json`` and ``{job_name}_profile.parquet`` in
+``profiling.report_dir`` (by default, the hydra output directory), where ``job_name`` is the hydra job name of
+the run. With ``profiling.profiler=cprofile`` or ``profiling.profiler=pyinstrument``, each task is also
+profiled and its profile saved in the ``{job_name}_profile`` subdirectory of the report directory.
+"""
+
+import cProfile
+import json
+import re
+import resource
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+from hydra.core.hydra_config import HydraConfig
+from hydra.experimental.callback import Callback
+from hydra.types import RunMode
+from loguru import logger
+from omegaconf import DictConfig
+
+from .utils import current_script_name
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+REPORT_SCHEMA = {
+    "stage": pl.String,
+    "task": pl.String,
+    "status": pl.String,
+    "start": pl.Datetime("us"),
+    "calls": pl.Int64,
+    "wall_time_s": pl.Float64,
+    "cpu_time_s": pl.Float64,
+    "peak_rss_mb": pl.Float64,
+    "rows": pl.Int64,
+    "nnz": pl.Int64,
+    "bytes_read": pl.Int64,
+    "bytes_written": pl.Int64,
+    "profile_fp": pl.String,
+}
+
+_ACTIVE_PROFILER = None
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident set size of the current process so far, in MB.
+
+    Examples:
+        >>> get_peak_rss_mb() > 0
+        True
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return (peak_rss if sys.platform == "darwin" else peak_rss * 1024) / 2**20
+
+
+def get_path_size(fp: Path | tuple[Path, ...] | list[Path] | None) -> int:
+    """Returns the size in bytes of a file or of all files under a directory, or 0 if it does not exist.
+
+    Tasks with several inputs (e.g., the MEDS shard and tabularized matrix of `cache_task`) pass a tuple or
+    list of paths, whose sizes are summed.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     _ = (Path(d) / "a.txt").write_text("abc")
+        ...     (Path(d) / "sub").mkdir()
+        ...     _ = (Path(d) / "sub" / "b.txt").write_text("de")
+        ...     get_path_size(Path(d) / "a.txt"), get_path_size(Path(d)), get_path_size(Path(d) / "c.txt")
+        ...     get_path_size((Path(d) / "a.txt", Path(d) / "sub")), get_path_size([])
+        (3, 5, 0)
+        (5, 0)
+        >>> get_path_size(None)
+        0
+    """
+    if fp is None:
+        return 0
+    if isinstance(fp, tuple | list):
+        return sum(get_path_size(f) for f in fp)
+    fp = Path(fp)
+    if fp.is_file():
+        return fp.stat().st_size
+    if fp.is_dir():
+        return sum(f.stat().st_size for f in fp.rglob("*") if f.is_file())
+    return 0
+
+
+def get_output_counts(obj) -> dict[str, int | None]:
+    """Counts the rows and nonzero values of a dataframe, sparse matrix or tuple thereof.
+
+    Nonzeros are only counted for sparse matrices and rows are not counted for lazy frames, which only hold
+    a query plan.
+
+    Examples:
+        >>> import numpy as np
+        >>> from scipy.sparse import csr_array
+        >>> get_output_counts(pl.DataFrame({"a": [1, 2, 3]}))
+        {'rows': 3, 'nnz': None}
+        >>> get_output_counts(csr_array(np.eye(4)))
+        {'rows': 4, 'nnz': 4}
+        >>> get_output_counts((pl.DataFrame({"a": [1, 2]}), csr_array(np.eye(2))))
+        {'rows': 2, 'nnz': 2}
+        >>> get_output_counts(pl.LazyFrame({"a": [1, 2]}))
+        {'rows': None, 'nnz': None}
+    """
+    if isinstance(obj, tuple | list):
+        counts = [get_output_counts(o) for o in obj]
+        rows = [c["rows"] for c in counts if c["rows"] is not None]
+        nnz = [c["nnz"] for c in counts if c["nnz"] is not None]
+        return {"rows": max(rows) if rows else None, "nnz": sum(nnz) if nnz else None}
+    if isinstance(obj, pl.DataFrame):
+        return {"rows": obj.height, "nnz": None}
+    if hasattr(obj, "nnz") and hasattr(obj, "shape"):
+        return {"rows": int(obj.shape[0]), "nnz": int(obj.nnz)}
+    return {"rows": None, "nnz": None}
+
+
+def get_profile_name(name: str) -> str:
+    """Returns a file name for the profile of a task.
+
+    Examples:
+        >>> get_profile_name("/out/tabularize/train/0/1d/code/count.npz")
+        'out_tabularize_train_0_1d_code_count.npz'
+    """
+    return re.sub(r"[^\w.-]+", "_", name).strip("_")
+
+
+class StageProfiler:
+    """Records the resource usage of the tasks of a stage and writes them to a report.
+
+    Tasks may run in several threads. CPU time is measured for the whole process, so it includes the work
+    of all concurrently running threads, and the peak resident set size is the high-water mark of the process
+    when the task ends.
+
+    Args:
+        stage: The name of the stage, e.g., ``tabularize_time_series``.
+        report_dir: The directory the report is written to.
+        profiler: If set, each task is also profiled with ``cprofile`` or ``pyinstrument`` (which must be
+            installed) and its profile written to ``{report_dir}/{report_stem}``. Nested tasks are only
+            profiled as part of the outermost task of their thread.
+        report_stem: The file name of the report, without suffix. Defaults to ``{stage}_profile``.
+
+    Raises:
+        ValueError: If the profiler is not supported.
+
+    Examples:
+        >>> import tempfile
+        >>> import numpy as np
+        >>> from scipy.sparse import csr_array
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     in_fp = Path(d) / "in.txt"
+        ...     _ = in_fp.write_text("abc")
+        ...     profiler = StageProfiler("example", Path(d) / "report", profiler="cprofile")
+        ...     with profiler.task("sum", in_fp=in_fp) as record:
+        ...         record.update(get_output_counts(csr_array(np.eye(3))))
+        ...     try:
+        ...         with profiler.task("fail"):
+        ...             raise KeyError("a")
+        ...     except KeyError:
+        ...         pass
+        ...     report_fp = profiler.save()
+        ...     report = pl.read_parquet(report_fp.with_suffix(".parquet"))
+        ...     summary = json.loads(report_fp.read_text())
+        ...     profiles = sorted(p.name for p in (Path(d) / "report" / "example_profile").iterdir())
+        >>> report.select("task", "status", "calls", "rows", "nnz", "bytes_read")
+        shape: (2, 6)
+        ┌──────┬──────────┬───────┬──────┬──────┬────────────┐
+        │ task ┆ status   ┆ calls ┆ rows ┆ nnz  ┆ bytes_read │
+        │ ---  ┆ ---      ┆ ---   ┆ ---  ┆ ---  ┆ ---        │
+        │ str  ┆ str      ┆ i64   ┆ i64  ┆ i64  ┆ i64        │
+        ╞══════╪══════════╪═══════╪══════╪══════╪════════════╡
+        │ sum  ┆ computed ┆ 1     ┆ 3    ┆ 3    ┆ 3          │
+        │ fail ┆ failed   ┆ 1     ┆ null ┆ null ┆ 0          │
+        └──────┴──────────┴───────┴──────┴──────┴────────────┘
+        >>> summary["stage"], summary["n_tasks"], summary["nnz"], len(summary["tasks"])
+        ('example', 2, 3, 2)
+        >>> profiles
+        ['0000_sum.prof', '0001_fail.prof']
+        >>> StageProfiler("example", ".", profiler="perf")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown profiler perf; expected one of cprofile, pyinstrument
+    """
+
+    def __init__(
+        self, stage: str, report_dir: Path | str, profiler: str | None = None, report_stem: str | None = None
+    ):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler}; expected one of {', '.join(PROFILERS)}")
+        self.stage = stage
+        self.report_dir = Path(report_dir)
+        self.profiler = profiler
+        self.report_stem = report_stem or f"{stage}_profile"
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = datetime.now()
+        self._start_wall_time = time.perf_counter()
+        self._start_cpu_time = time.process_time()
+
+    @contextmanager
+    def _profile(self, name: str) -> Iterator[dict]:
+        """Profiles the enclosed block, unless an enclosing task of the same thread is already profiled."""
+        profile = {}
+        if self.profiler is None or getattr(self._local, "profiling", False):
+            yield profile
+            return
+
+        with self._lock:
+            # profiled tasks are reported in the order they started, like their profiles are numbered
+            profile["index"] = len(self.records)
+            self.records.append(None)
+        profile_fp = self.report_dir / self.report_stem / f"{profile['index']:04d}_{get_profile_name(name)}"
+        profile_fp.parent.mkdir(parents=True, exist_ok=True)
+        if self.profiler == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            from pyinstrument import Profiler
+
+            profiler = Profiler()
+            profiler.start()
+        self._local.profiling = True
+        try:
+            yield profile
+        finally:
+            self._local.profiling = False
+            if self.profiler == "cprofile":
+                profiler.disable()
+                profile["profile_fp"] = str(profile_fp.with_suffix(".prof"))
+                profiler.dump_stats(profile["profile_fp"])
+            else:
+                profiler.stop()
+                profile["profile_fp"] = str(profile_fp.with_suffix(".html"))
+                Path(profile["profile_fp"]).write_text(profiler.output_html())
+
+    @contextmanager
+    def task(self, name: str, in_fp: Path | None = None, out_fp: Path | None = None) -> Iterator[dict]:
+        """Records the resource usage of the enclosed block as a task.
+
+        Args:
+            name: The name of the task, e.g., the output file it computes.
+            in_fp: The input file or directory of the task, whose size is counted as read.
+            out_fp: The output file of the task, whose size is counted as written if the task succeeds.
+
+        Yields:
+            The record of the task, in which the block can set the ``rows`` and ``nnz`` it processed (see
+            `get_output_counts`) and any other ``REPORT_SCHEMA`` fields. Tasks that raise are recorded with
+            the status ``failed``.
+        """
+        record = {"stage": self.stage, "task": name, "status": "computed", "calls": 1}
+        record["start"] = datetime.now()
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            with self._profile(name) as profile:
+                yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record.update(profile)
+            record["wall_time_s"] = time.perf_counter() - start_wall_time
+            record["cpu_time_s"] = time.process_time() - start_cpu_time
+            record["peak_rss_mb"] = get_peak_rss_mb()
+            record.setdefault("bytes_read", get_path_size(in_fp))
+            if record["status"] != "failed":
+                record.setdefault("bytes_written", get_path_size(out_fp))
+            self._add_record(record, profile.get("index", None))
+
+    def _add_record(self, record: dict, index: int | None = None):
+        with self._lock:
+            if index is None:
+                self.records.append(record)
+            else:
+                self.records[index] = record
+
+    def add_timings(self, name: str, timeable) -> None:
+        """Adds the timings of the methods of a `TimeableMixin` (e.g., a `TabularDataset`) to the report.
+
+        Each timed method is recorded as a task ``{name}.{method}`` with its number of calls and their total
+        wall time.
+
+        Examples:
+            >>> from mixins import TimeableMixin
+            >>> class Timed(TimeableMixin):
+            ...     @TimeableMixin.TimeAs
+            ...     def load(self):
+            ...         pass
+            >>> timed = Timed()
+            >>> for _ in range(3):
+            ...     timed.load()
+            >>> profiler = StageProfiler("example", ".")
+            >>> profiler.add_timings("dataset", timed)
+            >>> profiler.add_timings("untimed", object())
+            >>> profiler.get_report().select("task", "status", "calls")
+            shape: (1, 3)
+            ┌──────────────┬────────┬───────┐
+            │ task         ┆ status ┆ calls │
+            │ ---          ┆ ---    ┆ ---   │
+            │ str          ┆ str    ┆ i64   │
+            ╞══════════════╪════════╪═══════╡
+            │ dataset.load ┆ timed  ┆ 3     │
+            └──────────────┴────────┴───────┘
+        """
+        for key in getattr(timeable, "_timings", {}):
+            durations = timeable._times_for(key)
+            if durations:
+                record = {"stage": self.stage, "task": f"{name}.{key}", "status": "timed"}
+                self._add_record({**record, "calls": len(durations), "wall_time_s": sum(durations)})
+
+    def get_report(self) -> pl.DataFrame:
+        """Returns the records of the tasks, in the order they started (profiled tasks) or ended."""
+        records = [record for record in self.records if record is not None]
+        return pl.DataFrame(
+            [{k: record.get(k, None) for k in REPORT_SCHEMA} for record in records], schema=REPORT_SCHEMA
+        )
+
+    def get_summary(self) -> dict:
+        """Returns the totals of the stage so far, with its tasks."""
+        report = self.get_report()
+        tasks = report.filter(pl.col("status") != "timed")
+        return {
+            "stage": self.stage,
+            "start": self._start.isoformat(),
+            "wall_time_s": time.perf_counter() - self._start_wall_time,
+            "cpu_time_s": time.process_time() - self._start_cpu_time,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "n_tasks": tasks.height,
+            "n_failed_tasks": tasks.filter(pl.col("status") == "failed").height,
+            "rows": tasks["rows"].sum(),
+            "nnz": tasks["nnz"].sum(),
+            "bytes_read": tasks["bytes_read"].sum(),
+            "bytes_written": tasks["bytes_written"].sum(),
+            "tasks": report.with_columns(pl.col("start").dt.to_string("%Y-%m-%dT%H:%M:%S%.f")).to_dicts(),
+        }
+
+    def save(self) -> Path:
+        """Writes the summary with the tasks to ``{report_dir}/{report_stem}.json`` and the tasks to
+        ``{report_dir}/{report_stem}.parquet``.
+
+        Returns:
+            The path of the JSON report.
+        """
+        self.report_dir.mkdir(parents=True, exist_ok=True)
+        summary = self.get_summary()
+        report_fp = self.report_dir / f"{self.report_stem}.json"
+        report_fp.write_text(json.dumps(summary, indent=2))
+        self.get_report().write_parquet(report_fp.with_suffix(".parquet"))
+        logger.info(
+            f"Stage {self.stage} ran {summary['n_tasks']} tasks ({summary['n_failed_tasks']} failed) in "
+            f"{summary['wall_time_s']:.1f}s wall / {summary['cpu_time_s']:.1f}s CPU time with a peak RSS of "
+            f"{summary['peak_rss_mb']:.0f} MB; read {summary['bytes_read'] / 2**20:.1f} MB and wrote "
+            f"{summary['bytes_written'] / 2**20:.1f} MB. Profile written to {report_fp}"
+        )
+        return report_fp
+
+
+def get_active_profiler() -> StageProfiler | None:
+    """Returns the profiler of the running stage, if profiling is enabled."""
+    return _ACTIVE_PROFILER
+
+
+def set_active_profiler(profiler: StageProfiler | None) -> None:
+    """Sets the profiler that `profile_task` records tasks with, or disables profiling with None."""
+    global _ACTIVE_PROFILER
+    _ACTIVE_PROFILER = profiler
+
+
+def profile_task(name: str, in_fp: Path | None = None, out_fp: Path | None = None):
+    """Records the enclosed block as a task of the active profiler, if any (see `StageProfiler.task`).
+
+    Examples:
+        >>> with profile_task("untracked") as record:
+        ...     record["rows"] = 1
+        >>> profiler = StageProfiler("example", ".")
+        >>> set_active_profiler(profiler)
+        >>> with profile_task("tracked") as record:
+        ...     record["rows"] = 2
+        >>> set_active_profiler(None)
+        >>> profiler.get_report()["task"].to_list()
+        ['tracked']
+    """
+    profiler = get_active_profiler()
+    if profiler is None:
+        return nullcontext({})
+    return profiler.task(name, in_fp=in_fp, out_fp=out_fp)
+
+
+class StageProfilerCallback(Callback):
+    """Profiles each hydra job with a `StageProfiler` if ``profiling.enabled`` is set in its config."""
+
+    def on_job_start(self, config: DictConfig, **kwargs):
+        profiling_cfg = config.get("profiling", None)
+        if profiling_cfg is None or not profiling_cfg.enabled:
+            return
+        hydra_cfg = HydraConfig.get()
+        # all stages log to the same directory by default, so reports are named after their job
+        report_stem = f"{hydra_cfg.job.name}_profile"
+        if hydra_cfg.mode == RunMode.MULTIRUN:
+            report_stem = f"{hydra_cfg.job.name}_{hydra_cfg.job.num}_profile"
+        set_active_profiler(
+            StageProfiler(
+                current_script_name(),
+                profiling_cfg.report_dir or hydra_cfg.runtime.output_dir,
+                profiler=profiling_cfg.profiler,
+                report_stem=report_stem,
+            )
+        )
+
+    def on_job_end(self, config: DictConfig, job_return, **kwargs):
+        profiler = get_active_profiler()
+        if profiler is not None:
+            profiler.save()
+            set_active_profiler(None)
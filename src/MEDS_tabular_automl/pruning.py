@@ -0,0 +1,147 @@
+"""Median pruning of hyperparameter sweep trials based on intermediate tuning metrics.
+
+The hydra optuna sweeper launches each trial as an independent job and never exposes the optuna ``Trial``
+object to it, so trials cannot report intermediate values back to the study. Instead, trials that share a
+sweep record their per-step tuning metric curves in a shared directory, and a running trial is pruned when
+its best value so far falls below the median of the completed trials at the same step.
+"""
+
+import json
+import uuid
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from omegaconf import DictConfig
+
+
+class MedianPruner:
+    """Prunes a trial whose best intermediate value is below the median of completed trials.
+
+    Args:
+        history_dir: Directory shared by all trials of a sweep in which intermediate value curves are stored.
+        trial_name: Unique name of the current trial. A random name is used if not provided.
+        n_startup_trials: Pruning is disabled until this many trials have completed.
+        n_warmup_steps: Pruning is disabled for steps below this value.
+        interval_steps: Interval in number of steps between pruning checks.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as history_dir:
+        ...     for trial_name, values in [("a", [0.6, 0.7, 0.8]), ("b", [0.5, 0.6, 0.7])]:
+        ...         pruner = MedianPruner(history_dir, trial_name, n_startup_trials=2)
+        ...         for step, value in enumerate(values):
+        ...             pruner.report(step, value)
+        ...         pruner.complete()
+        ...     pruner = MedianPruner(history_dir, "c", n_startup_trials=2)
+        ...     pruner.report(0, 0.4)
+        ...     pruner.should_prune()
+        ...     pruner.report(1, 0.7)
+        ...     pruner.should_prune()
+        ...     pruner.complete(pruned=False)
+        ...     sorted(p.name for p in Path(history_dir).iterdir())
+        True
+        False
+        ['a.json', 'b.json', 'c.json']
+        >>> with tempfile.TemporaryDirectory() as history_dir:
+        ...     pruner = MedianPruner(history_dir, "a", n_startup_trials=0)
+        ...     pruner.report(0, 0.1)
+        ...     pruner.should_prune()
+        False
+    """
+
+    def __init__(
+        self,
+        history_dir: Path | str,
+        trial_name: str | None = None,
+        n_startup_trials: int = 5,
+        n_warmup_steps: int = 0,
+        interval_steps: int = 1,
+    ):
+        self.history_dir = Path(history_dir)
+        self.trial_name = trial_name if trial_name is not None else uuid.uuid4().hex
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_steps = n_warmup_steps
+        self.interval_steps = interval_steps
+        self.values: dict[int, float] = {}
+
+    def report(self, step: int, value: float):
+        """Records the intermediate value of the current trial at a given step."""
+        self.values[int(step)] = float(value)
+
+    def _load_completed_curves(self) -> list[dict[int, float]]:
+        """Loads the intermediate value curves of all completed (non-pruned) trials of the sweep."""
+        curves = []
+        for fp in self.history_dir.glob("*.json"):
+            if fp.stem == self.trial_name:
+                continue
+            try:
+                history = json.loads(fp.read_text())
+            except (OSError, json.JSONDecodeError):
+                continue
+            if history.get("pruned", False):
+                continue
+            curves.append({int(step): value for step, value in history["values"].items()})
+        return curves
+
+    def should_prune(self) -> bool:
+        """Returns whether the current trial should be pruned given the values reported so far."""
+        if not self.values:
+            return False
+        step = max(self.values)
+        if step < self.n_warmup_steps or (step - self.n_warmup_steps) % self.interval_steps != 0:
+            return False
+
+        curves = self._load_completed_curves()
+        if len(curves) < self.n_startup_trials:
+            return False
+
+        values_at_step = [curve[step] for curve in curves if step in curve]
+        if not values_at_step:
+            return False
+
+        best_so_far = max(self.values.values())
+        median = float(np.median(values_at_step))
+        if best_so_far < median:
+            logger.info(
+                f"Pruning trial {self.trial_name} at step {step}: best value {best_so_far:.4f} is below the "
+                f"median {median:.4f} of {len(values_at_step)} completed trials."
+            )
+            return True
+        return False
+
+    def complete(self, pruned: bool = False):
+        """Stores the intermediate value curve of the current trial for comparison by later trials."""
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        history = {"values": {str(step): value for step, value in self.values.items()}, "pruned": pruned}
+        (self.history_dir / f"{self.trial_name}.json").write_text(json.dumps(history))
+
+
+def get_pruner(cfg: DictConfig) -> MedianPruner | None:
+    """Builds the pruner of a model launcher configuration, or returns None if pruning is disabled.
+
+    Args:
+        cfg: The model launcher configuration. Pruning is configured via the optional ``pruning`` key and
+            intermediate values are stored in ``path.pruning_dir``.
+
+    Examples:
+        >>> get_pruner(DictConfig({"path": {"pruning_dir": "foo"}})) is None
+        True
+        >>> get_pruner(DictConfig({"pruning": {"enabled": False}})) is None
+        True
+        >>> pruner = get_pruner(DictConfig({
+        ...     "path": {"pruning_dir": "foo"},
+        ...     "pruning": {"enabled": True, "n_startup_trials": 2, "n_warmup_steps": 3, "interval_steps": 1},
+        ... }))
+        >>> pruner.history_dir, pruner.n_startup_trials, pruner.n_warmup_steps
+        (PosixPath('foo'), 2, 3)
+    """
+    pruning_cfg = cfg.get("pruning", None)
+    if pruning_cfg is None or not pruning_cfg.enabled:
+        return None
+    return MedianPruner(
+        cfg.path.pruning_dir,
+        n_startup_trials=pruning_cfg.n_startup_trials,
+        n_warmup_steps=pruning_cfg.n_warmup_steps,
+        interval_steps=pruning_cfg.interval_steps,
+    )
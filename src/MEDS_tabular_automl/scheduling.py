@@ -0,0 +1,353 @@
+"""Cost-ordered, file-system-backed task queues for spreading tabularization tasks over parallel workers.
+
+Workers of a stage (e.g., launched with ``worker="range(0,N)"``) all build the same task list, ordered from
+the most to the least expensive task, and atomically claim tasks from it through claim files in a shared
+queue directory. As long running tasks are started first and every worker takes the next unclaimed task as
+soon as it is free, the workers finish close together instead of waiting on a few stragglers. Task costs are
+estimated by `TaskCostModel` from the parquet metadata of the shards and the measured costs of the
+aggregations in previous runs, which also yields an estimate of the remaining time of the stage. Claims are
+only held while a task runs and are broken if their owner dies (see `mapper.acquire_lock`), so tasks of
+crashed workers are picked up again by the others.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+import uuid
+from collections.abc import Callable, Hashable, Iterator, Sequence
+from datetime import timedelta
+from pathlib import Path
+from typing import TypeVar
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow.parquet as pq
+from loguru import logger
+
+from .mapper import (
+    LOCK_HEARTBEAT_INTERVAL,
+    LOCK_STALE_AFTER,
+    LockHeartbeat,
+    acquire_lock,
+    release_lock,
+)
+
+TASK_T = TypeVar("TASK_T", bound=Hashable)
+
+# Relative costs per aggregated event of the aggregations of `generate_summarized_reps.sparse_aggregate`
+DEFAULT_AGG_COSTS = {
+    "count": 1.0,
+    "present": 1.0,
+    "first": 1.0,
+    "sum": 1.5,
+    "sum_sqd": 2.0,
+    "min": 3.0,
+    "max": 3.0,
+}
+
+
+def get_window_days(window_size: str) -> float:
+    """Returns the length of a rolling window in days.
+
+    Examples:
+        >>> get_window_days("1d"), get_window_days("12h"), get_window_days("full")
+        (1.0, 0.5, inf)
+    """
+    if window_size == "full":
+        return math.inf
+    # pandas deprecated the lowercase day unit
+    return pd.Timedelta(window_size.replace("d", "D")) / pd.Timedelta(days=1)
+
+
+def get_shard_stats(shard_fp: Path) -> dict[str, float]:
+    """Reads the number of events, the number of subjects and the time span of a MEDS shard.
+
+    The number of events and the time span are read from the parquet footer (row counts and row group
+    statistics of the ``time`` column), so only the ``subject_id`` column is read to count the subjects.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> shard_df = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2],
+        ...     "time": [None, datetime(2020, 1, 1), datetime(2020, 1, 3), None, datetime(2020, 1, 11)],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp = Path(d) / "0.parquet"
+        ...     shard_df.write_parquet(shard_fp)
+        ...     get_shard_stats(shard_fp)
+        {'n_rows': 5, 'n_subjects': 2, 'span_days': 10.0}
+    """
+    metadata = pq.ParquetFile(shard_fp).metadata
+    time_idx = metadata.schema.names.index("time")
+    min_time, max_time = None, None
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(time_idx).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        min_time = stats.min if min_time is None else min(min_time, stats.min)
+        max_time = stats.max if max_time is None else max(max_time, stats.max)
+    span_days = 0.0 if min_time is None else (max_time - min_time) / timedelta(days=1)
+    n_subjects = pl.scan_parquet(shard_fp).select(pl.col("subject_id").n_unique()).collect().item()
+    return {"n_rows": metadata.num_rows, "n_subjects": n_subjects, "span_days": span_days}
+
+
+class TaskCostModel:
+    """Estimates the cost of tabularizing a shard over a window with an aggregation.
+
+    The cost of a task is the number of events of the shard times the average number of events aggregated per
+    event, which grows with the window size up to the number of events per subject, times the cost of the
+    aggregation per event. The per-aggregation costs start from the relative `DEFAULT_AGG_COSTS` and are
+    replaced by the seconds per event measured in previous runs (see `record`), which are stored in
+    ``history_fp``, so that estimates of later runs are in seconds. The shard statistics (see
+    `get_shard_stats`) are stored there as well, keyed by the shard path, size and modification time, so
+    that the workers of later runs do not scan the shards again.
+
+    Args:
+        history_fp: The JSON file in which the measured per-aggregation costs and the shard statistics are
+            stored. If None, only the default costs are used.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> shard_df = pl.DataFrame({
+        ...     "subject_id": [1] * 10 + [2] * 10,
+        ...     "time": [datetime(2020, 1, 1 + i) for i in range(10)] * 2,
+        ... })
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp, history_fp = Path(d) / "0.parquet", Path(d) / "task_costs.json"
+        ...     shard_df.write_parquet(shard_fp)
+        ...     cost_model = TaskCostModel(history_fp)
+        ...     cost_model.estimate(shard_fp, "none", "static/present")
+        ...     [round(cost_model.estimate(shard_fp, w, "code/count"), 1) for w in ("1d", "9d", "full")]
+        ...     min_cost = cost_model.estimate(shard_fp, "1d", "value/min")
+        ...     min_cost > cost_model.estimate(shard_fp, "1d", "value/sum")
+        ...     cost_model.record(shard_fp, "full", "code/count", seconds=22.0)
+        ...     cost_model.save()
+        ...     cost_model = TaskCostModel(history_fp)
+        ...     cost_model.estimate(shard_fp, "full", "code/count")
+        ...     round(cost_model.estimate(shard_fp, "full", "value/min"), 1)
+        ...     list(cost_model.shard_history) == [str(shard_fp.resolve())]
+        20.0
+        [42.2, 220.0, 220.0]
+        True
+        22.0
+        66.0
+        True
+    """
+
+    def __init__(self, history_fp: Path | str | None = None):
+        self.history_fp = None if history_fp is None else Path(history_fp)
+        self.history: dict[str, dict[str, float]] = {}
+        self.shard_history: dict[str, dict] = {}
+        if self.history_fp is not None and self.history_fp.is_file():
+            stored = json.loads(self.history_fp.read_text())
+            self.history = stored.get("aggs", {})
+            self.shard_history = stored.get("shards", {})
+        self._shard_stats: dict[Path, dict[str, float]] = {}
+
+    def shard_stats(self, shard_fp: Path) -> dict[str, float]:
+        """Returns the statistics of a shard, reading them only if they are not stored for its version."""
+        shard_fp = Path(shard_fp)
+        if shard_fp not in self._shard_stats:
+            key = str(shard_fp.resolve())
+            stat = shard_fp.stat()
+            signature = [stat.st_size, stat.st_mtime_ns]
+            stored = self.shard_history.get(key)
+            if stored is None or stored["signature"] != signature:
+                stored = {"signature": signature, "stats": get_shard_stats(shard_fp)}
+                self.shard_history[key] = stored
+            self._shard_stats[shard_fp] = stored["stats"]
+        return self._shard_stats[shard_fp]
+
+    def get_n_units(self, shard_fp: Path, window_size: str) -> float:
+        """Returns the number of events times the average number of events aggregated per event."""
+        stats = self.shard_stats(shard_fp)
+        if window_size == "none":
+            return float(stats["n_rows"])
+        events_per_subject = stats["n_rows"] / max(stats["n_subjects"], 1)
+        window_fraction = 1.0
+        if stats["span_days"] > 0:
+            window_fraction = min(1.0, get_window_days(window_size) / stats["span_days"])
+        return stats["n_rows"] * (1.0 + events_per_subject * window_fraction)
+
+    def get_agg_cost(self, agg: str) -> float:
+        """Returns the measured seconds per unit of an aggregation, or its scaled default relative cost."""
+        if agg in self.history:
+            return self.history[agg]["seconds"] / self.history[agg]["units"]
+        default_cost = DEFAULT_AGG_COSTS.get(agg.split("/")[-1], 1.0)
+        if not self.history:
+            return default_cost
+        scales = [
+            (h["seconds"] / h["units"]) / DEFAULT_AGG_COSTS.get(a.split("/")[-1], 1.0)
+            for a, h in self.history.items()
+        ]
+        return default_cost * float(np.mean(scales))
+
+    def estimate(self, shard_fp: Path, window_size: str, agg: str) -> float:
+        """Estimates the cost of a task."""
+        return self.get_n_units(shard_fp, window_size) * self.get_agg_cost(agg)
+
+    def record(self, shard_fp: Path, window_size: str, agg: str, seconds: float):
+        """Records the measured duration of a task to refine the cost of its aggregation."""
+        agg_history = self.history.setdefault(agg, {"seconds": 0.0, "units": 0.0})
+        agg_history["seconds"] += seconds
+        agg_history["units"] += self.get_n_units(shard_fp, window_size)
+
+    def save(self):
+        """Stores the measured per-aggregation costs and the shard statistics for later runs.
+
+        Parallel workers each store the costs of previous runs plus their own measurements, so the last worker
+        to finish wins; this loses some measurements but never mixes up partially written files.
+        """
+        if self.history_fp is None:
+            return
+        self.history_fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fp = self.history_fp.with_name(f".{self.history_fp.name}.{uuid.uuid4().hex}")
+        stored = {"aggs": self.history, "shards": self.shard_history}
+        tmp_fp.write_text(json.dumps(stored, indent=2, sort_keys=True))
+        os.replace(tmp_fp, self.history_fp)
+
+
+def get_task_id(task: Hashable) -> str:
+    """Returns a stable, file-name-safe identifier of a task.
+
+    Examples:
+        >>> get_task_id(("train/0", "1d", "code/count")) == get_task_id(("train/0", "1d", "code/count"))
+        True
+        >>> len(get_task_id("foo"))
+        16
+    """
+    return hashlib.sha256(repr(task).encode()).hexdigest()[:16]
+
+
+class TaskQueue:
+    """Iterates over the tasks of a stage in decreasing order of cost, claiming each task atomically.
+
+    Every worker iterating over a queue with the same tasks and ``queue_dir`` skips the tasks that other
+    workers are running at that moment. Claims are only held while a task runs, so tasks that were already
+    finished by another worker are still yielded, and `mapper.wrap` returns their up-to-date outputs right
+    away. Tasks claimed by other workers are revisited on a second pass once all other tasks were claimed,
+    so that a task whose claim was released by a worker that crashed is picked up again. Callers mark the
+    tasks they actually compute with `mark_computed`, so that skipped tasks do not inflate the estimated
+    throughput.
+
+    Args:
+        queue_dir: The directory, shared by all workers of the stage, holding the task claims.
+        tasks: The tasks to run.
+        cost_fn: A function estimating the relative cost of a task. Ties are broken by the task order.
+        heartbeat_interval: The number of seconds between heartbeats of the held claim.
+        stale_after: The number of seconds without a heartbeat after which another worker may break a claim.
+
+    Examples:
+        >>> import tempfile
+        >>> tasks = ["a", "bbb", "cc", "dddd"]
+        >>> with tempfile.TemporaryDirectory() as queue_dir:
+        ...     list(TaskQueue(queue_dir, tasks, cost_fn=len))
+        ['dddd', 'bbb', 'cc', 'a']
+        >>> with tempfile.TemporaryDirectory() as queue_dir:
+        ...     other_worker = iter(TaskQueue(queue_dir, tasks, len))
+        ...     next(other_worker)  # Another worker is running the most expensive task
+        ...     list(TaskQueue(queue_dir, tasks, len))
+        'dddd'
+        ['bbb', 'cc', 'a']
+        >>> with tempfile.TemporaryDirectory() as queue_dir:
+        ...     other_worker = iter(TaskQueue(queue_dir, tasks, len))
+        ...     next(other_worker)
+        ...     claimed = []
+        ...     for task in TaskQueue(queue_dir, tasks, len):
+        ...         if task == "a":  # The other worker crashes before finishing its task
+        ...             other_worker.close()
+        ...         claimed.append(task)
+        ...     claimed
+        'dddd'
+        ['bbb', 'cc', 'a', 'dddd']
+    """
+
+    def __init__(
+        self,
+        queue_dir: Path | str,
+        tasks: Sequence[TASK_T],
+        cost_fn: Callable[[TASK_T], float],
+        heartbeat_interval: float = LOCK_HEARTBEAT_INTERVAL,
+        stale_after: float = LOCK_STALE_AFTER,
+    ):
+        self.queue_dir = Path(queue_dir)
+        costs = [cost_fn(task) for task in tasks]
+        order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+        self.tasks = [tasks[i] for i in order]
+        self.costs = [costs[i] for i in order]
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._computed = False
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    def _run_claimed(self, task: TASK_T) -> Iterator[TASK_T] | None:
+        claim = acquire_lock(self.queue_dir / get_task_id(task), stale_after=self.stale_after)
+        if claim is None:
+            return None
+        return self._hold(task, claim)
+
+    def _hold(self, task: TASK_T, claim: tuple[Path, str]) -> Iterator[TASK_T]:
+        try:
+            with LockHeartbeat(claim[0], self.heartbeat_interval):
+                yield task
+        finally:
+            release_lock(*claim)
+
+    def count_active_claims(self) -> int:
+        """Returns the number of tasks currently claimed by any worker."""
+        return sum(1 for _ in self.queue_dir.glob("*/locks/lock.json"))
+
+    def mark_computed(self):
+        """Marks the task currently held as computed, rather than skipped because its output was up to date.
+
+        Only the costs and durations of computed tasks count towards the throughput used to estimate the
+        remaining time of the stage.
+        """
+        self._computed = True
+
+    def log_progress(self, n_done: int, done_cost: float, remaining_cost: float, elapsed: float, busy: float):
+        """Logs the progress of this worker and the estimated time until all workers finish the stage.
+
+        The estimate divides the cost of the tasks not yet visited by this worker by this worker's throughput
+        (in cost units per second of computing tasks marked with `mark_computed`) and by the number of workers
+        currently running tasks.
+        """
+        message = f"Visited {n_done}/{len(self)} tasks in {timedelta(seconds=round(elapsed))}"
+        if done_cost > 0:
+            n_workers = max(self.count_active_claims(), 1)
+            eta = timedelta(seconds=round(remaining_cost * busy / done_cost / n_workers))
+            message += f"; estimated time remaining with {n_workers} active workers: {eta}"
+        logger.info(message)
+
+    def __iter__(self) -> Iterator[TASK_T]:
+        start = time.monotonic()
+        done_cost, busy = 0.0, 0.0
+        remaining_cost = float(sum(self.costs))
+        deferred = []
+        for i, (task, cost) in enumerate(zip(self.tasks, self.costs)):
+            remaining_cost -= cost
+            held = self._run_claimed(task)
+            if held is None:
+                deferred.append(task)
+                continue
+            self._computed = False
+            task_start = time.monotonic()
+            yield from held
+            if self._computed:
+                done_cost += cost
+                busy += time.monotonic() - task_start
+            self.log_progress(i + 1, done_cost, remaining_cost, time.monotonic() - start, busy)
+
+        if deferred:
+            logger.info(f"Revisiting {len(deferred)} tasks that were claimed by other workers.")
+        for task in deferred:
+            held = self._run_claimed(task)
+            if held is not None:
+                yield from held
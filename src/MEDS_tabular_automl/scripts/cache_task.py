@@ -5,24 +5,24 @@ from importlib.resources import files
 from pathlib import Path
 
 import hydra
-import numpy as np
 import polars as pl
 import scipy.sparse as sp
 from loguru import logger
 from omegaconf import DictConfig
 
-from ..describe_codes import filter_parquet, get_feature_columns
+from ..describe_codes import CodeFilter, filter_parquet, get_feature_columns
 from ..file_name import list_subdir_files
 from ..mapper import wrap as rwlock_wrap
+from ..scheduling import TaskQueue
 from ..utils import (
     CODE_AGGREGATIONS,
     STATIC_CODE_AGGREGATION,
     STATIC_VALUE_AGGREGATION,
     VALUE_AGGREGATIONS,
-    get_events_df,
+    get_label_events_df,
     get_shard_prefix,
-    get_unique_time_events_df,
     hydra_loguru_init,
+    load_label_df,
     load_matrix,
     load_tqdm,
     stage_init,
@@ -95,7 +95,7 @@ def main(cfg: DictConfig):
         hydra_loguru_init()
     # Produce ts representation
 
-    # shuffle tasks
+    # order tasks from the largest to the smallest matrix and claim them through a queue shared by all workers
     tabularization_tasks = list_subdir_files(cfg.input_tabularized_dir, "npz")
     if len(tabularization_tasks) == 0:
         raise FileNotFoundError(
@@ -103,26 +103,15 @@ def main(cfg: DictConfig):
             "is likely incorrect"
         )
 
-    np.random.shuffle(tabularization_tasks)
-
-    label_dir = Path(cfg.input_label_dir)
-    if not label_dir.exists():
-        raise FileNotFoundError(
-            f"Label directory {label_dir} does not exist, please check the `input_label_dir` kwarg"
-        )
-    label_df = (
-        pl.scan_parquet(label_dir / "**/*.parquet")
-        .rename(
-            {
-                "prediction_time": "time",
-                cfg.label_column: "label",
-            }
-        )
-        .group_by(pl.col("subject_id", "time"), maintain_order=True)
-        .first()
+    tabularization_tasks = TaskQueue(
+        Path(cfg.task_queue_dir), tabularization_tasks, cost_fn=lambda data_fp: data_fp.stat().st_size
     )
 
+    label_df = load_label_df(cfg.input_label_dir, cfg.label_column)
+
     feature_columns = get_feature_columns(cfg.tabularization.filtered_code_metadata_fp)
+    # the allowed codes are parsed once and applied to every shard while it is scanned
+    code_filter = CodeFilter(cfg.tabularization._resolved_codes)
 
     # iterate through them
     for data_fp in iter_wrapper(tabularization_tasks):
@@ -140,18 +129,7 @@ def main(cfg: DictConfig):
                     f"'numeric_value' column not found in raw data {meds_data_fp}. "
                     "You are maybe loading labels instead of meds data"
                 )
-            return filter_parquet(meds_data_fp, cfg.tabularization._resolved_codes)
-
-        def extract_labels(meds_data_df):
-            meds_data_df = (
-                get_unique_time_events_df(get_events_df(meds_data_df, feature_columns))
-                .with_row_index("event_id")
-                .select("subject_id", "time", "event_id")
-            )
-            shard_label_df = label_df.join(
-                meds_data_df.select("subject_id").unique(), on="subject_id", how="inner"
-            ).join_asof(other=meds_data_df, by="subject_id", on="time")
-            return shard_label_df
+            return filter_parquet(meds_data_fp, code_filter)
 
         def read_fn(in_fp_tuple):
             meds_data_fp, data_fp = in_fp_tuple
@@ -160,7 +138,7 @@ def main(cfg: DictConfig):
                 logger.info(f"Extracting labels for {shard_label_fp}")
                 Path(shard_label_fp).parent.mkdir(parents=True, exist_ok=True)
                 meds_data_df = read_meds_data_df(meds_data_fp)
-                extracted_events = extract_labels(meds_data_df)
+                extracted_events = get_label_events_df(label_df, meds_data_df, feature_columns)
                 write_lazyframe(extracted_events, shard_label_fp)
             else:
                 logger.info(f"Labels already exist, reading from {shard_label_fp}")
@@ -169,6 +147,7 @@ def main(cfg: DictConfig):
             return shard_label_df, matrix
 
         def compute_fn(input_tuple):
+            tabularization_tasks.mark_computed()
             shard_label_df, matrix = input_tuple
             row_cached_matrix = generate_row_cached_matrix(matrix=matrix, label_df=shard_label_df)
             return row_cached_matrix
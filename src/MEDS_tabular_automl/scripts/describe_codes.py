@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 """This Python script, stores the configuration parameters and feature columns used in the output."""
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from importlib.resources import files
 from pathlib import Path
 
@@ -11,11 +11,19 @@ from loguru import logger
 from omegaconf import DictConfig
 
 from ..describe_codes import (
+    compute_code_stats,
     compute_feature_frequencies,
-    convert_to_df,
-    convert_to_freq_dict,
+    merge_code_stats,
+    sum_feature_frequencies,
 )
 from ..file_name import list_subdir_files
+from ..manifest import (
+    diff_manifests,
+    get_shard_manifest,
+    load_manifest,
+    log_shard_changes,
+    write_manifest,
+)
 from ..mapper import wrap as rwlock_wrap
 from ..utils import get_shard_prefix, hydra_loguru_init, load_tqdm, stage_init, write_df
 
@@ -46,53 +54,108 @@ def main(cfg: DictConfig):
     def read_fn(in_fp):
         return pl.scan_parquet(in_fp)
 
-    # Map: Iterates through shards and caches feature frequencies
-    train_shards = list_subdir_files(cfg.input_dir, "parquet")
-    np.random.shuffle(train_shards)
-    for shard_fp in iter_wrapper(train_shards):
-        out_fp = (Path(cfg.cache_dir) / get_shard_prefix(cfg.input_dir, shard_fp)).with_suffix(
-            shard_fp.suffix
-        )
+    code_stats_cfg = cfg.get("code_stats", None)
+    compute_stats = code_stats_cfg is not None and code_stats_cfg.enabled
+
+    # Incremental runs only recompute the frequencies of shards added or changed since the last run and then
+    # re-reduce the cached per-shard frequencies.
+    manifest_fp = Path(cfg.manifest_fp)
+    shard_manifest = get_shard_manifest(cfg.input_dir, cfg.use_content_hash)
+    update_shards = set()
+    do_overwrite_reduce = cfg.do_overwrite
+    if cfg.incremental:
+        changes = diff_manifests(load_manifest(manifest_fp)["shards"], shard_manifest)
+        log_shard_changes(changes, len(shard_manifest))
+        update_shards = set(changes["added"]) | set(changes["changed"])
+        shard_cache_dirs = [cfg.cache_dir] + ([code_stats_cfg.cache_dir] if compute_stats else [])
+        for shard_prefix in changes["removed"]:
+            for shard_cache_dir in shard_cache_dirs:
+                (Path(shard_cache_dir) / shard_prefix).with_suffix(".parquet").unlink(missing_ok=True)
+        do_overwrite_reduce = do_overwrite_reduce or any(changes.values())
+
+    def compute_stats_fn(shard_df):
+        return compute_code_stats(shard_df, code_stats_cfg.n_quantiles)
+
+    def map_shard(shard_fp):
+        shard_prefix = get_shard_prefix(cfg.input_dir, shard_fp)
+        do_overwrite = cfg.do_overwrite or shard_prefix in update_shards
+        out_fp = (Path(cfg.cache_dir) / shard_prefix).with_suffix(shard_fp.suffix)
         rwlock_wrap(
             shard_fp,
             out_fp,
             read_fn,
             write_fn,
             compute_feature_frequencies,
-            do_overwrite=cfg.do_overwrite,
+            do_overwrite=do_overwrite,
             do_return=False,
+            manifest_key="compute_feature_frequencies",
         )
+        if compute_stats and shard_prefix.split("/")[0] in code_stats_cfg.splits:
+            rwlock_wrap(
+                shard_fp,
+                (Path(code_stats_cfg.cache_dir) / shard_prefix).with_suffix(shard_fp.suffix),
+                read_fn,
+                write_fn,
+                compute_stats_fn,
+                do_overwrite=do_overwrite,
+                do_return=False,
+                manifest_key=f"compute_code_stats/n_quantiles={code_stats_cfg.n_quantiles}",
+            )
+
+    # Map: Iterates through shards and caches feature frequencies. Polars releases the GIL while scanning, so
+    # shards are processed by a thread pool.
+    train_shards = list_subdir_files(cfg.input_dir, "parquet")
+    np.random.shuffle(train_shards)
+    n_workers = cfg.get("n_workers", 1)
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for _ in iter_wrapper(executor.map(map_shard, train_shards)):
+                pass
+    else:
+        for shard_fp in iter_wrapper(train_shards):
+            map_shard(shard_fp)
 
     logger.info("Summing frequency computations.")
-    # Reduce: sum the frequency computations
-
-    def compute_fn(freq_df_list):
-        feature_freqs = defaultdict(int)
-        for shard_freq_df in freq_df_list:
-            shard_freq_dict = convert_to_freq_dict(shard_freq_df)
-            for feature, freq in shard_freq_dict.items():
-                feature_freqs[feature] += freq
-        feature_df = convert_to_df(feature_freqs)
-        return feature_df
-
-    def write_fn(df, out_fp):
-        write_df(df, out_fp)
+    # Reduce: sum the frequency computations with a single lazy scan over all shard outputs
 
-    def read_fn(feature_dir):
-        files = list_subdir_files(feature_dir, "parquet")
-        return [pl.scan_parquet(fp) for fp in files]
+    def read_all_fn(feature_dir):
+        return pl.scan_parquet(list_subdir_files(feature_dir, "parquet"))
 
     rwlock_wrap(
         Path(cfg.cache_dir),
         Path(cfg.output_filepath),
-        read_fn,
+        read_all_fn,
         write_fn,
-        compute_fn,
-        do_overwrite=cfg.do_overwrite,
+        sum_feature_frequencies,
+        do_overwrite=do_overwrite_reduce,
         do_return=False,
+        manifest_key="sum_feature_frequencies",
     )
     logger.info("Stored feature columns and frequencies.")
 
+    if compute_stats:
+        logger.info("Merging per-code statistics.")
+
+        def read_stats_fn(stats_dir):
+            return pl.scan_parquet(list_subdir_files(stats_dir, "parquet"), include_file_paths="shard")
+
+        def merge_stats_fn(stats_df):
+            return merge_code_stats(stats_df, code_stats_cfg.n_quantiles)
+
+        rwlock_wrap(
+            Path(code_stats_cfg.cache_dir),
+            Path(code_stats_cfg.output_filepath),
+            read_stats_fn,
+            write_fn,
+            merge_stats_fn,
+            do_overwrite=do_overwrite_reduce,
+            do_return=False,
+            manifest_key=f"merge_code_stats/n_quantiles={code_stats_cfg.n_quantiles}",
+        )
+        logger.info("Stored per-code statistics.")
+
+    write_manifest({"shards": shard_manifest}, manifest_fp)
+
 
 if __name__ == "__main__":
     main()
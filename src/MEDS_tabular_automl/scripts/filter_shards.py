@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Writes the MEDS shards once, filtered to the allowed codes, for the tabularization stages to share."""
+from importlib.resources import files
+
+import hydra
+from loguru import logger
+from omegaconf import DictConfig
+
+from ..describe_codes import CodeFilter, filter_parquet
+from ..file_name import list_subdir_files
+from ..manifest import hash_codes
+from ..mapper import wrap as rwlock_wrap
+from ..shard_cache import (
+    encode_filtered_shard,
+    get_filtered_shard_fp,
+    write_filtered_shard,
+)
+from ..utils import hydra_loguru_init, load_tqdm, stage_init
+
+config_yaml = files("MEDS_tabular_automl").joinpath("configs/tabularization.yaml")
+if not config_yaml.is_file():
+    raise FileNotFoundError("Core configuration not successfully installed!")
+
+
+@hydra.main(version_base=None, config_path=str(config_yaml.parent.resolve()), config_name=config_yaml.stem)
+def main(cfg: DictConfig):
+    """Writes each MEDS shard, filtered to the allowed codes, to ``filtered_shards_dir``.
+
+    Each shard is filtered like in `filter_parquet`, sorted by subject and time, has its codes encoded as ids
+    into the allowed codes, and is written as an uncompressed Arrow IPC file (see `shard_cache`). With
+    ``use_filtered_shards=True``, `meds-tab-tabularize-static` and `meds-tab-tabularize-time-series` then
+    memory-map these files rather than scanning and filtering the raw shard in each of their tasks. Filtered
+    shards are rewritten when their shard or the allowed codes change, and several workers can write them
+    in parallel.
+
+    This stage runs after the allowed codes are resolved, i.e., after `meds-tab-describe`, or after the code
+    filtering step of `meds-tab-tabularize-static` if ``tabularization.filtered_code_metadata_fp`` is not
+    the code metadata file itself.
+
+    Args:
+        cfg: The configuration for tabularization, loaded from a YAML file.
+    """
+    stage_init(cfg, ["input_dir", "tabularization.filtered_code_metadata_fp"])
+    iter_wrapper = load_tqdm(cfg.tqdm)
+    if not cfg.loguru_init:
+        hydra_loguru_init()
+
+    resolved_codes = cfg.tabularization._resolved_codes
+    code_filter = CodeFilter(resolved_codes)
+    codes_hash = hash_codes(resolved_codes)
+
+    def read_fn(in_fp):
+        return encode_filtered_shard(filter_parquet(in_fp, code_filter), code_filter)
+
+    meds_shard_fps = list_subdir_files(cfg.input_dir, "parquet")
+    for shard_fp in iter_wrapper(meds_shard_fps):
+        rwlock_wrap(
+            shard_fp,
+            get_filtered_shard_fp(cfg.filtered_shards_dir, cfg.input_dir, shard_fp),
+            read_fn,
+            write_filtered_shard,
+            cache_intermediate=None,
+            do_overwrite=cfg.do_overwrite,
+            do_return=False,
+            manifest_key=codes_hash,
+        )
+    logger.info(f"Filtered {len(meds_shard_fps)} shards to {len(code_filter.codes)} codes")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@ from importlib.resources import files
 from pathlib import Path
 
 import hydra
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from loguru import logger
 from omegaconf import DictConfig, OmegaConf
 
@@ -28,6 +30,96 @@ def check_autogluon():
         )
 
 
+def select_top_k_features(data: sp.spmatrix, k: int | None) -> np.ndarray:
+    """Selects the indices of the ``k`` features with the most non-zero values.
+
+    Args:
+        data: The sparse feature matrix used for the selection, typically the training data.
+        k: The number of features to keep. If None or at least the number of features, all are kept.
+
+    Returns:
+        The sorted indices of the selected feature columns.
+
+    Examples:
+        >>> data = sp.csr_matrix(np.array([[1, 0, 2, 0], [0, 0, 3, 1], [4, 0, 5, 0]]))
+        >>> select_top_k_features(data, 2)
+        array([0, 2])
+        >>> select_top_k_features(data, None)
+        array([0, 1, 2, 3])
+        >>> select_top_k_features(data, 0)
+        Traceback (most recent call last):
+            ...
+        ValueError: top_k_features must be positive, got 0
+    """
+    n_features = data.shape[1]
+    if k is None or k >= n_features:
+        return np.arange(n_features)
+    if k < 1:
+        raise ValueError(f"top_k_features must be positive, got {k}")
+    nnz_per_feature = np.diff(sp.csc_matrix(data).indptr)
+    top_k = np.argpartition(-nnz_per_feature, k - 1)[:k]
+    return np.sort(top_k)
+
+
+def sparse_to_dataframe(
+    data: sp.spmatrix,
+    feature_idxs: np.ndarray | None = None,
+    data_format: str = "sparse",
+    chunk_columns: int = 1024,
+) -> pd.DataFrame:
+    """Converts a sparse feature matrix to a float32 DataFrame without a float64 dense copy.
+
+    Args:
+        data: The sparse feature matrix.
+        feature_idxs: The indices of the feature columns to keep. All columns are kept if None.
+        data_format: "sparse" to build pandas ``SparseDtype`` columns, or "dense" to densify to float32. The
+            dense frame holds every selected column, so its memory is only reduced by selecting fewer features
+            (see `select_top_k_features`).
+        chunk_columns: The number of columns densified at once when ``data_format`` is "dense". Each batch is
+            written into the preallocated float32 frame, so the densification only needs one batch of memory
+            on top of the frame.
+
+    Returns:
+        A DataFrame with one float32 column per selected feature, named by the feature index.
+
+    Examples:
+        >>> data = sp.csr_matrix(np.array([[1, 0, 2], [0, 0, 3]]))
+        >>> df = sparse_to_dataframe(data, np.array([0, 2]))
+        >>> df.dtypes.tolist()
+        [Sparse[float32, 0.0], Sparse[float32, 0.0]]
+        >>> df.sparse.to_dense().values.tolist()
+        [[1.0, 2.0], [0.0, 3.0]]
+        >>> df = sparse_to_dataframe(data, data_format="dense", chunk_columns=2)
+        >>> df.columns.tolist(), df.dtypes.unique().tolist(), df.values.tolist()
+        ([0, 1, 2], [dtype('float32')], [[1.0, 0.0, 2.0], [0.0, 0.0, 3.0]])
+        >>> sparse_to_dataframe(data, data_format="foo")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown data_format foo; expected one of 'sparse' or 'dense'
+    """
+    data = sp.csc_matrix(data, dtype=np.float32)
+    if feature_idxs is None:
+        feature_idxs = np.arange(data.shape[1])
+    else:
+        data = data[:, feature_idxs]
+    columns = [int(i) for i in feature_idxs]
+
+    if data_format == "sparse":
+        # `pd.DataFrame.sparse.from_spmatrix` uses NaN as the fill value for float data, so the columns are
+        # built one at a time to keep unobserved entries as zeros, matching the dense representation.
+        arrays = {
+            col: pd.arrays.SparseArray.from_spmatrix(data[:, i : i + 1]) for i, col in enumerate(columns)
+        }
+        return pd.DataFrame(arrays)
+    elif data_format == "dense":
+        dense = np.empty(data.shape, dtype=np.float32)
+        for start in range(0, data.shape[1], chunk_columns):
+            dense[:, start : start + chunk_columns] = data[:, start : start + chunk_columns].toarray()
+        return pd.DataFrame(dense, columns=columns, copy=False)
+    else:
+        raise ValueError(f"Unknown data_format {data_format}; expected one of 'sparse' or 'dense'")
+
+
 @hydra.main(version_base=None, config_path=str(config_yaml.parent.resolve()), config_name=config_yaml.stem)
 def main(cfg: DictConfig) -> float:
     """Launches AutoGluon after collecting data based on the provided configuration.
@@ -52,14 +144,17 @@ def main(cfg: DictConfig) -> float:
     tuning_data, tuning_labels = ituning.densify()
     held_out_data, held_out_labels = iheld_out.densify()
 
-    # construct dfs for AutoGluon
-    train_df = pd.DataFrame(train_data.todense())
+    # construct dfs for AutoGluon, keeping the data sparse or densifying it in float32 column batches
+    feature_idxs = select_top_k_features(train_data, cfg.model_launcher.top_k_features)
+    logger.info(f"Using {len(feature_idxs)} of {train_data.shape[1]} features for AutoGluon.")
+    data_format = cfg.model_launcher.data_format
+    chunk_columns = cfg.model_launcher.dense_chunk_columns
+
+    train_df = sparse_to_dataframe(train_data, feature_idxs, data_format, chunk_columns)
     train_df[cfg.task_name] = train_labels
-    tuning_df = pd.DataFrame(
-        tuning_data.todense(),
-    )
+    tuning_df = sparse_to_dataframe(tuning_data, feature_idxs, data_format, chunk_columns)
     tuning_df[cfg.task_name] = tuning_labels
-    held_out_df = pd.DataFrame(held_out_data.todense())
+    held_out_df = sparse_to_dataframe(held_out_data, feature_idxs, data_format, chunk_columns)
     held_out_df[cfg.task_name] = held_out_labels
 
     train_dataset = ag.TabularDataset(train_df)
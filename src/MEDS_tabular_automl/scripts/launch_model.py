@@ -8,6 +8,7 @@ from omegaconf import DictConfig, OmegaConf
 
 from MEDS_tabular_automl.base_model import BaseModel
 
+from ..profiling import get_active_profiler, profile_task
 from ..utils import hydra_loguru_init, stage_init
 
 config_yaml = files("MEDS_tabular_automl").joinpath("configs/launch_model.yaml")
@@ -40,8 +41,19 @@ def main(cfg: DictConfig) -> float:
 
     model_launcher: BaseModel = hydra.utils.instantiate(cfg.model_launcher)
 
-    model_launcher.train()
-    auc = model_launcher.evaluate()
+    with profile_task("train"):
+        model_launcher.train()
+    with profile_task("evaluate"):
+        tuning_metrics = model_launcher.evaluate_metrics()
+        held_out_metrics = model_launcher.evaluate_metrics(split="held_out")
+    auc = tuning_metrics["auc"]
+
+    # report the timings of the data loading methods of the model's datasets along with the stage's tasks
+    profiler = get_active_profiler()
+    if profiler is not None:
+        profiler.add_timings("model", model_launcher)
+        for split in ["train", "tuning", "held_out"]:
+            profiler.add_timings(split, getattr(model_launcher, f"i{split}", None))
 
     # Make output model directory
     path_cfg = model_launcher.cfg.path
@@ -53,6 +65,12 @@ def main(cfg: DictConfig) -> float:
     # save model
     model_launcher.save_model(trial_output_dir / model_filename)
 
+    # save the code masks, fitted preprocessing and columns of the training data to reload the model without
+    # re-deriving them from the training shards
+    model_launcher.itrain.save_state(trial_output_dir / f"{path_cfg.dataset_state_stem}.pkl")
+    with open(trial_output_dir / f"{path_cfg.column_manifest_stem}.json", "w") as f:
+        json.dump(model_launcher.itrain.get_included_column_names(), f)
+
     # save model config
     config_fp = trial_output_dir / f"{cfg.path.config_log_stem}.log"
     with open(config_fp, "w") as f:
@@ -60,12 +78,12 @@ def main(cfg: DictConfig) -> float:
 
     # save model performance
     model_performance_fp = trial_output_dir / f"{cfg.path.performance_log_stem}.log"
+    performance = {"trial_name": trial_output_dir.stem}
+    performance.update({f"tuning_{k}": v for k, v in tuning_metrics.items()})
+    performance.update({f"test_{k}": v for k, v in held_out_metrics.items()})
     with open(model_performance_fp, "w") as f:
-        f.write("trial_name,tuning_auc,test_auc\n")
-        f.write(
-            f"{trial_output_dir.stem},{model_launcher.evaluate()},"
-            f"{model_launcher.evaluate(split='held_out')}\n"
-        )
+        f.write(",".join(performance.keys()) + "\n")
+        f.write(",".join(str(v) for v in performance.values()) + "\n")
 
     logger.debug(f"Model config and performance logged to {config_fp} and {model_performance_fp}")
     return auc
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""Scores the task-specific tabularized data of a cohort with a trained model."""
+import json
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from importlib.resources import files
+from pathlib import Path
+from typing import TypeVar
+
+import hydra
+import numpy as np
+import polars as pl
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+
+from ..base_model import BaseModel
+from ..file_name import list_subdir_files
+from ..mapper import get_input_signature, is_output_up_to_date
+from ..mapper import wrap as rwlock_wrap
+from ..tabular_dataset import TabularDataset
+from ..utils import hydra_loguru_init, stage_init
+
+config_yaml = files("MEDS_tabular_automl").joinpath("configs/predict.yaml")
+if not config_yaml.is_file():
+    raise FileNotFoundError("Core configuration not successfully installed!")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def iter_prefetched(
+    items: Iterable[T], load_fn: Callable[[T], R], n_prefetch: int
+) -> Iterator[tuple[T, Future[R]]]:
+    """Yields each item with a future of its loaded data, loading up to `n_prefetch` items ahead.
+
+    The items are loaded in order by a single background thread, so loading the next items overlaps with the
+    processing of the current one.
+
+    Args:
+        items: The items to load.
+        load_fn: The function loading an item.
+        n_prefetch: The number of items loaded ahead of the item being processed.
+
+    Examples:
+        >>> [(item, future.result()) for item, future in iter_prefetched([1, 2, 3], lambda x: 10 * x, 1)]
+        [(1, 10), (2, 20), (3, 30)]
+        >>> [future.result() for _, future in iter_prefetched("ab", str.upper, n_prefetch=0)]
+        ['A', 'B']
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(load_fn, item)))
+            if len(pending) > n_prefetch:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_predictions_df(label_df: pl.DataFrame, probabilities: np.ndarray, threshold: float) -> pl.DataFrame:
+    """Returns the predictions for the labeled prediction times of a shard in the MEDS prediction schema.
+
+    Args:
+        label_df: The task-specific labels of the shard, with columns subject_id, time and label.
+        probabilities: The predicted probability of the positive class for each row of `label_df`.
+        threshold: The probability at or above which the predicted label is positive.
+
+    Returns:
+        A DataFrame with columns subject_id, prediction_time, boolean_value (the label),
+        predicted_boolean_value and predicted_boolean_probability.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> label_df = pl.DataFrame({
+        ...     "subject_id": [1, 2],
+        ...     "time": [datetime(2020, 1, 1), datetime(2020, 1, 2)],
+        ...     "label": [1, 0],
+        ...     "event_id": [0, 3],
+        ... })
+        >>> get_predictions_df(label_df, np.array([0.75, 0.25]), threshold=0.5)
+        shape: (2, 5)
+        ┌────────────┬─────────────────────┬───────────────┬───────────────────────┬───────────────────────┐
+        │ subject_id ┆ prediction_time     ┆ boolean_value ┆ predicted_boolean_val ┆ predicted_boolean_pro │
+        │ ---        ┆ ---                 ┆ ---           ┆ ue                    ┆ bability              │
+        │ i64        ┆ datetime[μs]        ┆ bool          ┆ ---                   ┆ ---                   │
+        │            ┆                     ┆               ┆ bool                  ┆ f64                   │
+        ╞════════════╪═════════════════════╪═══════════════╪═══════════════════════╪═══════════════════════╡
+        │ 1          ┆ 2020-01-01 00:00:00 ┆ true          ┆ true                  ┆ 0.75                  │
+        │ 2          ┆ 2020-01-02 00:00:00 ┆ false         ┆ false                 ┆ 0.25                  │
+        └────────────┴─────────────────────┴───────────────┴───────────────────────┴───────────────────────┘
+        >>> get_predictions_df(label_df, np.array([0.5]), threshold=0.5)
+        Traceback (most recent call last):
+            ...
+        ValueError: Got 1 predictions for 2 labels.
+    """
+    if len(probabilities) != len(label_df):
+        raise ValueError(f"Got {len(probabilities)} predictions for {len(label_df)} labels.")
+    return label_df.select(
+        "subject_id",
+        pl.col("time").alias("prediction_time"),
+        pl.col("label").cast(pl.Boolean).alias("boolean_value"),
+        pl.Series("predicted_boolean_value", probabilities >= threshold),
+        pl.Series("predicted_boolean_probability", probabilities, dtype=pl.Float64),
+    )
+
+
+def load_model_launcher(cfg: DictConfig) -> tuple[BaseModel, Path, Path | None]:
+    """Restores the trained model of ``cfg.model_dir``, set up to load the task-specific data of ``cfg``.
+
+    The model launcher is instantiated from the logged configuration of the training run, so the data is
+    loaded with the same tabularization (code metadata, windows, aggregations and code filters) and
+    preprocessing as during training; only the task-specific data and cache directories are replaced.
+
+    Args:
+        cfg: The prediction configuration.
+
+    Returns:
+        The model launcher holding the trained model, the file path of the model, and the file path of the
+        dataset state of the training data saved with the model (None for models saved without one).
+    """
+    model_cfg = OmegaConf.load(cfg.model_config_fp)
+    for key in ["input_tabularized_cache_dir", "input_label_cache_dir", "cache_dir"]:
+        model_cfg.path[key] = cfg[key]
+
+    model_launcher: BaseModel = hydra.utils.instantiate(model_cfg.model_launcher)
+    path_cfg = model_launcher.cfg.path
+    model_fp = Path(cfg.model_dir) / f"{path_cfg.model_file_stem}{path_cfg.model_file_extension}"
+    logger.info(f"Loading model from {model_fp}")
+    model_launcher.load_model(model_fp)
+
+    state_fp = Path(cfg.model_dir) / f"{path_cfg.get('dataset_state_stem', 'dataset_state')}.pkl"
+    if not state_fp.is_file():
+        logger.warning(f"No dataset state found at {state_fp}; preprocessing is fit on each scored split.")
+        state_fp = None
+    return model_launcher, model_fp, state_fp
+
+
+@hydra.main(version_base=None, config_path=str(config_yaml.parent.resolve()), config_name=config_yaml.stem)
+def main(cfg: DictConfig):
+    """Scores the labeled prediction times of a cohort with a trained model.
+
+    The task-specific data of every split is loaded shard by shard through `TabularDataset`, with the code
+    masks and fitted preprocessing of the training data saved with the model, and with the next
+    ``n_prefetch_shards`` shards loaded in the background while the current one is scored. The predictions of
+    each shard are written to ``output_predictions_dir/{split}/{shard}.parquet`` (see `get_predictions_df`).
+    Outputs are locked while computed and skipped once up to date with the labels and the model, so several
+    workers (e.g., ``--multirun worker="range(0,N)"``) can score the shards of a cohort in parallel.
+
+    Args:
+        cfg: The configuration for prediction, loaded from a YAML file.
+    """
+    stage_init(
+        cfg,
+        ["model_dir", "model_config_fp", "input_tabularized_cache_dir", "input_label_cache_dir"],
+    )
+    if not cfg.loguru_init:
+        hydra_loguru_init()
+
+    model_launcher, model_fp, state_fp = load_model_launcher(cfg)
+    manifest_key = json.dumps(
+        {
+            "model": get_input_signature(model_fp),
+            "state": get_input_signature(state_fp) if state_fp is not None else None,
+            "threshold": cfg.threshold,
+        },
+        sort_keys=True,
+    )
+
+    label_cache_dir = Path(cfg.input_label_cache_dir)
+    splits = cfg.splits
+    if splits is None:
+        splits = sorted(
+            fp.name for fp in label_cache_dir.iterdir() if fp.is_dir() and not fp.name.startswith(".")
+        )
+
+    total_rows, total_start = 0, time.monotonic()
+    for split in splits:
+        label_fps = {fp.stem: fp for fp in list_subdir_files(label_cache_dir / split, "parquet")}
+        output_dir = Path(cfg.output_predictions_dir) / split
+        out_fps = {shard: output_dir / f"{shard}.parquet" for shard in label_fps}
+        pending_shards = [
+            shard
+            for shard in sorted(label_fps)
+            if cfg.do_overwrite or not is_output_up_to_date(label_fps[shard], out_fps[shard], manifest_key)
+        ]
+        if not pending_shards:
+            logger.info(f"Predictions of all {len(label_fps)} shards of split {split} exist; skipping.")
+            continue
+
+        dataset = TabularDataset(model_launcher.cfg, split, state_fp=state_fp)
+        shard_indices = {shard: idx for idx, shard in enumerate(dataset._data_shards)}
+
+        scored_rows, split_start = [], time.monotonic()
+        for shard, shard_data in iter_prefetched(
+            pending_shards, lambda shard: dataset.get_data_shards(shard_indices[shard]), cfg.n_prefetch_shards
+        ):
+
+            def compute_fn(label_df: pl.DataFrame) -> pl.DataFrame:
+                X, _ = shard_data.result()
+                predictions_df = get_predictions_df(label_df, model_launcher.predict(X), cfg.threshold)
+                scored_rows.append(len(predictions_df))
+                return predictions_df
+
+            rwlock_wrap(
+                label_fps[shard],
+                out_fps[shard],
+                pl.read_parquet,
+                pl.DataFrame.write_parquet,
+                compute_fn,
+                cache_intermediate=None,
+                do_overwrite=cfg.do_overwrite,
+                do_return=False,
+                manifest_key=manifest_key,
+            )
+
+        n_rows, elapsed = sum(scored_rows), time.monotonic() - split_start
+        total_rows += n_rows
+        logger.info(
+            f"Scored {n_rows} prediction times in {len(scored_rows)} shards of split {split} in "
+            f"{elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s)"
+        )
+
+    elapsed = time.monotonic() - total_start
+    logger.info(
+        f"Scored {total_rows} prediction times in {elapsed:.1f}s "
+        f"({total_rows / max(elapsed, 1e-9):.0f} rows/s); predictions are in {cfg.output_predictions_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,40 @@
 #!/usr/bin/env python
 """Tabularizes static data in MEDS format into tabular representations."""
 
+import json
+import shutil
+import time
 from itertools import product
 from pathlib import Path
 
 import hydra
-import numpy as np
 import polars as pl
+import scipy.sparse as sp
 
 pl.enable_string_cache()
 
 from importlib.resources import files
 
-from omegaconf import DictConfig
+from omegaconf import DictConfig, ListConfig, OmegaConf
 
 from ..describe_codes import (
+    CodeFilter,
     convert_to_df,
-    filter_parquet,
     get_feature_columns,
     get_feature_freqs,
 )
 from ..file_name import list_subdir_files
 from ..generate_static_features import get_flat_static_rep
+from ..manifest import hash_codes, plan_incremental_run, write_manifest
 from ..mapper import wrap as rwlock_wrap
+from ..scheduling import TaskCostModel, TaskQueue
+from ..shard_cache import get_filtered_shard_fp, read_shard
 from ..utils import (
     STATIC_CODE_AGGREGATION,
     STATIC_VALUE_AGGREGATION,
     filter_to_codes,
     get_shard_prefix,
+    get_subject_chunks,
     hydra_loguru_init,
     load_tqdm,
     stage_init,
@@ -105,6 +112,8 @@ def main(
             cfg.tabularization.min_code_inclusion_count,
             cfg.tabularization.min_code_inclusion_frequency,
             cfg.tabularization.max_included_codes,
+            cfg.tabularization.code_stats_fp,
+            cfg.tabularization.min_subject_prevalence,
         )
         feature_freqs = get_feature_freqs(cfg.input_code_metadata_fp)
         filtered_feature_columns_set = set(filtered_feature_columns)
@@ -118,6 +127,27 @@ def main(
 
     in_fp = Path(cfg.input_code_metadata_fp)
     out_fp = Path(cfg.tabularization.filtered_code_metadata_fp)
+
+    # The filtered codes are recomputed whenever the code metadata or the filtering criteria change, unless
+    # they are filtered in place.
+    filter_key = None
+    if in_fp.resolve() != out_fp.resolve():
+        filter_key = json.dumps(
+            {
+                k: OmegaConf.to_container(v) if isinstance(v, ListConfig) else v
+                for k, v in cfg.tabularization.items()
+                if k
+                in [
+                    "allowed_codes",
+                    "min_code_inclusion_count",
+                    "min_code_inclusion_frequency",
+                    "max_included_codes",
+                    "min_subject_prevalence",
+                ]
+            },
+            sort_keys=True,
+        )
+
     rwlock_wrap(
         in_fp,
         out_fp,
@@ -126,34 +156,65 @@ def main(
         compute_fn,
         do_overwrite=cfg.do_overwrite,
         do_return=False,
+        manifest_key=filter_key,
     )
 
     # Step 2: Produce static data representation
     meds_shard_fps = list_subdir_files(cfg.input_dir, "parquet")
     feature_columns = get_feature_columns(cfg.tabularization.filtered_code_metadata_fp)
+    # the allowed codes are parsed once and applied to every shard while it is scanned
+    code_filter = CodeFilter(cfg.tabularization._resolved_codes)
+
+    # Incremental runs only tabularize the shards added or changed since the last run.
+    manifest_fp = Path(cfg.output_tabularized_dir) / ".static_manifest.json"
+    update_shards = set()
+    if cfg.incremental:
+        update_shards, removed_shards, manifest = plan_incremental_run(
+            cfg.input_dir, manifest_fp, cfg.tabularization._resolved_codes, cfg.use_content_hash
+        )
+        for shard_prefix in removed_shards:
+            shutil.rmtree(Path(cfg.output_tabularized_dir) / shard_prefix / "none", ignore_errors=True)
 
-    # shuffle tasks
+    # outputs are recomputed if their shard or the resolved code set changed since they were written
+    codes_hash = hash_codes(cfg.tabularization._resolved_codes)
+
+    # order tasks from the most to the least expensive and claim them through a queue shared by all workers
     aggs = cfg.tabularization.aggs
     static_aggs = [agg for agg in aggs if agg in [STATIC_CODE_AGGREGATION, STATIC_VALUE_AGGREGATION]]
-    tabularization_tasks = list(product(meds_shard_fps, static_aggs))
-    np.random.shuffle(tabularization_tasks)
+    cost_model = TaskCostModel(cfg.task_cost_history_fp)
+    tabularization_tasks = TaskQueue(
+        Path(cfg.task_queue_dir) / "static",
+        list(product(meds_shard_fps, static_aggs)),
+        cost_fn=lambda task: cost_model.estimate(task[0], "none", task[1]),
+    )
     for shard_fp, agg in iter_wrapper(tabularization_tasks):
-        out_fp = (
-            Path(cfg.output_tabularized_dir) / get_shard_prefix(cfg.input_dir, shard_fp) / "none" / agg
-        ).with_suffix(".npz")
+        shard_prefix = get_shard_prefix(cfg.input_dir, shard_fp)
+        do_overwrite = cfg.do_overwrite or shard_prefix in update_shards
+        out_fp = (Path(cfg.output_tabularized_dir) / shard_prefix / "none" / agg).with_suffix(".npz")
 
         def read_fn(in_fp):
-            return filter_parquet(in_fp, cfg.tabularization._resolved_codes)
+            filtered_shard_fp = None
+            if cfg.use_filtered_shards:
+                filtered_shard_fp = get_filtered_shard_fp(cfg.filtered_shards_dir, cfg.input_dir, in_fp)
+            return read_shard(in_fp, code_filter, filtered_shard_fp, codes_hash)
 
         def compute_fn(shard_df):
-            return get_flat_static_rep(
-                agg=agg,
-                feature_columns=feature_columns,
-                shard_df=shard_df,
-            )
+            tabularization_tasks.mark_computed()
+            start_time = time.monotonic()
+            matrices = [
+                get_flat_static_rep(
+                    agg=agg,
+                    feature_columns=feature_columns,
+                    shard_df=chunk_df,
+                )
+                for chunk_df in get_subject_chunks(shard_df, cfg.max_events_per_chunk)
+            ]
+            out = matrices[0] if len(matrices) == 1 else sp.vstack(matrices, format="coo")
+            cost_model.record(shard_fp, "none", agg, time.monotonic() - start_time)
+            return out
 
         def write_fn(data, out_df):
-            write_df(data, out_df, do_overwrite=cfg.do_overwrite)
+            write_df(data, out_df, do_overwrite=do_overwrite)
 
         rwlock_wrap(
             shard_fp,
@@ -161,10 +222,15 @@ def main(
             read_fn,
             write_fn,
             compute_fn,
-            do_overwrite=cfg.do_overwrite,
+            do_overwrite=do_overwrite,
             do_return=False,
+            manifest_key=json.dumps({"agg": agg, "codes": codes_hash}),
         )
 
+    cost_model.save()
+    if cfg.incremental:
+        write_manifest(manifest, manifest_fp)
+
 
 if __name__ == "__main__":
     main()
@@ -6,24 +6,31 @@ import polars as pl
 pl.enable_string_cache()
 
 import gc
+import json
+import shutil
+import time
 from importlib.resources import files
 from itertools import product
 from pathlib import Path
 
 import hydra
-import numpy as np
+import scipy.sparse as sp
 from loguru import logger
 from omegaconf import DictConfig
 
-from ..describe_codes import filter_parquet, get_feature_columns
+from ..describe_codes import CodeFilter, get_feature_columns
 from ..file_name import list_subdir_files
 from ..generate_summarized_reps import generate_summary
 from ..generate_ts_features import get_flat_ts_rep
+from ..manifest import hash_codes, plan_incremental_run, write_manifest
 from ..mapper import wrap as rwlock_wrap
+from ..scheduling import TaskCostModel, TaskQueue
+from ..shard_cache import get_filtered_shard_fp, read_shard
 from ..utils import (
     STATIC_CODE_AGGREGATION,
     STATIC_VALUE_AGGREGATION,
     get_shard_prefix,
+    get_subject_chunks,
     hydra_loguru_init,
     load_tqdm,
     stage_init,
@@ -79,51 +86,80 @@ def main(
     # Produce ts representation
     meds_shard_fps = list_subdir_files(cfg.input_dir, "parquet")
     feature_columns = get_feature_columns(cfg.tabularization.filtered_code_metadata_fp)
+    # the allowed codes are parsed once and applied to every shard while it is scanned
+    code_filter = CodeFilter(cfg.tabularization._resolved_codes)
+
+    # Incremental runs only tabularize the shards added or changed since the last run.
+    manifest_fp = Path(cfg.output_tabularized_dir) / ".time_series_manifest.json"
+    update_shards = set()
+    if cfg.incremental:
+        update_shards, removed_shards, manifest = plan_incremental_run(
+            cfg.input_dir, manifest_fp, cfg.tabularization._resolved_codes, cfg.use_content_hash
+        )
+        for shard_prefix, window_size in product(removed_shards, cfg.tabularization.window_sizes):
+            shutil.rmtree(Path(cfg.output_tabularized_dir) / shard_prefix / window_size, ignore_errors=True)
+
+    # outputs are recomputed if their shard or the resolved code set changed since they were written
+    codes_hash = hash_codes(cfg.tabularization._resolved_codes)
 
-    # shuffle tasks
+    # order tasks from the most to the least expensive and claim them through a queue shared by all workers
     aggs = [
         agg
         for agg in cfg.tabularization.aggs
         if agg not in [STATIC_CODE_AGGREGATION, STATIC_VALUE_AGGREGATION]
     ]
-    tabularization_tasks = list(product(meds_shard_fps, cfg.tabularization.window_sizes, aggs))
-    np.random.shuffle(tabularization_tasks)
+    cost_model = TaskCostModel(cfg.task_cost_history_fp)
+    tabularization_tasks = TaskQueue(
+        Path(cfg.task_queue_dir) / "time_series",
+        list(product(meds_shard_fps, cfg.tabularization.window_sizes, aggs)),
+        cost_fn=lambda task: cost_model.estimate(*task),
+    )
 
     # iterate through them
     for shard_fp, window_size, agg in iter_wrapper(tabularization_tasks):
-        out_fp = (
-            Path(cfg.output_tabularized_dir) / get_shard_prefix(cfg.input_dir, shard_fp) / window_size / agg
-        ).with_suffix(".npz")
+        shard_prefix = get_shard_prefix(cfg.input_dir, shard_fp)
+        do_overwrite = cfg.do_overwrite or shard_prefix in update_shards
+        out_fp = (Path(cfg.output_tabularized_dir) / shard_prefix / window_size / agg).with_suffix(".npz")
 
         def read_fn(in_fp):
-            return filter_parquet(in_fp, cfg.tabularization._resolved_codes)
+            filtered_shard_fp = None
+            if cfg.use_filtered_shards:
+                filtered_shard_fp = get_filtered_shard_fp(cfg.filtered_shards_dir, cfg.input_dir, in_fp)
+            return read_shard(in_fp, code_filter, filtered_shard_fp, codes_hash)
 
         def compute_fn(shard_df):
-            # Load Sparse DataFrame
-            index_df, sparse_matrix = get_flat_ts_rep(agg, feature_columns, shard_df)
-
-            # Summarize data -- applying aggregations on a specific window size + aggregation combination
-            summary_df = generate_summary(
-                feature_columns,
-                index_df,
-                sparse_matrix,
-                window_size,
-                agg,
-            )
-
-            if not summary_df.shape[1]:
-                raise ValueError("No data found in the summarized dataframe.")
-
-            del index_df
-            del sparse_matrix
-            gc.collect()
-
+            tabularization_tasks.mark_computed()
+            start_time = time.monotonic()
+            summaries = []
+            for chunk_df in get_subject_chunks(shard_df, cfg.max_events_per_chunk):
+                # Load Sparse DataFrame
+                index_df, sparse_matrix = get_flat_ts_rep(agg, feature_columns, chunk_df)
+
+                # Summarize data -- applying aggregations on a specific window size + aggregation combination
+                summary_df = generate_summary(
+                    feature_columns,
+                    index_df,
+                    sparse_matrix,
+                    window_size,
+                    agg,
+                )
+
+                if not summary_df.shape[1]:
+                    raise ValueError("No data found in the summarized dataframe.")
+                summaries.append(summary_df)
+
+                del index_df
+                del sparse_matrix
+                gc.collect()
+
+            summary_df = summaries[0] if len(summaries) == 1 else sp.vstack(summaries, format="csr")
+            cost_model.record(shard_fp, window_size, agg, time.monotonic() - start_time)
             logger.info("Writing pivot file")
             return summary_df
 
         def write_fn(out_matrix, out_fp):
             coo_matrix = out_matrix.tocoo()
-            write_df(coo_matrix, out_fp, do_overwrite=cfg.do_overwrite)
+            write_df(coo_matrix, out_fp, do_overwrite=do_overwrite)
             del coo_matrix
             del out_matrix
             gc.collect()
@@ -134,10 +170,15 @@ def main(
             read_fn,
             write_fn,
             compute_fn,
-            do_overwrite=cfg.do_overwrite,
+            do_overwrite=do_overwrite,
             do_return=False,
+            manifest_key=json.dumps({"window_size": window_size, "agg": agg, "codes": codes_hash}),
         )
 
+    cost_model.save()
+    if cfg.incremental:
+        write_manifest(manifest, manifest_fp)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,126 @@
+"""A cache of the MEDS shards, filtered to the allowed codes once and shared by the tabularization stages.
+
+Without it, every static and time-series tabularization task scans its raw MEDS shard and filters it to the
+allowed codes again. `meds-tab-filter-shards` instead writes each shard once, filtered, sorted by subject and
+time, and with its codes encoded as ids into the sorted allowed codes, to an uncompressed Arrow IPC file.
+The tabularization stages then memory-map these files, reading them without copying or decoding.
+"""
+from pathlib import Path
+
+import polars as pl
+from loguru import logger
+
+from .describe_codes import CodeFilter, filter_parquet
+from .mapper import is_output_up_to_date
+from .utils import get_shard_prefix
+
+
+def get_filtered_shard_fp(filtered_shards_dir: Path | str, input_dir: Path | str, shard_fp: Path) -> Path:
+    """Returns the file path of the filtered copy of a MEDS shard.
+
+    Args:
+        filtered_shards_dir: The root directory of the filtered shards.
+        input_dir: The root directory of the MEDS shards.
+        shard_fp: The file path of the MEDS shard.
+
+    Examples:
+        >>> get_filtered_shard_fp("out/filtered", "data", Path("data/train/0.parquet"))
+        PosixPath('out/filtered/train/0.arrow')
+    """
+    return (Path(filtered_shards_dir) / get_shard_prefix(input_dir, shard_fp)).with_suffix(".arrow")
+
+
+def encode_filtered_shard(df: pl.LazyFrame, code_filter: CodeFilter) -> pl.LazyFrame:
+    """Encodes the codes of a filtered shard as ids into the allowed codes and sorts it by subject and time.
+
+    The codes are cast to a `pl.Enum` of ``code_filter.codes``, which is stored as a dictionary of the codes
+    and their integer ids, and behaves like the string codes in all downstream comparisons. Static events,
+    without a time, come first for each subject.
+
+    Args:
+        df: The shard, filtered with ``code_filter``.
+        code_filter: The allowed codes.
+
+    Examples:
+        >>> df = pl.LazyFrame({
+        ...     "subject_id": [2, 1, 1, 1],
+        ...     "time": [1, 2, None, 1],
+        ...     "code": ["B", "A", "B", "A"],
+        ...     "numeric_value": [1.0, 2.0, None, 3.0],
+        ... })
+        >>> code_filter = CodeFilter(["A/code", "B/code", "B/static/present"])
+        >>> df = encode_filtered_shard(df, code_filter).collect()
+        >>> df.schema["code"]
+        Enum(categories=['A', 'B'])
+        >>> df.rows()
+        [(1, None, 'B', None), (1, 1, 'A', 3.0), (1, 2, 'A', 2.0), (2, 1, 'B', 1.0)]
+        >>> df["code"].to_physical().to_list()
+        [1, 0, 0, 1]
+    """
+    return df.with_columns(pl.col("code").cast(pl.String).cast(pl.Enum(code_filter.codes))).sort(
+        "subject_id", "time", nulls_last=False, maintain_order=True
+    )
+
+
+def write_filtered_shard(df: pl.LazyFrame, fp: Path):
+    """Writes a filtered shard uncompressed, so it can be memory-mapped by `scan_filtered_shard`."""
+    df.collect().write_ipc(fp, compression="uncompressed")
+
+
+def scan_filtered_shard(fp: Path) -> pl.LazyFrame:
+    """Lazily reads a filtered shard written by `write_filtered_shard`, memory-mapping the file.
+
+    Examples:
+        >>> import tempfile
+        >>> df = pl.LazyFrame({"subject_id": [1, 1], "time": [None, 1], "code": ["A", "B"]})
+        >>> df = encode_filtered_shard(df, CodeFilter(["A/static/present", "B/code"]))
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     write_filtered_shard(df, Path(d) / "0.arrow")
+        ...     scan_filtered_shard(Path(d) / "0.arrow").collect().equals(df.collect())
+        True
+    """
+    return pl.scan_ipc(fp, memory_map=True)
+
+
+def read_shard(
+    shard_fp: Path,
+    code_filter: CodeFilter,
+    filtered_shard_fp: Path | None = None,
+    codes_hash: str | None = None,
+) -> pl.LazyFrame:
+    """Reads a MEDS shard filtered to the allowed codes, from its filtered copy if that is up to date.
+
+    Args:
+        shard_fp: The file path of the MEDS shard.
+        code_filter: The allowed codes.
+        filtered_shard_fp: The file path of the filtered copy of the shard (see `get_filtered_shard_fp`), or
+            None to filter the shard itself.
+        codes_hash: The hash of the allowed codes the filtered copy must have been written with.
+
+    Returns:
+        The filtered shard. If its filtered copy is missing or stale, i.e., written from an older version of
+        the shard or with other allowed codes, the shard itself is filtered with `filter_parquet`.
+
+    Examples:
+        >>> import tempfile
+        >>> from MEDS_tabular_automl.manifest import hash_codes
+        >>> code_filter = CodeFilter(["A/code"])
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     shard_fp, filtered_fp = Path(d) / "0.parquet", Path(d) / "0.arrow"
+        ...     pl.DataFrame({
+        ...         "subject_id": [1, 1], "time": [1, 2], "code": ["A", "B"], "numeric_value": [1.0, 2.0]
+        ...     }).write_parquet(shard_fp)
+        ...     read_shard(shard_fp, code_filter).collect().schema["code"]
+        ...     codes_hash = hash_codes(["A/code"])
+        ...     read_shard(shard_fp, code_filter, filtered_fp, codes_hash).collect().schema["code"]
+        String
+        String
+    """
+    if filtered_shard_fp is not None:
+        if is_output_up_to_date(shard_fp, filtered_shard_fp, codes_hash):
+            return scan_filtered_shard(filtered_shard_fp)
+        logger.warning(
+            f"The filtered copy {filtered_shard_fp} of {shard_fp} is missing or stale; filtering the shard. "
+            "Run meds-tab-filter-shards to update it."
+        )
+    return filter_parquet(shard_fp, code_filter)
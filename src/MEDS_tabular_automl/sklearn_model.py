@@ -1,13 +1,14 @@
 from pathlib import Path
-from pickle import dump
+from pickle import dump, load
 
 import numpy as np
 import scipy.sparse as sp
 from loguru import logger
 from omegaconf import DictConfig
-from sklearn.metrics import roc_auc_score
 
 from .base_model import BaseModel
+from .metrics import binary_classification_metrics
+from .pruning import get_pruner
 from .tabular_dataset import TabularDataset as SklearnIterator
 
 
@@ -73,6 +74,9 @@ class SklearnModel(BaseModel):
         self.dtuning = None
         self.dheld_out = None
 
+        # Shards of the tuning split kept in memory across epochs when streaming
+        self._resident_tuning_shards = None
+
         self.model = cfg.model
         # check that self.model is a valid model
         if not hasattr(self.model, "fit"):
@@ -87,27 +91,54 @@ class SklearnModel(BaseModel):
             self._build_iterators()
 
     def _fit_from_partial(self):
-        """Fits model until convergence or maximum epochs."""
+        """Fits model until convergence or maximum epochs.
+
+        If ``training_params.batch_size`` is set, each epoch streams shuffled mini-batches of rows (see
+        `TabularDataset.iter_minibatches`) instead of whole shards in a fixed order.
+
+        If pruning is enabled, the tuning AUC of every epoch is reported to the pruner and training stops
+        once the trial falls below the median of the completed trials.
+        """
         if not hasattr(self.model, "partial_fit"):
             raise ValueError(
                 f"Data is loaded in shards, but {self.model.__class__.__name__} does not support partial_fit."
             )
         classes = self.itrain.get_classes()
+        batch_size = self.cfg.training_params.get("batch_size", None)
+        rng = np.random.default_rng(self.cfg.training_params.get("seed", None))
+        pruner = get_pruner(self.cfg)
+        pruned = False
         best_auc = 0
         best_epoch = 0
         for epoch in range(self.cfg.training_params.epochs):
             # train on each all data
-            for shard_idx in range(len(self.itrain._data_shards)):
-                data, labels = self.itrain.get_data_shards(shard_idx)
-                self.model.partial_fit(data, labels, classes=classes)
+            if batch_size is None:
+                for shard_idx in range(len(self.itrain._data_shards)):
+                    data, labels = self.itrain.get_data_shards(shard_idx)
+                    self.model.partial_fit(data, labels, classes=classes)
+            else:
+                for data, labels in self.itrain.iter_minibatches(
+                    batch_size,
+                    shuffle=self.cfg.training_params.get("shuffle", True),
+                    buffer_shards=self.cfg.training_params.get("shuffle_buffer_shards", 1),
+                    rng=rng,
+                ):
+                    self.model.partial_fit(data, labels, classes=classes)
             # evaluate on tuning set
             auc = self.evaluate()
+            if pruner is not None:
+                pruner.report(epoch, auc)
+                pruned = pruner.should_prune()
+                if pruned:
+                    break
             # early stopping
             if auc > best_auc:
                 best_auc = auc
                 best_epoch = epoch
             if epoch - best_epoch > self.cfg.training_params.early_stopping_rounds:
                 break
+        if pruner is not None:
+            pruner.complete(pruned=pruned)
 
     def _train(self):
         """Trains the model."""
@@ -133,12 +164,40 @@ class SklearnModel(BaseModel):
         self.ituning = SklearnIterator(self.cfg, split="tuning")
         self.iheld_out = SklearnIterator(self.cfg, split="held_out")
 
+    def _iter_eval_shards(self, split: str, isplit: SklearnIterator):
+        """Yields the (data, labels) shards of a split for streamed evaluation.
+
+        The tuning split is evaluated after every epoch of `_fit_from_partial`, so unless disabled via
+        ``data_loading_params.keep_tuning_data_in_memory`` its processed shards are loaded once and kept.
+        """
+        keep_resident = split == "tuning" and self.cfg.data_loading_params.keep_tuning_data_in_memory
+        if keep_resident and self._resident_tuning_shards is not None:
+            yield from self._resident_tuning_shards
+            return
+
+        shards = []
+        for shard_idx in range(len(isplit._data_shards)):
+            data, labels = isplit.get_data_shards(shard_idx)
+            if keep_resident:
+                shards.append((data, labels))
+            yield data, labels
+        if keep_resident:
+            self._resident_tuning_shards = shards
+
     def evaluate(self, split: str = "tuning") -> float:
         """Evaluates the model on the tuning set.
 
         Returns:
             The evaluation metric as the ROC AUC score.
         """
+        return self.evaluate_metrics(split)["auc"]
+
+    def evaluate_metrics(self, split: str = "tuning") -> dict[str, float]:
+        """Evaluates the model on a split.
+
+        Returns:
+            The ROC AUC, AUPRC and log-loss of the model on the split.
+        """
         # depending on split point to correct data
         if split == "tuning":
             dsplit = self.dtuning
@@ -161,19 +220,20 @@ class SklearnModel(BaseModel):
             y_pred = self.model.predict_proba(dsplit.get_data())[:, 1]
             y_true = dsplit.get_label()
         else:
-            y_pred = []
-            y_true = []
-            for shard_idx in range(len(isplit._data_shards)):
-                data, labels = isplit.get_data_shards(shard_idx)
-                y_pred.extend(self.model.predict_proba(data)[:, 1])
-                y_true.extend(labels)
-            y_pred = np.array(y_pred)
-            y_true = np.array(y_true)
-
-        # check if y_pred and y_true are not empty
-        if len(y_pred) == 0 or len(y_true) == 0:
-            raise ValueError("Predictions or true labels are empty.")
-        return roc_auc_score(y_true, y_pred)
+            # Predictions are written into arrays preallocated from the known number of labels per shard
+            n_rows = sum(len(labels) for labels in isplit.labels.values())
+            y_pred = np.empty(n_rows, dtype=np.float64)
+            y_true = np.empty(n_rows, dtype=np.float64)
+            offset = 0
+            for data, labels in self._iter_eval_shards(split, isplit):
+                n_shard_rows = len(labels)
+                y_pred[offset : offset + n_shard_rows] = self.model.predict_proba(data)[:, 1]
+                y_true[offset : offset + n_shard_rows] = labels
+                offset += n_shard_rows
+            y_pred = y_pred[:offset]
+            y_true = y_true[:offset]
+
+        return binary_classification_metrics(y_true, y_pred)
 
     def save_model(self, output_fp: Path):
         """Saves the model to the specified file path.
@@ -191,3 +251,28 @@ class SklearnModel(BaseModel):
                 dump(self.model, f, protocol=5)
         else:
             self.model.save_model(output_fp)
+
+    def load_model(self, input_fp: Path):
+        """Loads a model saved with `save_model` from the specified file path.
+
+        Args:
+            input_fp: The file path to load the model from.
+        """
+        if not hasattr(self.model, "load_model"):
+            with open(input_fp, "rb") as f:
+                self.model = load(f)
+        else:
+            self.model.load_model(input_fp)
+
+    def predict(self, X: sp.csc_matrix) -> np.ndarray:
+        """Predicts the probability of the positive class for each row of the feature matrix.
+
+        Args:
+            X: The feature matrix, with the columns the model was trained on.
+
+        Returns:
+            The predicted probabilities.
+        """
+        if not hasattr(self.model, "predict_proba"):
+            raise ValueError(f"Model {self.model.__class__.__name__} does not have a predict_proba method.")
+        return self.model.predict_proba(X)[:, 1]
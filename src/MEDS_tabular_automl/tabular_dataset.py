@@ -1,16 +1,22 @@
-from collections.abc import Mapping
+import hashlib
+import json
+import os
+import pickle
+from collections.abc import Iterator, Mapping
 from pathlib import Path
 
 import numpy as np
 import polars as pl
 import scipy.sparse as sp
+from loguru import logger
 from mixins import TimeableMixin
-from omegaconf import DictConfig
+from omegaconf import DictConfig, ListConfig, OmegaConf
 from scipy.stats import pearsonr
 
 from .describe_codes import get_feature_columns
 from .file_name import get_model_files, list_subdir_files
-from .utils import get_feature_indices
+from .mapper import get_input_signature
+from .utils import get_feature_indices, get_resolved_code_set
 
 
 class TabularDataset(TimeableMixin):
@@ -38,7 +44,7 @@ class TabularDataset(TimeableMixin):
         num_features: Total number of features in the data.
     """
 
-    def __init__(self, cfg: DictConfig, split: str = "train"):
+    def __init__(self, cfg: DictConfig, split: str = "train", state_fp: Path | None = None):
         """Initializes the Iterator with the provided configuration and data split.
 
         Args:
@@ -46,6 +52,9 @@ class TabularDataset(TimeableMixin):
                 data processing, feature selection, and other settings.
             split: The data split to use, which can be one of "train", "tuning",
                 or "held_out". This determines which subset of the data is loaded and processed.
+            state_fp: The file of a dataset state written by `save_state`, e.g., the state of the training
+                data saved with a model. If given, its code masks and fitted preprocessing are used instead of
+                being derived from this split.
         """
         super().__init__(cache_prefix=Path(cfg.path.cache_dir))
         self.cfg = cfg
@@ -63,17 +72,120 @@ class TabularDataset(TimeableMixin):
                 + str(Path(cfg.path.input_label_cache_dir).resolve())
             )
         self.valid_event_ids, self.labels = None, None
+        self._column_names = None
+
+        # The state cache is keyed on this split, so it does not apply to a state fitted elsewhere
+        self._state_cache_dir = self._get_state_cache_dir() if state_fp is None else None
+        if state_fp is not None:
+            logger.info(f"Loading dataset state from {state_fp}")
+            self.load_state(state_fp)
+        elif self._state_cache_dir is not None and (self._state_cache_dir / "state.pkl").is_file():
+            logger.info(f"Loading cached dataset state from {self._state_cache_dir}")
+            self.load_state(self._state_cache_dir / "state.pkl")
+        else:
+            self.codes_set, self.code_masks, self.num_features = self._get_code_set()
 
-        self.codes_set, self.code_masks, self.num_features = self._get_code_set()
-
-        self._set_scaler()
-        self._set_imputer()
+            self._set_scaler()
+            self._set_imputer()
+            if self._state_cache_dir is not None:
+                self.save_state(self._state_cache_dir / "state.pkl")
 
         self.valid_event_ids, self.labels = self._load_ids_and_labels()
         # check if the labels are empty
         if len(self.labels) == 0:
             raise ValueError("No labels found.")
 
+    def _get_state_cache_key(self) -> dict:
+        """Returns everything the derived dataset state (code masks, fitted preprocessing) depends on.
+
+        This covers the tabularization config (without resolving the expensive ``_resolved_codes``, which is a
+        function of the other keys and the code metadata file), the preprocessing objects, the split and the
+        on-disk signature of the code metadata, code statistics (if codes are filtered on their subject
+        prevalence), label and task-specific matrix files of the split, so rewriting any of them invalidates
+        the cached state.
+        """
+        tabularization = {}
+        for key in self.cfg.tabularization.keys():
+            if key == "_resolved_codes":
+                continue
+            value = self.cfg.tabularization[key]
+            if isinstance(value, DictConfig | ListConfig):
+                value = OmegaConf.to_container(value, resolve=True)
+            tabularization[key] = value
+
+        def file_signature(fp: Path) -> tuple[str, int, int]:
+            stat = Path(fp).stat()
+            return str(Path(fp).resolve()), stat.st_size, stat.st_mtime_ns
+
+        label_dir = Path(self.cfg.path.input_label_cache_dir) / self.split
+        tabularized_dir = Path(self.cfg.path.input_tabularized_cache_dir) / self.split
+        data_loading_params = self.cfg.data_loading_params
+        code_stats_fp = self.cfg.tabularization.get("code_stats_fp", None)
+        code_stats = None
+        if self.cfg.tabularization.get("min_subject_prevalence", None) is not None and code_stats_fp:
+            code_stats = file_signature(code_stats_fp) if Path(code_stats_fp).is_file() else None
+        return {
+            "split": self.split,
+            "tabularization": tabularization,
+            "input_tabularized_cache_dir": str(Path(self.cfg.path.input_tabularized_cache_dir).resolve()),
+            "binarize_task": data_loading_params.get("binarize_task", None),
+            "imputer": repr(OmegaConf.select(data_loading_params, "imputer.imputer_target", default=None)),
+            "normalizer": repr(
+                OmegaConf.select(data_loading_params, "normalization.normalizer", default=None)
+            ),
+            "code_metadata": file_signature(self.cfg.tabularization.filtered_code_metadata_fp),
+            "code_stats": code_stats,
+            "tabularized_data": get_input_signature(tabularized_dir) if tabularized_dir.is_dir() else None,
+            "labels": [file_signature(label_dir / f"{shard}.parquet") for shard in self._data_shards],
+        }
+
+    def _get_state_cache_dir(self) -> Path | None:
+        """Returns the directory caching the derived state of this dataset, or None if caching is disabled.
+
+        The directory is keyed by a hash of `_get_state_cache_key`, so sweep trials that only vary model
+        hyperparameters reuse the code masks, fitted preprocessing and filtered shards of earlier trials.
+        """
+        if not self.cfg.data_loading_params.get("cache_dataset_state", False):
+            return None
+        key = json.dumps(self._get_state_cache_key(), sort_keys=True, default=str)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return Path(self.cfg.path.cache_dir) / "dataset_state" / digest
+
+    def save_state(self, fp: Path):
+        """Writes the derived dataset state to disk, atomically so concurrent trials never read partial files.
+
+        Args:
+            fp: The file path to write the pickled state to.
+        """
+        state = {
+            "codes_set": self.codes_set,
+            "code_masks": self.code_masks,
+            "num_features": self.num_features,
+            "scaler": self.scaler,
+            "imputer": self.imputer,
+            "column_names": self.get_all_column_names(),
+        }
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fp = fp.with_name(f".{fp.name}.{os.getpid()}.tmp")
+        with open(tmp_fp, "wb") as f:
+            pickle.dump(state, f, protocol=5)
+        os.replace(tmp_fp, fp)
+
+    def load_state(self, fp: Path):
+        """Restores the derived dataset state written by `save_state`.
+
+        Args:
+            fp: The file path of the pickled state.
+        """
+        with open(fp, "rb") as f:
+            state = pickle.load(f)
+        self.codes_set = state["codes_set"]
+        self.code_masks = state["code_masks"]
+        self.num_features = state["num_features"]
+        self.scaler = state["scaler"]
+        self.imputer = state["imputer"]
+        self._column_names = state["column_names"]
+
     @TimeableMixin.TimeAs
     def _get_code_masks(self, feature_columns: list, codes_set: set) -> Mapping[str, list[bool]]:
         """Creates boolean masks for filtering features.
@@ -183,7 +295,7 @@ class TabularDataset(TimeableMixin):
         """
         feature_columns = get_feature_columns(self.cfg.tabularization.filtered_code_metadata_fp)
         feature_dict = {col: i for i, col in enumerate(feature_columns)}
-        allowed_codes = set(self.cfg.tabularization._resolved_codes)
+        allowed_codes = get_resolved_code_set(self.cfg.tabularization)
         codes_set = {feature_dict[code] for code in feature_dict if code in allowed_codes}
 
         if (
@@ -318,6 +430,13 @@ class TabularDataset(TimeableMixin):
         Raises:
             ValueError: If any of the required files for the shard do not exist.
         """
+        # Filtered shards are only cached once the code masks are known
+        shard_cache_fp = None
+        if self._state_cache_dir is not None and getattr(self, "code_masks", None) is not None:
+            shard_cache_fp = self._state_cache_dir / "shards" / f"{self._data_shards[idx]}.npz"
+            if shard_cache_fp.is_file():
+                return sp.load_npz(shard_cache_fp).tocsc()
+
         # get all window_size x aggreagation files using the file resolver
         files = get_model_files(self.cfg, self.split, self._data_shards[idx])
 
@@ -332,6 +451,12 @@ class TabularDataset(TimeableMixin):
 
         combined_csc = sp.hstack(dynamic_cscs, format="csc")
 
+        if shard_cache_fp is not None:
+            shard_cache_fp.parent.mkdir(parents=True, exist_ok=True)
+            tmp_fp = shard_cache_fp.with_name(f".{shard_cache_fp.stem}.{os.getpid()}.tmp.npz")
+            sp.save_npz(tmp_fp, combined_csc, compressed=False)
+            os.replace(tmp_fp, shard_cache_fp)
+
         return combined_csc
 
     @TimeableMixin.TimeAs
@@ -402,6 +527,47 @@ class TabularDataset(TimeableMixin):
 
         return X, y
 
+    def iter_minibatches(
+        self,
+        batch_size: int,
+        shuffle: bool = True,
+        buffer_shards: int = 1,
+        rng: np.random.Generator | None = None,
+    ) -> Iterator[tuple[sp.csr_matrix, np.ndarray]]:
+        """Iterates once over the split in mini-batches of rows.
+
+        Shards are visited in a random order and loaded ``buffer_shards`` at a time; the rows of each buffer
+        are shuffled together and sliced into batches, so at most ``buffer_shards`` shards are held in memory
+        while rows from different shards are still mixed within the same batches.
+
+        Args:
+            batch_size: The maximum number of rows per batch.
+            shuffle: Whether to shuffle the shard order and the rows within each buffer.
+            buffer_shards: The number of shards whose rows are shuffled together.
+            rng: The random number generator used for shuffling. Pass the same generator across epochs to
+                get a different, but reproducible, order every epoch.
+
+        Yields:
+            Tuples of the feature data of a batch as a CSR matrix and the corresponding labels.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+        if buffer_shards < 1:
+            raise ValueError(f"buffer_shards must be positive, got {buffer_shards}")
+        if rng is None:
+            rng = np.random.default_rng()
+
+        n_shards = len(self._data_shards)
+        shard_order = rng.permutation(n_shards) if shuffle else np.arange(n_shards)
+        for start in range(0, n_shards, buffer_shards):
+            X, y = self.get_data_shards([int(i) for i in shard_order[start : start + buffer_shards]])
+            X = sp.csr_matrix(X)
+            y = np.asarray(y)
+            row_order = rng.permutation(X.shape[0]) if shuffle else np.arange(X.shape[0])
+            for batch_start in range(0, len(row_order), batch_size):
+                batch_rows = row_order[batch_start : batch_start + batch_size]
+                yield X[batch_rows], y[batch_rows]
+
     def get_data(self) -> tuple[sp.csc_matrix, np.ndarray]:
         """Retrieves the feature data and labels for the current split.
 
@@ -438,6 +604,9 @@ class TabularDataset(TimeableMixin):
         Returns:
             The names of all columns.
         """
+        if self._column_names is not None:
+            return list(self._column_names)
+
         files = get_model_files(self.cfg, self.split, self._data_shards[0])
 
         def extract_name(test_file):
@@ -454,7 +623,8 @@ class TabularDataset(TimeableMixin):
             for feat_name in feature_names:
                 all_feats.append(f"{feat_name}/{agg}/{window}")
 
-        return all_feats
+        self._column_names = all_feats
+        return list(all_feats)
 
     def get_column_names(self, indices: list[int] = None) -> list[str]:
         """Retrieves the names of the columns in the data.
@@ -462,27 +632,31 @@ class TabularDataset(TimeableMixin):
         Returns:
             The names of the columns.
         """
-        files = get_model_files(self.cfg, self.split, self._data_shards[0])
-
-        def extract_name(test_file):
-            return str(Path(test_file.parent.parent.stem, test_file.parent.stem, test_file.stem))
-
-        agg_wind_combos = [extract_name(test_file) for test_file in files]
-
-        feature_columns = get_feature_columns(self.cfg.tabularization.filtered_code_metadata_fp)
-        all_feats = []
-        for agg_wind in agg_wind_combos:
-            window, feat, agg = agg_wind.split("/")
-            feature_ids = get_feature_indices(feat + "/" + agg, feature_columns)
-            feature_names = [feature_columns[i] for i in feature_ids]
-            for feat_name in feature_names:
-                all_feats.append(f"{feat_name}/{agg}/{window}")
+        all_feats = self.get_all_column_names()
 
         # filter by only those in the list of indices
         if indices is not None:
             all_feats = [all_feats[i] for i in indices]
         return all_feats
 
+    def get_included_column_names(self) -> list[str]:
+        """Retrieves the names of the columns of the loaded data.
+
+        These are the names of the features passing the code masks.
+
+        Returns:
+            The names of the columns of the matrices returned by `get_data_shards`, in order.
+        """
+        code_masks = []
+        for file in get_model_files(self.cfg, self.split, self._data_shards[0]):
+            if file.stem in ["first", "present"]:
+                agg = f"static/{file.stem}"
+            else:
+                agg = f"{file.parent.stem}/{file.stem}"
+            code_masks.append(np.asarray(self.code_masks[agg], dtype=bool))
+        included = np.concatenate(code_masks)
+        return [name for name, is_included in zip(self.get_all_column_names(), included) if is_included]
+
     def densify(self) -> np.ndarray:
         """Builds the data as a dense matrix based on column subselection."""
 
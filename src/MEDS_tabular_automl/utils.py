@@ -1,4 +1,5 @@
 """The base class for core dataset processing logic and script utilities."""
+import functools
 import os
 import sys
 from pathlib import Path
@@ -45,6 +46,8 @@ def filter_to_codes(
     min_code_inclusion_count: int | None,
     min_code_inclusion_frequency: float | None,
     max_include_codes: int | None,
+    code_stats_fp: Path | None = None,
+    min_subject_prevalence: float | None = None,
 ) -> ListConfig[str]:
     """Filters and returns codes based on allowed list and minimum frequency.
 
@@ -57,6 +60,10 @@ def filter_to_codes(
             across all codes in the dataset, to be included.
         max_include_codes: Maximum number of codes to include (selecting the most
             prevelent codes).
+        code_stats_fp: Path to the per-code statistics computed by the describe stage, used for the
+            ``min_subject_prevalence`` filter.
+        min_subject_prevalence: The minimum fraction of subjects that must have a code for its features to
+            be included.
 
     Returns:
         Sorted list of the intersection of allowed codes (if they are specified) and filters based on
@@ -83,7 +90,25 @@ def filter_to_codes(
         ...
         ValueError: Code filtering criteria ...
         ...
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     codes_fp, stats_fp = Path(d) / "codes.parquet", Path(d) / "code_stats.parquet"
+        ...     codes = ["A/code", "A/value", "B/static/present"]
+        ...     codes_df = pl.DataFrame({"code": codes, "count": [4, 3, 2]})
+        ...     codes_df.write_parquet(codes_fp)
+        ...     pl.DataFrame({"code": ["A", "B"], "subject_prevalence": [0.1, 0.5]}).write_parquet(stats_fp)
+        ...     filter_to_codes(codes_fp, None, None, None, None, stats_fp, 0.2)
+        ['B/static/present']
+        >>> filter_to_codes("codes.parquet", None, None, None, None, None, 0.2)
+        Traceback (most recent call last):
+        ...
+        ValueError: min_subject_prevalence requires the code statistics of the describe stage (code_stats_fp).
     """
+    if min_subject_prevalence is not None and code_stats_fp is None:
+        raise ValueError(
+            "min_subject_prevalence requires the code statistics of the describe stage (code_stats_fp)."
+        )
+
     feature_freqs = pl.read_parquet(code_metadata_fp)
 
     if allowed_codes is not None:
@@ -98,6 +123,20 @@ def filter_to_codes(
     if min_code_inclusion_count is not None:
         feature_freqs = feature_freqs.filter(pl.col("count") >= min_code_inclusion_count)
 
+    if min_subject_prevalence is not None:
+        prevalent_codes = pl.scan_parquet(code_stats_fp).filter(
+            pl.col("subject_prevalence") >= min_subject_prevalence
+        )
+        feature_freqs = (
+            feature_freqs.with_columns(
+                pl.col("code")
+                .str.replace(r"/(static/present|static/first|code|value)$", "")
+                .alias("base_code")
+            )
+            .join(prevalent_codes.select(pl.col("code").alias("base_code")).collect(), on="base_code")
+            .drop("base_code")
+        )
+
     if max_include_codes is not None:
         feature_freqs = feature_freqs.sort("count", descending=True).head(max_include_codes)
 
@@ -109,11 +148,175 @@ def filter_to_codes(
             f"\n- tabularization.min_code_inclusion_count: {min_code_inclusion_count}"
             f"\n- tabularization.min_code_inclusion_frequency: {min_code_inclusion_frequency}"
             f"\n- tabularization.max_include_codes: {max_include_codes}"
+            f"\n- tabularization.min_subject_prevalence: {min_subject_prevalence}"
         )
     return ListConfig(sorted(feature_freqs["code"].to_list()))
 
 
-OmegaConf.register_new_resolver("filter_to_codes", filter_to_codes, replace=True)
+def get_file_fingerprint(fp: Path | str | None) -> tuple[str, int, int] | None:
+    """Returns the resolved path, modification time and size of a file, or None if it does not exist.
+
+    Examples:
+        >>> from tempfile import NamedTemporaryFile
+        >>> with NamedTemporaryFile() as f:
+        ...     _ = f.write(b"abc"); f.flush()
+        ...     get_file_fingerprint(f.name)[2]
+        3
+        >>> get_file_fingerprint("missing.parquet") is None, get_file_fingerprint(None) is None
+        (True, True)
+    """
+    if fp is None:
+        return None
+    try:
+        stat = os.stat(fp)
+    except FileNotFoundError:
+        return None
+    return str(Path(fp).resolve()), stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _filter_to_codes_cached(
+    code_metadata_fingerprint: tuple,
+    allowed_codes: tuple[str, ...] | None,
+    min_code_inclusion_count: int | None,
+    min_code_inclusion_frequency: float | None,
+    max_include_codes: int | None,
+    code_stats_fingerprint: tuple,
+    min_subject_prevalence: float | None,
+) -> frozenset[str]:
+    code_metadata_fp, code_stats_fp = code_metadata_fingerprint[0], code_stats_fingerprint[0]
+    return frozenset(
+        filter_to_codes(
+            code_metadata_fp,
+            None if allowed_codes is None else list(allowed_codes),
+            min_code_inclusion_count,
+            min_code_inclusion_frequency,
+            max_include_codes,
+            code_stats_fp,
+            min_subject_prevalence,
+        )
+    )
+
+
+def resolve_codes(
+    code_metadata_fp: Path,
+    allowed_codes: list[str] | None,
+    min_code_inclusion_count: int | None,
+    min_code_inclusion_frequency: float | None,
+    max_include_codes: int | None,
+    code_stats_fp: Path | None = None,
+    min_subject_prevalence: float | None = None,
+) -> frozenset[str]:
+    """Returns the codes of `filter_to_codes` as a frozenset, computed once per process for the same inputs.
+
+    This backs the ``filter_to_codes`` resolver of ``tabularization._resolved_codes`` (see
+    `resolve_codes_config`), which is accessed in the task loops of every stage. The result is memoized on
+    the arguments and the path, modification time and size of the code metadata (and code statistics) file,
+    so the file is only read and filtered again once it changes.
+
+    Args:
+        code_metadata_fp: Path to the metadata file containing code information.
+        allowed_codes: List of allowed codes, None means all codes are allowed.
+        min_code_inclusion_count: Minimum count a code must have to be included.
+        min_code_inclusion_frequency: The minimum normalized frequency a code must have to be included.
+        max_include_codes: Maximum number of codes to include.
+        code_stats_fp: Path to the per-code statistics computed by the describe stage.
+        min_subject_prevalence: The minimum fraction of subjects that must have a code.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "codes.parquet"
+        ...     pl.DataFrame({"code": ["E", "D", "A"], "count": [4, 3, 2]}).write_parquet(fp)
+        ...     codes = resolve_codes(fp, ListConfig(["A", "D"]), None, None, None)
+        ...     sorted(codes), resolve_codes(fp, ["A", "D"], None, None, None) is codes
+        ...     pl.DataFrame({"code": ["E", "D"], "count": [4, 3]}).write_parquet(fp)
+        ...     os.utime(fp, ns=(0, 0))
+        ...     sorted(resolve_codes(fp, ["A", "D"], None, None, None))
+        (['A', 'D'], True)
+        ['D']
+    """
+    code_stats_fingerprint = (None,)
+    if min_subject_prevalence is not None and code_stats_fp is not None:
+        code_stats_fingerprint = get_file_fingerprint(code_stats_fp) or (str(code_stats_fp),)
+    return _filter_to_codes_cached(
+        get_file_fingerprint(code_metadata_fp) or (str(code_metadata_fp),),
+        None if allowed_codes is None else tuple(allowed_codes),
+        min_code_inclusion_count,
+        min_code_inclusion_frequency,
+        max_include_codes,
+        code_stats_fingerprint,
+        min_subject_prevalence,
+    )
+
+
+def get_resolved_code_set(tabularization_cfg: DictConfig) -> frozenset[str]:
+    """Returns the codes of ``tabularization._resolved_codes`` as the frozenset of `resolve_codes`.
+
+    This takes the same arguments as the ``filter_to_codes`` resolver of ``_resolved_codes``, so membership
+    tests use the memoized set instead of iterating over the items of the config list.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "codes.parquet"
+        ...     pl.DataFrame({"code": ["E", "D", "A"], "count": [4, 3, 2]}).write_parquet(fp)
+        ...     cfg = OmegaConf.create({
+        ...         "filtered_code_metadata_fp": str(fp), "allowed_codes": None,
+        ...         "min_code_inclusion_count": 3, "min_code_inclusion_frequency": None,
+        ...         "max_included_codes": None, "code_stats_fp": None, "min_subject_prevalence": None,
+        ...     })
+        ...     sorted(get_resolved_code_set(cfg))
+        ['D', 'E']
+    """
+    return resolve_codes(
+        tabularization_cfg.filtered_code_metadata_fp,
+        tabularization_cfg.allowed_codes,
+        tabularization_cfg.min_code_inclusion_count,
+        tabularization_cfg.min_code_inclusion_frequency,
+        tabularization_cfg.max_included_codes,
+        tabularization_cfg.get("code_stats_fp", None),
+        tabularization_cfg.get("min_subject_prevalence", None),
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _get_sorted_codes_config(codes: frozenset[str]) -> ListConfig:
+    # The node is shared by every config of the process, so it is read-only
+    node = ListConfig(sorted(codes))
+    OmegaConf.set_readonly(node, True)
+    return node
+
+
+def resolve_codes_config(*args) -> ListConfig:
+    """The ``filter_to_codes`` resolver: the codes of `resolve_codes` as a sorted list for the configuration.
+
+    OmegaConf only holds lists, not sets, and converts the list returned by a resolver into a config node on
+    every access, which takes seconds for tens of thousands of codes. The sorted list is therefore built once
+    per code set and returned as the same read-only node on each access, which OmegaConf passes through
+    unchanged. Use `get_resolved_code_set` for membership tests.
+
+    Examples:
+        >>> import tempfile
+        >>> from omegaconf.errors import ReadonlyConfigError
+        >>> with tempfile.TemporaryDirectory() as d:
+        ...     fp = Path(d) / "codes.parquet"
+        ...     pl.DataFrame({"code": ["E", "D", "A"], "count": [4, 3, 2]}).write_parquet(fp)
+        ...     cfg = OmegaConf.create({"fp": str(fp), "codes": "${filter_to_codes:${fp},null,3,null,null}"})
+        ...     cfg.codes, cfg.codes is cfg.codes
+        ...     try:
+        ...         cfg.codes.append("F")
+        ...     except ReadonlyConfigError:
+        ...         print("read-only")
+        ...     cfg.codes
+        (['D', 'E'], True)
+        read-only
+        ['D', 'E']
+    """
+    return _get_sorted_codes_config(resolve_codes(*args))
+
+
+OmegaConf.register_new_resolver("filter_to_codes", resolve_codes_config, replace=True)
 
 
 def load_tqdm(use_tqdm: bool):
@@ -356,6 +559,78 @@ def get_unique_time_events_df(events_df: pl.LazyFrame) -> pl.LazyFrame:
     return events_df
 
 
+def load_label_df(label_dir: Path | str, label_column: str) -> pl.LazyFrame:
+    """Loads the labels of a task, with one label per subject and prediction time.
+
+    Args:
+        label_dir: The directory of the label parquet files, with columns subject_id, prediction_time and the
+            label column.
+        label_column: The column holding the label.
+
+    Returns:
+        A LazyFrame with columns subject_id, time and label, plus any other columns of the label files.
+
+    Raises:
+        FileNotFoundError: If the label directory does not exist.
+    """
+    label_dir = Path(label_dir)
+    if not label_dir.exists():
+        raise FileNotFoundError(
+            f"Label directory {label_dir} does not exist, please check the `input_label_dir` kwarg"
+        )
+    return (
+        pl.scan_parquet(label_dir / "**/*.parquet")
+        .rename({"prediction_time": "time", label_column: "label"})
+        .group_by(pl.col("subject_id", "time"), maintain_order=True)
+        .first()
+    )
+
+
+def get_label_events_df(label_df: pl.LazyFrame, shard_df: pl.LazyFrame, feature_columns) -> pl.LazyFrame:
+    """Matches each label of the subjects of a shard to the last event at or before its prediction time.
+
+    Args:
+        label_df: The labels, as loaded by `load_label_df`.
+        shard_df: The (filtered) MEDS shard.
+        feature_columns: The feature columns used to extract the events of the shard.
+
+    Returns:
+        The labels of the subjects of the shard with an additional ``event_id`` column, the index of the
+        matched event in `get_unique_time_events_df`, i.e., the row of the tabularized shard.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> shard_df = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2],
+        ...     "time": [datetime(2020, 1, d) for d in [1, 2, 5]] + [datetime(2020, 1, d) for d in [1, 3]],
+        ...     "code": ["A", "A", "B", "A", "B"],
+        ... })
+        >>> label_df = pl.LazyFrame({
+        ...     "subject_id": [1, 2, 3],
+        ...     "time": [datetime(2020, 1, 4), datetime(2020, 1, 3), datetime(2020, 1, 3)],
+        ...     "label": [True, False, True],
+        ... })
+        >>> get_label_events_df(label_df, shard_df, ["A/code", "B/code"]).collect()
+        shape: (2, 4)
+        ┌────────────┬─────────────────────┬───────┬──────────┐
+        │ subject_id ┆ time                ┆ label ┆ event_id │
+        │ ---        ┆ ---                 ┆ ---   ┆ ---      │
+        │ i64        ┆ datetime[μs]        ┆ bool  ┆ u32      │
+        ╞════════════╪═════════════════════╪═══════╪══════════╡
+        │ 1          ┆ 2020-01-04 00:00:00 ┆ true  ┆ 1        │
+        │ 2          ┆ 2020-01-03 00:00:00 ┆ false ┆ 4        │
+        └────────────┴─────────────────────┴───────┴──────────┘
+    """
+    events_df = (
+        get_unique_time_events_df(get_events_df(shard_df, feature_columns))
+        .with_row_index("event_id")
+        .select("subject_id", "time", "event_id")
+    )
+    return label_df.join(events_df.select("subject_id").unique(), on="subject_id", how="inner").join_asof(
+        other=events_df, by="subject_id", on="time"
+    )
+
+
 def get_feature_names(agg: str, feature_columns: list[str]) -> str:
     """Extracts feature column names based on aggregation type from a list of column names.
 
@@ -418,6 +693,65 @@ def get_shard_prefix(base_path: Path, fp: Path) -> str:
     return str(relative_parent / file_name)
 
 
+def get_subject_chunks(shard_df: pl.LazyFrame, max_events_per_chunk: int | None) -> list[pl.LazyFrame]:
+    """Splits a shard into chunks of consecutive subjects with at most ``max_events_per_chunk`` events each.
+
+    Rolling windows never cross subjects, so tabularizing the chunks separately and concatenating their rows
+    in order yields the same output as tabularizing the whole shard, while only one chunk needs to fit in
+    memory at a time. Only timestamped events are counted, as subjects without them produce no rows; a
+    subject with more events than the limit gets a chunk of its own.
+
+    Args:
+        shard_df: The (filtered) shard, sorted by subject_id and time.
+        max_events_per_chunk: The maximum number of timestamped events per chunk. If None, the shard is not
+            split.
+
+    Returns:
+        The chunks, as lazy filters of ``shard_df`` on ranges of subject ids, in subject order.
+
+    Examples:
+        >>> shard_df = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2, 3, 4, 4],
+        ...     "time": [None, 1, 2, 1, 2, None, 1, 2],
+        ... })
+        >>> [chunk.collect()["subject_id"].to_list() for chunk in get_subject_chunks(shard_df, 3)]
+        [[1, 1, 1], [2, 2, 3], [4, 4]]
+        >>> [chunk.collect()["subject_id"].to_list() for chunk in get_subject_chunks(shard_df, 5)]
+        [[1, 1, 1, 2, 2, 3], [4, 4]]
+        >>> len(get_subject_chunks(shard_df, None)), len(get_subject_chunks(shard_df, 100))
+        (1, 1)
+    """
+    if max_events_per_chunk is None:
+        return [shard_df]
+    counts = (
+        shard_df.filter(pl.col("time").is_not_null())
+        .group_by("subject_id")
+        .agg(pl.len().alias("n_events"))
+        .sort("subject_id")
+        .collect()
+    )
+    if counts["n_events"].sum() <= max_events_per_chunk or counts.height <= 1:
+        return [shard_df]
+
+    # Each chunk ends just before the first subject that would push it over the limit.
+    chunk_starts = []
+    n_events_in_chunk = 0
+    for subject_id, n_events in counts.iter_rows():
+        if not chunk_starts or n_events_in_chunk + n_events > max_events_per_chunk:
+            chunk_starts.append(subject_id)
+            n_events_in_chunk = 0
+        n_events_in_chunk += n_events
+
+    logger.info(f"Splitting shard into {len(chunk_starts)} chunks of at most {max_events_per_chunk} events")
+    chunks = []
+    for i, start in enumerate(chunk_starts):
+        in_chunk = pl.col("subject_id") >= start if i > 0 else pl.lit(True)
+        if i < len(chunk_starts) - 1:
+            in_chunk = in_chunk & (pl.col("subject_id") < chunk_starts[i + 1])
+        chunks.append(shard_df.filter(in_chunk))
+    return chunks
+
+
 def current_script_name() -> str:
     """Returns the name of the module that called this function."""
 
@@ -1,13 +1,15 @@
 from collections.abc import Callable
 from pathlib import Path
 
+import numpy as np
 import scipy.sparse as sp
 import xgboost as xgb
 from loguru import logger
 from omegaconf import DictConfig, OmegaConf
-from sklearn.metrics import roc_auc_score
 
 from .base_model import BaseModel
+from .metrics import binary_classification_metrics
+from .pruning import MedianPruner, get_pruner
 from .tabular_dataset import TabularDataset
 
 
@@ -72,6 +74,51 @@ class XGBIterator(xgb.DataIter, TabularDataset):
         self._it = 0
 
 
+def get_pruning_eval_metrics(eval_metric: str | list[str] | None) -> list[str]:
+    """Returns the evaluation metrics of a model whose tuning AUC is reported to a pruner.
+
+    The AUC is added in front of the configured metrics, as the last metric drives early stopping; without
+    configured metrics, XGBoost's default logloss stays last.
+
+    Examples:
+        >>> get_pruning_eval_metrics(None)
+        ['auc', 'logloss']
+        >>> get_pruning_eval_metrics("error")
+        ['auc', 'error']
+        >>> get_pruning_eval_metrics(["error", "logloss"])
+        ['auc', 'error', 'logloss']
+        >>> get_pruning_eval_metrics(["logloss", "auc"])
+        ['logloss', 'auc']
+    """
+    if eval_metric is None:
+        return ["auc", "logloss"]
+    eval_metric = [eval_metric] if isinstance(eval_metric, str) else list(eval_metric)
+    return eval_metric if "auc" in eval_metric else ["auc", *eval_metric]
+
+
+class XGBoostPruningCallback(xgb.callback.TrainingCallback):
+    """Reports the per-round tuning AUC to a pruner and stops training once the trial should be pruned.
+
+    Args:
+        pruner: The pruner tracking the intermediate values of the current trial.
+        eval_name: The name of the evaluation set whose metric is reported.
+        metric: The name of the evaluation metric to report.
+    """
+
+    def __init__(self, pruner: MedianPruner, eval_name: str = "tuning", metric: str = "auc"):
+        super().__init__()
+        self.pruner = pruner
+        self.eval_name = eval_name
+        self.metric = metric
+        self.pruned = False
+
+    def after_iteration(self, model: xgb.Booster, epoch: int, evals_log: dict) -> bool:
+        """Reports the latest metric value and returns True to stop training if the trial is pruned."""
+        self.pruner.report(epoch, evals_log[self.eval_name][self.metric][-1])
+        self.pruned = self.pruner.should_prune()
+        return self.pruned
+
+
 class XGBoostModel(BaseModel):
     """Class for configuring, training, and evaluating an XGBoost model.
 
@@ -126,16 +173,32 @@ class XGBoostModel(BaseModel):
             self._build_dmatrix_from_iterators()
 
     def _train(self):
-        """Trains the model."""
+        """Trains the model.
+
+        If pruning is enabled, the tuning AUC is reported to the pruner after every boosting round and
+        training stops early once the trial falls below the median of the completed trials.
+        """
+        params = OmegaConf.to_container(self.cfg.model)
+        callbacks = []
+        pruner = get_pruner(self.cfg)
+        if pruner is not None:
+            params["eval_metric"] = get_pruning_eval_metrics(params.get("eval_metric", None))
+            pruning_callback = XGBoostPruningCallback(pruner)
+            callbacks.append(pruning_callback)
+
         self.model = xgb.train(
-            OmegaConf.to_container(self.cfg.model),
+            params,
             self.dtrain,
             num_boost_round=self.cfg.training_params.num_boost_round,
             early_stopping_rounds=self.cfg.training_params.early_stopping_rounds,
             evals=[(self.dtrain, "train"), (self.dtuning, "tuning")],
             verbose_eval=0,
+            callbacks=callbacks,
         )
 
+        if pruner is not None:
+            pruner.complete(pruned=pruning_callback.pruned)
+
     def train(self):
         """Trains the model."""
         self._build()
@@ -168,6 +231,14 @@ class XGBoostModel(BaseModel):
         Returns:
             The evaluation metric as the ROC AUC score.
         """
+        return self.evaluate_metrics(split)["auc"]
+
+    def evaluate_metrics(self, split="tuning") -> dict[str, float]:
+        """Evaluates the model on a split.
+
+        Returns:
+            The ROC AUC, AUPRC and log-loss of the model on the split.
+        """
         if split == "tuning":
             y_pred = self.model.predict(self.dtuning)
             y_true = self.dtuning.get_label()
@@ -179,7 +250,7 @@ class XGBoostModel(BaseModel):
             y_true = self.dtrain.get_label()
         else:
             raise ValueError(f"Invalid split for evaluation: {split}")
-        return roc_auc_score(y_true, y_pred)
+        return binary_classification_metrics(y_true, y_pred)
 
     def save_model(self, output_fp: Path):
         """Saves the trained model to the specified file path.
@@ -188,3 +259,31 @@ class XGBoostModel(BaseModel):
             output_fp: The file path to save the model to.
         """
         self.model.save_model(output_fp)
+
+    def load_model(self, input_fp: Path):
+        """Loads a model saved with `save_model` from the specified file path.
+
+        Args:
+            input_fp: The file path to load the model from.
+        """
+        params = {}
+        if OmegaConf.select(self.cfg, "model.nthread") is not None:
+            params["nthread"] = self.cfg.model.nthread
+        self.model = xgb.Booster(params=params)
+        self.model.load_model(input_fp)
+
+    def predict(self, X: sp.csc_matrix) -> np.ndarray:
+        """Predicts the probability of the positive class for each row of the feature matrix.
+
+        Args:
+            X: The feature matrix, with the columns the model was trained on.
+
+        Returns:
+            The predicted probabilities.
+
+        Raises:
+            ValueError: If the number of columns of `X` differs from the number of features of the model.
+        """
+        if X.shape[1] != self.model.num_features():
+            raise ValueError(f"The model expects {self.model.num_features()} features, got {X.shape[1]}.")
+        return self.model.predict(xgb.DMatrix(sp.csr_matrix(X)))
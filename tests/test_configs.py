@@ -65,6 +65,33 @@ def test_model_config(model_launcher_override, imputer, normalization, tmp_path)
     assert cfg.tabularization.window_sizes
 
 
+def test_autogluon_config(tmp_path):
+    code_metadata_fp = tmp_path / "codes.parquet"
+    pl.DataFrame({"code": ["E", "D", "A"], "count": [4, 3, 2]}).write_parquet(code_metadata_fp)
+    model_launcher_config_kwargs = {
+        "input_dir": "/foo/",
+        "output_dir": "/bar/",
+        "output_model_dir": "/baz/",
+        "++tabularization.filtered_code_metadata_fp": str(code_metadata_fp),
+        "task_name": "foo_bar",
+    }
+
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = ["model_launcher=autogluon"] + [
+            f"{k}={v}" for k, v in model_launcher_config_kwargs.items()
+        ]
+        cfg = compose(config_name="launch_model", overrides=overrides)
+        assert cfg.model_launcher.data_format == "sparse"
+        assert cfg.model_launcher.dense_chunk_columns == 1024
+        assert cfg.model_launcher.top_k_features is None
+        assert "model_launcher" not in cfg.model_launcher
+
+        overrides += ["model_launcher.data_format=dense", "model_launcher.top_k_features=10"]
+        cfg = compose(config_name="launch_model", overrides=overrides)
+        assert cfg.model_launcher.data_format == "dense"
+        assert cfg.model_launcher.top_k_features == 10
+
+
 def test_generate_subsets_configs():
     input_dir = "blah"
     stderr, stdout_ws = run_command("generate-subsets", ["[30d]"], {}, "generate-subsets window_sizes")
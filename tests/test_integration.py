@@ -306,11 +306,13 @@ def test_integration(tmp_path):
         stderr, stdout = run_command(script, overrides, model_config, f"launch_model_{model}")
         assert "Performance of best model:" in stderr
         if model == "xgboost":
-            assert len(glob.glob(str(output_model_dir / "*/sweep_results/**/*.json"))) == 2
-            assert len(glob.glob(str(output_model_dir / "*/best_trial/*.json"))) == 1
+            assert len(glob.glob(str(output_model_dir / f"*/sweep_results/**/{model}.json"))) == 2
+            assert len(glob.glob(str(output_model_dir / f"*/best_trial/{model}.json"))) == 1
         else:
-            assert len(glob.glob(str(output_model_dir / "*/sweep_results/**/*.pkl"))) == 2
-            assert len(glob.glob(str(output_model_dir / "*/best_trial/*.pkl"))) == 1
+            assert len(glob.glob(str(output_model_dir / f"*/sweep_results/**/{model}.pkl"))) == 2
+            assert len(glob.glob(str(output_model_dir / f"*/best_trial/{model}.pkl"))) == 1
+        assert len(glob.glob(str(output_model_dir / "*/best_trial/dataset_state.pkl"))) == 1
+        assert len(glob.glob(str(output_model_dir / "*/best_trial/columns.json"))) == 1
         shutil.rmtree(output_model_dir)
 
     for model in [
@@ -339,9 +341,11 @@ def test_integration(tmp_path):
         stderr, stdout = run_command(script, overrides, model_config, f"launch_model_{model}")
         assert "Performance of best model:" in stderr
         if model == "xgboost":
-            assert len(glob.glob(str(output_model_dir / "*/sweep_results/**/*.json"))) == 2
-            assert len(glob.glob(str(output_model_dir / "*/best_trial/*.json"))) == 1
+            assert len(glob.glob(str(output_model_dir / f"*/sweep_results/**/{model}.json"))) == 2
+            assert len(glob.glob(str(output_model_dir / f"*/best_trial/{model}.json"))) == 1
         else:
-            assert len(glob.glob(str(output_model_dir / "*/sweep_results/**/*.pkl"))) == 2
-            assert len(glob.glob(str(output_model_dir / "*/best_trial/*.pkl"))) == 1
+            assert len(glob.glob(str(output_model_dir / f"*/sweep_results/**/{model}.pkl"))) == 2
+            assert len(glob.glob(str(output_model_dir / f"*/best_trial/{model}.pkl"))) == 1
+        assert len(glob.glob(str(output_model_dir / "*/best_trial/dataset_state.pkl"))) == 1
+        assert len(glob.glob(str(output_model_dir / "*/best_trial/columns.json"))) == 1
         shutil.rmtree(output_model_dir)
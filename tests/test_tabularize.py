@@ -4,23 +4,41 @@ root = rootutils.setup_root(__file__, dotenv=True, pythonpath=True, cwd=True)
 
 import importlib
 import json
+import os
 import shutil
+import tempfile
+from datetime import datetime
 from io import StringIO
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 import pytest
+import scipy.sparse as sp
 from hydra import compose, initialize
+from omegaconf import OmegaConf
 
-from MEDS_tabular_automl.describe_codes import get_feature_columns
-from MEDS_tabular_automl.file_name import list_subdir_files
+from MEDS_tabular_automl.describe_codes import (
+    CodeFilter,
+    compute_feature_frequencies,
+    get_feature_columns,
+    sum_feature_frequencies,
+)
+from MEDS_tabular_automl.feature_builder import FeatureBuilder
+from MEDS_tabular_automl.file_name import get_model_files, list_subdir_files
+from MEDS_tabular_automl.generate_summarized_reps import generate_summary
+from MEDS_tabular_automl.profiling import StageProfiler, set_active_profiler
 from MEDS_tabular_automl.scripts import (
     cache_task,
     describe_codes,
+    filter_shards,
     launch_model,
+    predict,
     tabularize_static,
+    tabularize_task,
     tabularize_time_series,
 )
+from MEDS_tabular_automl.tabular_dataset import TabularDataset
 from MEDS_tabular_automl.utils import (
     VALUE_AGGREGATIONS,
     get_events_df,
@@ -145,6 +163,26 @@ EXPECTED_STATIC_FILES = [
 ]
 
 
+def test_summary_min_max_rows():
+    # Each window's min and max are written to the row of its event; they all used to end up in row 0.
+    index_df = pl.LazyFrame(
+        {
+            "subject_id": [1, 1, 1, 2, 2],
+            "time": [datetime(2020, 1, d) for d in (1, 2, 5)] + [datetime(2020, 1, d) for d in (1, 2)],
+        }
+    )
+    matrix = sp.csr_array(np.array([[3.0, 0], [1.0, 2.0], [5.0, 0], [2.0, 4.0], [0, 1.0]]))
+    feature_columns = ["A/value", "B/value"]
+
+    expected = {
+        "value/min": [[3.0, 0.0], [1.0, 0.0], [5.0, 0.0], [2.0, 4.0], [0.0, 1.0]],
+        "value/max": [[3.0, 0.0], [3.0, 2.0], [5.0, 0.0], [2.0, 4.0], [2.0, 4.0]],
+    }
+    for agg, expected_rows in expected.items():
+        summary = generate_summary(feature_columns, index_df, matrix, "2d", agg)
+        assert summary.toarray().tolist() == expected_rows, agg
+
+
 def test_tabularize(tmp_path):
     input_dir = Path(tmp_path) / "input_dir"
     output_dir = Path(tmp_path) / "output_dir"
@@ -161,7 +199,7 @@ def test_tabularize(tmp_path):
         "loguru_init": True,
     }
 
-    describe_codes_config = {**shared_config}
+    describe_codes_config = {**shared_config, "n_workers": 2, "code_stats.enabled": True}
 
     with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
         overrides = [f"{k}={v}" for k, v in describe_codes_config.items()]
@@ -192,10 +230,31 @@ def test_tabularize(tmp_path):
     split_json = json.load(StringIO(SPLITS_JSON))
     splits_fp = input_dir / ".shards.json"
     json.dump(split_json, splits_fp.open("w"))
-    # Step 1: Describe Codes - compute code frequencies
+    # Step 1: Describe Codes - compute code frequencies, first without the held out shard and then
+    # incrementally once it is appended to the dataset
+    held_out_fp = input_dir / "held_out/0.parquet"
+    shutil.move(held_out_fp, output_dir / "held_out_0.parquet")
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = [f"{k}={v}" for k, v in describe_codes_config.items()] + ["incremental=True"]
+        incremental_cfg = compose(config_name="describe_codes", overrides=overrides)
+    describe_codes.main(incremental_cfg)
+    partial_codes = pl.read_parquet(cfg.output_filepath)
+
+    shutil.move(output_dir / "held_out_0.parquet", held_out_fp)
+    describe_codes.main(incremental_cfg)
+    expected_codes = sum_feature_frequencies(
+        pl.concat([compute_feature_frequencies(pl.scan_parquet(fp)) for fp in meds_files]).lazy()
+    )
+    assert pl.read_parquet(cfg.output_filepath).equals(expected_codes)
+    assert not partial_codes.equals(expected_codes)
+    assert "held_out/0" in json.loads(Path(cfg.manifest_fp).read_text())["shards"]
+
     describe_codes.main(cfg)
 
     assert Path(cfg.output_filepath).is_file()
+    code_stats = pl.read_parquet(cfg.code_stats.output_filepath)
+    assert code_stats["subject_prevalence"].is_between(0, 1, closed="right").all()
+    assert (code_stats["n_values"] > 0).sum() == code_stats["quantiles"].is_not_null().sum()
 
     feature_columns = get_feature_columns(cfg.output_filepath)
     assert get_feature_names("code/count", feature_columns) == sorted(CODE_COLS)
@@ -209,18 +268,29 @@ def test_tabularize(tmp_path):
         **shared_config,
         "tabularization.min_code_inclusion_count": 1,
         "tabularization.window_sizes": "[30d,365d,full]",
+        "incremental": True,
     }
 
     with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
         overrides = [f"{k}={v}" for k, v in tabularize_static_config.items()]
         cfg = compose(config_name="tabularization", overrides=overrides)
-    tabularize_static.main(cfg)
+    profiler = StageProfiler("tabularize_static", Path(cfg.output_dir) / ".profile")
+    set_active_profiler(profiler)
+    try:
+        tabularize_static.main(cfg)
+    finally:
+        set_active_profiler(None)
 
     output_dir = Path(cfg.output_dir) / "tabularize"
 
     output_files = list(output_dir.glob("**/static/**/*.npz"))
     actual_files = [get_shard_prefix(output_dir, each) + ".npz" for each in output_files]
     assert set(actual_files) == set(EXPECTED_STATIC_FILES)
+    # every static output is profiled as a task of the stage
+    report = pl.read_parquet(profiler.save().with_suffix(".parquet"))
+    assert set(report["task"]) == {str(f) for f in output_files}
+    assert (report["status"] == "computed").all()
+    assert (report["rows"] > 0).all() and (report["bytes_written"] > 0).all()
     # Check the files are not empty
     for f in output_files:
         static_matrix = load_matrix(f)
@@ -249,6 +319,16 @@ def test_tabularize(tmp_path):
     ), f"Should have {len(feature_columns)} codes but has {num_allowed_codes}"
 
     tabularize_time_series.main(cfg)
+    for manifest_fp in [output_dir / ".static_manifest.json", output_dir / ".time_series_manifest.json"]:
+        assert set(json.loads(manifest_fp.read_text())["shards"]) == set(MEDS_OUTPUTS)
+    task_costs = json.loads(Path(cfg.task_cost_history_fp).read_text())
+    assert set(task_costs["aggs"]) == set(cfg.tabularization.aggs)
+    assert len(task_costs["shards"]) == len(MEDS_OUTPUTS)
+
+    # outputs whose inputs and manifest keys are unchanged are reused
+    static_mtimes = {fp: fp.stat().st_mtime_ns for fp in output_dir.glob("**/none/**/*.npz")}
+    tabularize_static.main(cfg)
+    assert static_mtimes == {fp: fp.stat().st_mtime_ns for fp in output_dir.glob("**/none/**/*.npz")}
 
     # confirm summary files exist:
     output_files = list_subdir_files(str(output_dir.resolve()), "npz")
@@ -291,6 +371,42 @@ def test_tabularize(tmp_path):
     )
     expected_num_static_tabs = NUM_SHARDS * 2
     assert len(list_subdir_files(cfg.output_dir, "npz")) == expected_num_time_tabs + expected_num_static_tabs
+
+    # Tabularizing shards in subject chunks yields the same matrices
+    with tempfile.TemporaryDirectory() as chunked_dir:
+        with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+            overrides = [f"{k}={v}" for k, v in tabularize_static_config.items()] + [
+                "max_events_per_chunk=4",
+                f"output_tabularized_dir={chunked_dir}",
+            ]
+            chunked_cfg = compose(config_name="tabularization", overrides=overrides)
+        tabularize_static.main(chunked_cfg)
+        tabularize_time_series.main(chunked_cfg)
+        for f in list_subdir_files(cfg.output_tabularized_dir, "npz"):
+            chunked_f = Path(chunked_dir) / f.relative_to(cfg.output_tabularized_dir)
+            assert (load_matrix(f).tocsr() != load_matrix(chunked_f).tocsr()).nnz == 0, f
+
+    # Tabularizing the shards filtered once by meds-tab-filter-shards yields the same matrices
+    with tempfile.TemporaryDirectory() as filtered_dir:
+        with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+            overrides = [f"{k}={v}" for k, v in tabularize_static_config.items()] + [
+                "use_filtered_shards=True",
+                f"filtered_shards_dir={filtered_dir}/shards",
+                f"output_tabularized_dir={filtered_dir}/tabularize",
+            ]
+            filtered_cfg = compose(config_name="tabularization", overrides=overrides)
+        filter_shards.main(filtered_cfg)
+        filtered_shard_fps = list_subdir_files(f"{filtered_dir}/shards", "arrow")
+        assert len(filtered_shard_fps) == NUM_SHARDS
+        assert pl.read_ipc(filtered_shard_fps[0]).schema["code"] == pl.Enum(
+            CodeFilter(cfg.tabularization._resolved_codes).codes
+        )
+        tabularize_static.main(filtered_cfg)
+        tabularize_time_series.main(filtered_cfg)
+        for f in list_subdir_files(cfg.output_tabularized_dir, "npz"):
+            filtered_f = Path(filtered_dir) / "tabularize" / f.relative_to(cfg.output_tabularized_dir)
+            assert (load_matrix(f).tocsr() != load_matrix(filtered_f).tocsr()).nnz == 0, f
+
     # Step 3: Cache Task data
     cache_config = {
         **shared_config,
@@ -314,7 +430,17 @@ def test_tabularize(tmp_path):
     out_fp.parent.mkdir(parents=True, exist_ok=True)
     df.write_parquet(out_fp)
 
-    cache_task.main(cfg)
+    profiler = StageProfiler("cache_task", Path(cfg.output_dir) / ".profile")
+    set_active_profiler(profiler)
+    try:
+        cache_task.main(cfg)
+    finally:
+        set_active_profiler(None)
+    # tasks read both the MEDS shard and the tabularized matrix
+    report = profiler.get_report()
+    assert report.height == len(list_subdir_files(cfg.output_tabularized_cache_dir, "npz"))
+    assert (report["status"] == "computed").all()
+    assert (report["bytes_read"] > 0).all() and (report["bytes_written"] > 0).all()
     for split in split_json:
         for window in cfg.tabularization.window_sizes:
             for agg in cfg.tabularization.aggs:
@@ -332,6 +458,52 @@ def test_tabularize(tmp_path):
         == expected_num_time_tabs + expected_num_static_tabs
     )
 
+    # Features built in memory for the labeled prediction times match the task-specific cache
+    builder = FeatureBuilder(
+        get_feature_columns(cfg.tabularization.filtered_code_metadata_fp),
+        list(cfg.tabularization.window_sizes),
+        list(cfg.tabularization.aggs),
+        allowed_codes=list(cfg.tabularization._resolved_codes),
+    )
+    for split in split_json:
+        label_df = pl.read_parquet(Path(cfg.output_label_cache_dir) / f"{split}.parquet")
+        model_files_cfg = OmegaConf.create(
+            {
+                "path": {"input_tabularized_cache_dir": cfg.output_tabularized_cache_dir},
+                "tabularization": {
+                    "window_sizes": cfg.tabularization.window_sizes,
+                    "aggs": cfg.tabularization.aggs,
+                },
+            }
+        )
+        model_files = get_model_files(model_files_cfg, *split.split("/"))
+        expected = sp.hstack([load_matrix(fp) for fp in model_files], format="csr")
+        features = builder.transform(
+            pl.read_parquet(Path(cfg.input_dir) / f"{split}.parquet"),
+            label_df.select("subject_id", pl.col("time").alias("prediction_time")),
+        )
+        assert features.shape == expected.shape
+        assert (features != expected).nnz == 0, split
+
+    # Task-first tabularization yields the same labels and matrices without tabularizing every event
+    with tempfile.TemporaryDirectory() as task_dir:
+        with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+            overrides = [f"{k}={v}" for k, v in cache_config.items()] + [
+                f"output_tabularized_cache_dir={task_dir}/task_cache",
+                f"output_label_cache_dir={task_dir}/labels",
+            ]
+            task_cfg = compose(config_name="tabularize_task", overrides=overrides)
+        tabularize_task.main(task_cfg)
+        for f in list_subdir_files(cfg.output_label_cache_dir, "parquet"):
+            task_f = Path(task_cfg.output_label_cache_dir) / f.relative_to(cfg.output_label_cache_dir)
+            assert pl.read_parquet(f).equals(pl.read_parquet(task_f)), f
+        cached_files = list_subdir_files(cfg.output_tabularized_cache_dir, "npz")
+        assert len(cached_files) == len(list_subdir_files(task_cfg.output_tabularized_cache_dir, "npz"))
+        for f in cached_files:
+            relative_fp = f.relative_to(cfg.output_tabularized_cache_dir)
+            task_f = Path(task_cfg.output_tabularized_cache_dir) / relative_fp
+            assert (load_matrix(f).tocsr() != load_matrix(task_f).tocsr()).nnz == 0, f
+
     failure_xgboost_config = {
         **shared_config,
         "tabularization.min_code_inclusion_count": 100_000_000,
@@ -361,12 +533,42 @@ def test_tabularize(tmp_path):
     launch_model.main(cfg)
 
     expected_output_dir = Path(cfg.time_output_model_dir)
-    output_files = list(expected_output_dir.glob("**/*.json"))
+    output_files = list(expected_output_dir.glob(f"**/{cfg.path.model_file_stem}.json"))
     assert len(output_files) == 1
 
     log_dir = Path(cfg.path.sweep_results_dir)
     log_files = list(log_dir.glob("**/*.log"))
     assert len(log_files) == 2
+
+    # The training data's dataset state and included columns are saved with the model
+    trial_dir = output_files[0].parent
+    columns = json.loads((trial_dir / f"{cfg.path.column_manifest_stem}.json").read_text())
+    train_dataset = TabularDataset(
+        cfg.model_launcher, "train", state_fp=trial_dir / f"{cfg.path.dataset_state_stem}.pkl"
+    )
+    assert train_dataset.get_included_column_names() == columns
+    assert train_dataset.get_data_shards(0)[0].shape[1] == len(columns)
+
+    # The saved model scores the labeled prediction times of every split
+    predict_config = {**shared_config, "task_name": "test_task", "model_dir": str(output_files[0].parent)}
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = [f"{k}={v}" for k, v in predict_config.items()]
+        predict_cfg = compose(config_name="predict", overrides=overrides)
+    predict.main(predict_cfg)
+    prediction_fps = list_subdir_files(predict_cfg.output_predictions_dir, "parquet")
+    assert len(prediction_fps) == len(split_json)
+    for split in split_json:
+        label_df = pl.read_parquet(Path(predict_cfg.input_label_cache_dir) / f"{split}.parquet")
+        predictions_df = pl.read_parquet(Path(predict_cfg.output_predictions_dir) / f"{split}.parquet")
+        assert predictions_df["subject_id"].equals(label_df["subject_id"])
+        assert predictions_df["prediction_time"].equals(label_df["time"], check_names=False)
+        probabilities = predictions_df["predicted_boolean_probability"]
+        assert probabilities.is_between(0, 1).all()
+        assert predictions_df["predicted_boolean_value"].equals(probabilities >= 0.5, check_names=False)
+    # Up-to-date predictions are not recomputed
+    mtimes = [fp.stat().st_mtime_ns for fp in prediction_fps]
+    predict.main(predict_cfg)
+    assert mtimes == [fp.stat().st_mtime_ns for fp in prediction_fps]
     shutil.rmtree(expected_output_dir)
 
     xgboost_config = {
@@ -386,7 +588,7 @@ def test_tabularize(tmp_path):
     launch_model.main(cfg)
 
     expected_output_dir = Path(cfg.time_output_model_dir)
-    output_files = list(expected_output_dir.glob("**/*.json"))
+    output_files = list(expected_output_dir.glob(f"**/{cfg.path.model_file_stem}.json"))
     assert len(output_files) == 1
 
     log_dir = Path(cfg.path.sweep_results_dir)
@@ -394,6 +596,27 @@ def test_tabularize(tmp_path):
     assert len(log_files) == 2
     shutil.rmtree(expected_output_dir)
 
+    cached_state_config = {
+        **xgboost_config,
+        "data_loading_params.cache_dataset_state": True,
+    }
+
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = ["model_launcher=xgboost"] + [f"{k}={v}" for k, v in cached_state_config.items()]
+        cfg = compose(config_name="launch_model", overrides=overrides, return_hydra_config=True)
+
+    uncached_auc = launch_model.main(cfg)
+    state_fps = list((Path(cfg.path.cache_dir) / "dataset_state").glob("*/state.pkl"))
+    assert len(state_fps) == 3, "There should be one cached dataset state per split!"
+    assert launch_model.main(cfg) == uncached_auc
+    assert len(list((Path(cfg.path.cache_dir) / "dataset_state").glob("*/state.pkl"))) == 3
+    # rewriting the task-specific matrices of a split invalidates its cached state
+    state_dir = TabularDataset(cfg.model_launcher, "train")._get_state_cache_dir()
+    npz_fp = next((Path(cfg.model_launcher.path.input_tabularized_cache_dir) / "train").rglob("*.npz"))
+    os.utime(npz_fp, ns=(0, 0))
+    assert TabularDataset(cfg.model_launcher, "train")._get_state_cache_dir() != state_dir
+    shutil.rmtree(Path(cfg.time_output_model_dir))
+
     sklearnmodel_config = {
         **shared_config,
         "tabularization.min_code_inclusion_count": 1,
@@ -409,8 +632,21 @@ def test_tabularize(tmp_path):
     launch_model.main(cfg)
 
     expected_output_dir = Path(cfg.time_output_model_dir)
-    output_files = list(expected_output_dir.glob("**/*.pkl"))
+    output_files = list(expected_output_dir.glob(f"**/{cfg.path.model_file_stem}.pkl"))
     assert len(output_files) == 1
+
+    predict_config = {
+        **shared_config,
+        "task_name": "test_task",
+        "model_dir": str(output_files[0].parent),
+        "output_predictions_dir": str(Path(cfg.output_dir) / "test_task" / "sgd_predictions"),
+        "splits": "[held_out]",
+    }
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = [f"{k}={v}" for k, v in predict_config.items()]
+        predict_cfg = compose(config_name="predict", overrides=overrides)
+    predict.main(predict_cfg)
+    assert len(list_subdir_files(predict_cfg.output_predictions_dir, "parquet")) == 1
     shutil.rmtree(expected_output_dir)
 
     sklearnmodel_config = {
@@ -450,7 +686,22 @@ def test_tabularize(tmp_path):
     launch_model.main(cfg)
 
     expected_output_dir = Path(cfg.time_output_model_dir)
-    output_files = list(expected_output_dir.glob("**/*.pkl"))
+    output_files = list(expected_output_dir.glob(f"**/{cfg.path.model_file_stem}.pkl"))
+    assert len(output_files) == 1
+    shutil.rmtree(expected_output_dir)
+
+    minibatch_config = {
+        **sklearnmodel_config,
+        "model_launcher.training_params.batch_size": 4,
+        "model_launcher.training_params.shuffle_buffer_shards": 2,
+    }
+    with initialize(version_base=None, config_path="../src/MEDS_tabular_automl/configs/"):
+        overrides = ["model_launcher=sgd_classifier"] + [f"{k}={v}" for k, v in minibatch_config.items()]
+        cfg = compose(config_name="launch_model", overrides=overrides)
+    launch_model.main(cfg)
+
+    expected_output_dir = Path(cfg.time_output_model_dir)
+    output_files = list(expected_output_dir.glob(f"**/{cfg.path.model_file_stem}.pkl"))
     assert len(output_files) == 1
     shutil.rmtree(expected_output_dir)
 